@@ -0,0 +1,188 @@
+from collections import Counter
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from xml_utils import IssueTracker, env_float, env_int
+
+# Diferencia máxima (pesos) aceptada por cada partida sumada; el redondeo del SAT es por partida.
+TOLERANCIA_AUDITORIA = env_float("XML_TOLERANCIA_AUDITORIA", 0.01)
+# Días después del fin de periodo en que todavía se acepta la fecha de pago.
+DIAS_GRACIA_PERIODO = env_int("XML_AUDITORIA_DIAS_GRACIA", 0)
+
+COLUMNAS_EXCEPCIONES: List[str] = [
+    "Regla",
+    "Folio CFDI (UUID)",
+    "Archivo",
+    "Detalle",
+    "Declarado",
+    "Calculado",
+    "Diferencia",
+]
+
+HOJA_EXCEPCIONES = "Excepciones"
+
+REGLA_UUID_DUPLICADO = "UUID duplicado"
+REGLA_PERIODO_INVERTIDO = "Periodo invertido"
+REGLA_FECHA_FUERA_PERIODO = "Fecha fuera del periodo"
+REGLA_PAGO_DUPLICADO = "Pago duplicado del periodo"
+REGLA_UUID_OTRO_LOTE = "UUID visto en otro lote"
+REGLA_PERIODO_OTRO_LOTE = "Periodo pagado en otro lote"
+
+
+def _excepciones(regla: str, uuid: pd.Series, archivo: pd.Series, detalle, **montos) -> pd.DataFrame:
+    datos = {"Regla": regla, "Folio CFDI (UUID)": uuid.to_numpy(), "Archivo": archivo.to_numpy(), "Detalle": detalle}
+    for columna in ("Declarado", "Calculado", "Diferencia"):
+        valor = montos.get(columna.lower())
+        datos[columna] = valor.to_numpy() if valor is not None else None
+    return pd.DataFrame(datos, columns=COLUMNAS_EXCEPCIONES)
+
+
+def diferencias_de_total(
+    regla: str,
+    uuid: pd.Series,
+    archivo: pd.Series,
+    declarado: pd.Series,
+    calculado: pd.Series,
+    partidas: pd.Series,
+) -> pd.DataFrame:
+    """Documentos cuyo total declarado difiere de la suma de sus partidas más allá de la tolerancia."""
+    diferencia = declarado - calculado
+    fuera = diferencia.astype(float).abs() > TOLERANCIA_AUDITORIA * partidas.clip(lower=1)
+    detalle = partidas[fuera].map(lambda n: f"{n} partida(s) sumada(s)")
+    return _excepciones(
+        regla,
+        uuid[fuera],
+        archivo[fuera],
+        detalle.to_numpy(),
+        declarado=declarado[fuera],
+        calculado=calculado[fuera],
+        diferencia=diferencia[fuera],
+    )
+
+
+def uuids_duplicados(uuid: pd.Series, archivo: pd.Series) -> pd.DataFrame:
+    """Una fila por archivo cuyo UUID aparece en más de un archivo del lote."""
+    pares = pd.DataFrame({"uuid": uuid.astype(str).str.upper().to_numpy(), "original": uuid.to_numpy(), "archivo": archivo.to_numpy()})
+    pares = pares[~pares["uuid"].isin(("", "N/A", "NAN", "NONE"))].drop_duplicates(["uuid", "archivo"])
+    archivos = pares.groupby("uuid", sort=False)["archivo"].transform("size")
+    repetidos = pares[archivos > 1]
+    detalle = archivos[archivos > 1].map(lambda n: f"UUID presente en {n} archivos")
+    return _excepciones(REGLA_UUID_DUPLICADO, repetidos["original"], repetidos["archivo"], detalle.to_numpy())
+
+
+def _fechas(valores: pd.Series) -> pd.Series:
+    # Solo la parte de fecha: algunos emisores incluyen hora en campos tipo t_Fecha.
+    return pd.to_datetime(valores.astype(str).str.slice(0, 10), format="%Y-%m-%d", errors="coerce")
+
+
+def fechas_fuera_de_periodo(
+    uuid: pd.Series,
+    archivo: pd.Series,
+    fecha: pd.Series,
+    inicio: pd.Series,
+    fin: pd.Series,
+    etiqueta: str,
+) -> pd.DataFrame:
+    """Periodos con inicio posterior al fin y fechas fuera de [inicio, fin + días de gracia]."""
+    fecha_dt, inicio_dt, fin_dt = _fechas(fecha), _fechas(inicio), _fechas(fin)
+    invertido = inicio_dt > fin_dt
+    fuera = ~invertido & (
+        (fecha_dt < inicio_dt) | (fecha_dt > fin_dt + pd.Timedelta(days=DIAS_GRACIA_PERIODO))
+    )
+    periodo = inicio.astype(str) + " a " + fin.astype(str)
+    return pd.concat(
+        [
+            _excepciones(
+                REGLA_PERIODO_INVERTIDO, uuid[invertido], archivo[invertido], ("Periodo " + periodo[invertido]).to_numpy()
+            ),
+            _excepciones(
+                REGLA_FECHA_FUERA_PERIODO,
+                uuid[fuera],
+                archivo[fuera],
+                (etiqueta + " " + fecha[fuera].astype(str) + " fuera del periodo " + periodo[fuera]).to_numpy(),
+            ),
+        ],
+        ignore_index=True,
+    )
+
+
+def periodos_traslapados(
+    empleado: pd.Series, uuid: pd.Series, archivo: pd.Series, inicio: pd.Series, fin: pd.Series
+) -> pd.DataFrame:
+    """Pagos de un mismo empleado cuyo periodo [inicio, fin] se traslapa con el de otro pago.
+
+    Índice de intervalos por empleado: ordenados por inicio, cada periodo se compara con el
+    mayor fin visto antes en el grupo y se reporta contra el pago dueño de ese fin. Se omiten
+    empleados vacíos, fechas inválidas, periodos invertidos y el mismo UUID en varios archivos
+    (ya reportado como UUID duplicado).
+    """
+    periodos = pd.DataFrame(
+        {
+            "empleado": empleado.to_numpy(),
+            "uuid": uuid.to_numpy(),
+            "archivo": archivo.to_numpy(),
+            "inicio": inicio.to_numpy(),
+            "fin": fin.to_numpy(),
+            "inicio_dt": _fechas(inicio).to_numpy(),
+            "fin_dt": _fechas(fin).to_numpy(),
+        }
+    )
+    periodos = periodos[
+        (periodos["empleado"] != "") & periodos["inicio_dt"].notna() & periodos["fin_dt"].notna()
+        & (periodos["inicio_dt"] <= periodos["fin_dt"])
+    ]
+    periodos = periodos.sort_values(["empleado", "inicio_dt", "fin_dt"], kind="stable").reset_index(drop=True)
+    grupos = periodos.groupby("empleado", sort=False)
+    mayor_fin = grupos["fin_dt"].cummax()
+    # Posición del pago con el mayor fin hasta cada fila, y la del anterior dentro del empleado.
+    duenio = pd.Series(np.where(periodos["fin_dt"] == mayor_fin, periodos.index, np.nan)).groupby(periodos["empleado"]).ffill()
+    anterior = duenio.groupby(periodos["empleado"]).shift()
+    fin_anterior = mayor_fin.groupby(periodos["empleado"]).shift()
+    traslape = (periodos["inicio_dt"] <= fin_anterior).to_numpy()
+    if not traslape.any():
+        return _excepciones(REGLA_PAGO_DUPLICADO, uuid.iloc[:0], archivo.iloc[:0], [])
+
+    filas = periodos[traslape]
+    otros = periodos.loc[anterior[traslape].astype(int).to_numpy()].reset_index(drop=True)
+    filas = filas.reset_index(drop=True)
+    distinto = (filas["uuid"].astype(str).str.upper() != otros["uuid"].astype(str).str.upper()).to_numpy()
+    filas, otros = filas[distinto], otros[distinto]
+    detalle = (
+        "Empleado " + filas["empleado"].astype(str)
+        + ": periodo " + filas["inicio"].astype(str) + " a " + filas["fin"].astype(str)
+        + " traslapado con " + otros["uuid"].astype(str).to_numpy()
+        + " (" + otros["archivo"].astype(str).to_numpy()
+        + ", " + otros["inicio"].astype(str).to_numpy() + " a " + otros["fin"].astype(str).to_numpy() + ")"
+    )
+    return _excepciones(REGLA_PAGO_DUPLICADO, filas["uuid"], filas["archivo"], detalle.to_numpy())
+
+
+def excepciones_de_indice(regla: str, filas: Sequence[Sequence[str]]) -> pd.DataFrame:
+    """Excepciones ya resueltas contra el índice entre lotes: filas (uuid, archivo, detalle)."""
+    uuid, archivo, detalle = (list(columna) for columna in zip(*filas)) if filas else ([], [], [])
+    return _excepciones(regla, pd.Series(uuid, dtype=object), pd.Series(archivo, dtype=object), detalle)
+
+
+def unir_excepciones(partes: Iterable[Optional[pd.DataFrame]]) -> pd.DataFrame:
+    partes = [parte for parte in partes if parte is not None and not parte.empty]
+    if not partes:
+        return pd.DataFrame(columns=COLUMNAS_EXCEPCIONES)
+    return pd.concat(partes, ignore_index=True)
+
+
+def ordenar_por_regla(excepciones: pd.DataFrame, reglas: Sequence[str]) -> pd.DataFrame:
+    """Junta las filas de cada regla en el orden de `reglas` (otras al final) sin alterar su orden interno.
+
+    Para lotes auditados por partes, donde cada parte trae sus propias filas de cada regla.
+    """
+    orden = {regla: posicion for posicion, regla in enumerate(reglas)}
+    posiciones = excepciones["Regla"].map(lambda regla: orden.get(regla, len(orden))).to_numpy()
+    return excepciones.iloc[np.argsort(posiciones, kind="stable")].reset_index(drop=True)
+
+
+def reportar_excepciones(tracker: IssueTracker, excepciones: pd.DataFrame) -> None:
+    """Un aviso por regla con el número de excepciones encontradas."""
+    for regla, cantidad in Counter(excepciones["Regla"]).items():
+        tracker.warn(f"Auditoría: {cantidad} excepción(es) de '{regla}'; ver hoja {HOJA_EXCEPCIONES}")
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Almacén local de CFDI en SQLite
+Los extractores cargan aquí lo que leen (si XML_SQLITE_DB está definido) y este
+mismo script permite consultar y exportar a CSV/XLSX sin volver a leer los XML.
+
+Uso:
+    python cfdi_store.py <base.db> [--tabla comprobantes] [--rfc RFC] [--desde AAAA-MM-DD]
+                         [--hasta AAAA-MM-DD] [--tipo I] [--min-total 100000] --salida out.xlsx
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from xml_utils import IssueTracker, env_int
+
+# Decimal (modo XML_MONTOS_EXACTOS) se guarda como texto y SQLite lo convierte a REAL.
+sqlite3.register_adapter(Decimal, str)
+
+LOTE_INSERCION = env_int("XML_SQLITE_LOTE", 5000)
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS comprobantes (
+    uuid TEXT PRIMARY KEY,
+    lote TEXT,
+    archivo TEXT,
+    tipo TEXT,
+    version TEXT,
+    fecha TEXT,
+    rfc_emisor TEXT,
+    nombre_emisor TEXT,
+    regimen_fiscal_emisor TEXT,
+    lugar_expedicion TEXT,
+    rfc_receptor TEXT,
+    nombre_receptor TEXT,
+    uso_cfdi TEXT,
+    metodo_pago TEXT,
+    forma_pago TEXT,
+    total REAL
+);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_rfc_emisor ON comprobantes (rfc_emisor, fecha);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_rfc_receptor ON comprobantes (rfc_receptor, fecha);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_fecha ON comprobantes (fecha);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_tipo ON comprobantes (tipo, fecha);
+
+CREATE TABLE IF NOT EXISTS conceptos (
+    uuid TEXT,
+    descripcion TEXT,
+    cantidad REAL,
+    unidad TEXT,
+    valor_unitario REAL,
+    importe REAL,
+    clave_impuesto_trasladado TEXT,
+    impuesto_trasladado REAL,
+    clave_impuesto_retenido TEXT,
+    impuesto_retenido REAL,
+    total_concepto REAL
+);
+CREATE INDEX IF NOT EXISTS ix_conceptos_uuid ON conceptos (uuid);
+
+CREATE TABLE IF NOT EXISTS pagos (
+    uuid TEXT,
+    uuid_relacionado TEXT,
+    tipo_relacion TEXT,
+    forma_pago TEXT,
+    monto REAL,
+    importe_pagado REAL
+);
+CREATE INDEX IF NOT EXISTS ix_pagos_uuid ON pagos (uuid);
+CREATE INDEX IF NOT EXISTS ix_pagos_relacionado ON pagos (uuid_relacionado);
+
+CREATE TABLE IF NOT EXISTS nominas (
+    uuid TEXT PRIMARY KEY,
+    lote TEXT,
+    archivo TEXT,
+    num_empleado TEXT,
+    nombre TEXT,
+    rfc TEXT,
+    curp TEXT,
+    puesto TEXT,
+    departamento TEXT,
+    tipo_nomina TEXT,
+    fecha TEXT,
+    num_dias_pagados TEXT,
+    fecha_inicial_pago TEXT,
+    fecha_final_pago TEXT,
+    fecha_pago TEXT,
+    total_percepciones REAL,
+    total_deducciones REAL,
+    total_subsidios REAL,
+    total_neto REAL
+);
+CREATE INDEX IF NOT EXISTS ix_nominas_rfc ON nominas (rfc, fecha_pago);
+CREATE INDEX IF NOT EXISTS ix_nominas_curp ON nominas (curp, fecha_pago);
+CREATE INDEX IF NOT EXISTS ix_nominas_fecha ON nominas (fecha_pago);
+CREATE INDEX IF NOT EXISTS ix_nominas_tipo ON nominas (tipo_nomina, fecha_pago);
+
+CREATE TABLE IF NOT EXISTS nomina_conceptos (
+    uuid TEXT,
+    tipo TEXT,
+    tipo_sat TEXT,
+    clave TEXT,
+    concepto TEXT,
+    importe_gravado REAL,
+    importe_exento REAL,
+    importe_total REAL
+);
+CREATE INDEX IF NOT EXISTS ix_nomina_conceptos_uuid ON nomina_conceptos (uuid);
+"""
+
+# Columnas de la hoja de gasto -> columnas de cada tabla
+GASTO_COMPROBANTE = [
+    ("Tipo de Comprobante", "tipo"),
+    ("Versión CFDI", "version"),
+    ("Fecha", "fecha"),
+    ("RFC Proveedor", "rfc_emisor"),
+    ("Nombre Proveedor", "nombre_emisor"),
+    ("Régimen Fiscal Proveedor", "regimen_fiscal_emisor"),
+    ("CP del Proveedor", "lugar_expedicion"),
+    ("RFC del Cliente", "rfc_receptor"),
+    ("Nombre del Cliente", "nombre_receptor"),
+    ("Uso del CFDI", "uso_cfdi"),
+    ("Método de Pago", "metodo_pago"),
+    ("Forma de Pago", "forma_pago"),
+    ("Total General", "total"),
+]
+GASTO_CONCEPTO = [
+    ("Descripción", "descripcion"),
+    ("Cantidad", "cantidad"),
+    ("Unidad", "unidad"),
+    ("Valor Unitario", "valor_unitario"),
+    ("Importe", "importe"),
+    ("Clave Impuesto Trasladado", "clave_impuesto_trasladado"),
+    ("Impuesto Trasladado", "impuesto_trasladado"),
+    ("Clave Impuesto Retenido", "clave_impuesto_retenido"),
+    ("Impuesto Retenido", "impuesto_retenido"),
+    ("Total por Concepto", "total_concepto"),
+]
+GASTO_PAGO = [
+    ("Folio CFDI (UUID) Relacionados", "uuid_relacionado"),
+    ("Tipo Relación", "tipo_relacion"),
+    ("Forma de Pago", "forma_pago"),
+    ("Importe", "monto"),
+    ("_ImpPagado", "importe_pagado"),
+]
+
+NOMINA_COLUMNAS = [
+    "uuid", "lote", "archivo", "num_empleado", "nombre", "rfc", "curp", "puesto", "departamento",
+    "tipo_nomina", "fecha", "num_dias_pagados", "fecha_inicial_pago", "fecha_final_pago", "fecha_pago",
+    "total_percepciones", "total_deducciones", "total_subsidios", "total_neto",
+]
+NOMINA_CONCEPTO_COLUMNAS = [
+    "uuid", "tipo", "tipo_sat", "clave", "concepto", "importe_gravado", "importe_exento", "importe_total",
+]
+
+
+def _chunks(rows: Iterable[Sequence[Any]], size: int) -> Iterator[List[Sequence[Any]]]:
+    chunk: List[Sequence[Any]] = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _valor(value: Any) -> Any:
+    """NaN/categorías de pandas -> tipos nativos de SQLite."""
+    if value is None:
+        return None
+    if isinstance(value, float) and value != value:
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+class CfdiStore:
+    """Base SQLite (WAL) con encabezados, conceptos, pagos y nómina, indexada para consultas."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(ESQUEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _insertar(self, tabla: str, columnas: Sequence[str], filas: Iterable[Sequence[Any]], reemplazar: bool = False) -> int:
+        verbo = "INSERT OR REPLACE" if reemplazar else "INSERT"
+        sql = f"{verbo} INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' for _ in columnas)})"
+        total = 0
+        for chunk in _chunks(filas, LOTE_INSERCION):
+            self.conn.executemany(sql, chunk)
+            total += len(chunk)
+        return total
+
+    def _borrar_hijos(self, tablas: Sequence[str], uuids: Sequence[str]) -> None:
+        """Al recargar un UUID se reemplazan sus renglones dependientes."""
+        for tabla in tablas:
+            for chunk in _chunks(((uuid,) for uuid in uuids), LOTE_INSERCION):
+                self.conn.executemany(f"DELETE FROM {tabla} WHERE uuid = ?", chunk)
+
+    def cargar_gasto(self, df, lote: str) -> int:
+        """Carga la hoja de detalle de extractor_xml (ya convertida a números)."""
+        validos = df[df["Folio CFDI (UUID)"] != "N/A"]
+        encabezados = validos.drop_duplicates("Folio CFDI (UUID)")
+        uuids = encabezados["Folio CFDI (UUID)"].tolist()
+        archivos = encabezados["_Archivo"].tolist() if "_Archivo" in encabezados else [None] * len(uuids)
+
+        with self.conn:
+            self._borrar_hijos(("conceptos", "pagos"), uuids)
+            columnas = [destino for _, destino in GASTO_COMPROBANTE]
+            valores = zip(*(encabezados[origen].tolist() for origen, _ in GASTO_COMPROBANTE))
+            self._insertar(
+                "comprobantes",
+                ["uuid", "lote", "archivo"] + columnas,
+                ([uuid, lote, archivo] + [_valor(v) for v in fila] for uuid, archivo, fila in zip(uuids, archivos, valores)),
+                reemplazar=True,
+            )
+
+            es_pago = validos["Tipo de Comprobante"] == "P"
+            for subset, mapeo, tabla in ((validos[~es_pago], GASTO_CONCEPTO, "conceptos"), (validos[es_pago], GASTO_PAGO, "pagos")):
+                mapeo = [(origen, destino) for origen, destino in mapeo if origen in subset]
+                columnas = ["uuid"] + [destino for _, destino in mapeo]
+                fuentes = [subset["Folio CFDI (UUID)"].tolist()] + [subset[origen].tolist() for origen, _ in mapeo]
+                self._insertar(tabla, columnas, ([_valor(v) for v in fila] for fila in zip(*fuentes)))
+        return len(uuids)
+
+    def cargar_nomina(self, recibos: List[Dict[str, Any]], conceptos: List[Sequence[Any]], lote: str) -> int:
+        """Carga recibos (dicts con NOMINA_COLUMNAS salvo lote) y sus percepciones/deducciones/subsidios."""
+        uuids = [recibo["uuid"] for recibo in recibos if recibo["uuid"]]
+        with self.conn:
+            self._borrar_hijos(("nomina_conceptos",), uuids)
+            self._insertar(
+                "nominas",
+                NOMINA_COLUMNAS,
+                ([_valor(recibo.get(c, lote if c == "lote" else None)) for c in NOMINA_COLUMNAS] for recibo in recibos if recibo["uuid"]),
+                reemplazar=True,
+            )
+            self._insertar("nomina_conceptos", NOMINA_CONCEPTO_COLUMNAS, ([_valor(v) for v in fila] for fila in conceptos))
+        return len(uuids)
+
+
+def open_store(tracker: IssueTracker, path: Optional[str] = None) -> Optional[CfdiStore]:
+    """Abre la base configurada en XML_SQLITE_DB; None si no está habilitada."""
+    path = path or os.environ.get("XML_SQLITE_DB")
+    if not path:
+        return None
+    try:
+        return CfdiStore(path)
+    except Exception as exc:
+        tracker.error(f"No se pudo abrir la base SQLite '{path}': {exc}")
+        return None
+
+
+def lote_de(directorio: str) -> str:
+    return os.environ.get("XML_LOTE_ID") or os.path.basename(os.path.abspath(directorio))
+
+
+# ---------------------------------------------------------------------------
+# Consultas
+# ---------------------------------------------------------------------------
+
+# tabla -> (SELECT base, columna UUID, columna de fecha, columnas RFC, columna de total, columna de tipo)
+CONSULTAS: Dict[str, Tuple[str, str, str, Tuple[str, ...], str, str]] = {
+    "comprobantes": (
+        "SELECT c.* FROM comprobantes c",
+        "c.uuid",
+        "c.fecha",
+        ("c.rfc_emisor", "c.rfc_receptor"),
+        "c.total",
+        "c.tipo",
+    ),
+    "conceptos": (
+        "SELECT c.fecha, c.tipo, c.rfc_emisor, c.nombre_emisor, c.rfc_receptor, c.total, k.* "
+        "FROM conceptos k JOIN comprobantes c ON c.uuid = k.uuid",
+        "k.uuid",
+        "c.fecha",
+        ("c.rfc_emisor", "c.rfc_receptor"),
+        "c.total",
+        "c.tipo",
+    ),
+    "pagos": (
+        "SELECT c.fecha, c.rfc_emisor, c.nombre_emisor, c.rfc_receptor, p.* "
+        "FROM pagos p JOIN comprobantes c ON c.uuid = p.uuid",
+        "p.uuid",
+        "c.fecha",
+        ("c.rfc_emisor", "c.rfc_receptor"),
+        "p.importe_pagado",
+        "c.tipo",
+    ),
+    "nominas": ("SELECT n.* FROM nominas n", "n.uuid", "n.fecha_pago", ("n.rfc",), "n.total_neto", "n.tipo_nomina"),
+}
+
+
+def construir_consulta(args: argparse.Namespace) -> Tuple[str, List[Any]]:
+    base, col_uuid, col_fecha, cols_rfc, col_total, col_tipo = CONSULTAS[args.tabla]
+    condiciones: List[str] = []
+    parametros: List[Any] = []
+    if args.uuid:
+        condiciones.append(f"{col_uuid} = ?")
+        parametros.append(args.uuid)
+    if args.rfc:
+        condiciones.append("(" + " OR ".join(f"{col} = ?" for col in cols_rfc) + ")")
+        parametros.extend([args.rfc.upper()] * len(cols_rfc))
+    if args.rfc_emisor and "c.rfc_emisor" in cols_rfc:
+        condiciones.append("c.rfc_emisor = ?")
+        parametros.append(args.rfc_emisor.upper())
+    if args.rfc_receptor and "c.rfc_receptor" in cols_rfc:
+        condiciones.append("c.rfc_receptor = ?")
+        parametros.append(args.rfc_receptor.upper())
+    if args.desde:
+        condiciones.append(f"{col_fecha} >= ?")
+        parametros.append(args.desde)
+    if args.hasta:
+        # Fechas ISO con hora: se compara contra el día siguiente para incluir todo 'hasta'.
+        condiciones.append(f"{col_fecha} < ?")
+        parametros.append((date.fromisoformat(args.hasta) + timedelta(days=1)).isoformat())
+    if args.tipo:
+        condiciones.append(f"{col_tipo} = ?")
+        parametros.append(args.tipo)
+    if args.min_total is not None:
+        condiciones.append(f"{col_total} >= ?")
+        parametros.append(args.min_total)
+    if args.max_total is not None:
+        condiciones.append(f"{col_total} <= ?")
+        parametros.append(args.max_total)
+
+    sql = base
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += f" ORDER BY {col_fecha}"
+    if args.limite:
+        sql += f" LIMIT {int(args.limite)}"
+    return sql, parametros
+
+
+def exportar(cursor: sqlite3.Cursor, salida: str) -> int:
+    """Escribe el resultado en streaming a CSV o XLSX (modo write-only)."""
+    encabezados = [col[0] for col in cursor.description]
+    filas = 0
+    if salida.lower().endswith(".xlsx"):
+        import openpyxl
+
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Consulta")
+        ws.append(encabezados)
+        for fila in cursor:
+            ws.append(list(fila))
+            filas += 1
+        wb.save(salida)
+    else:
+        with open(salida, "w", newline="", encoding="utf-8-sig") as handle:
+            writer = csv.writer(handle)
+            writer.writerow(encabezados)
+            for fila in cursor:
+                writer.writerow(fila)
+                filas += 1
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consulta el almacén SQLite de CFDI y exporta a CSV/XLSX")
+    parser.add_argument("db", help="Ruta de la base SQLite (XML_SQLITE_DB)")
+    parser.add_argument("--tabla", choices=sorted(CONSULTAS), default="comprobantes")
+    parser.add_argument("--uuid")
+    parser.add_argument("--rfc", help="RFC emisor o receptor")
+    parser.add_argument("--rfc-emisor")
+    parser.add_argument("--rfc-receptor")
+    parser.add_argument("--desde", help="Fecha inicial AAAA-MM-DD")
+    parser.add_argument("--hasta", help="Fecha final AAAA-MM-DD (inclusive)")
+    parser.add_argument("--tipo", help="TipoDeComprobante (I, E, P, N...) o TipoNomina para --tabla nominas")
+    parser.add_argument("--min-total", type=float)
+    parser.add_argument("--max-total", type=float)
+    parser.add_argument("--limite", type=int)
+    parser.add_argument("--salida", required=True, help="Archivo .csv o .xlsx")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"ERROR: '{args.db}' no existe", file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        sql, parametros = construir_consulta(args)
+        conn = sqlite3.connect(args.db)
+        filas = exportar(conn.execute(sql, parametros), args.salida)
+        conn.close()
+    except Exception as e:
+        print(f"FATAL: Error en la consulta: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    print(f"{filas} fila(s) exportadas", file=sys.stderr)
+    print(os.path.abspath(args.salida))
+
+
+if __name__ == "__main__":
+    main()
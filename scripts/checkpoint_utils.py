@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from xml_utils import IssueTracker, XmlEntry, env_float, env_int, print_progress
+
+# A checkpoint is saved after this many files or this many seconds, whichever comes first.
+CHECKPOINT_EVERY_FILES = env_int("XML_CHECKPOINT_ARCHIVOS", 500)
+CHECKPOINT_EVERY_SECONDS = env_float("XML_CHECKPOINT_SEGUNDOS", 60.0)
+# Bumped when the state or part layout changes; older checkpoints are discarded.
+CHECKPOINT_VERSION = 3
+
+Signature = Tuple[int, int]  # (size, mtime_ns)
+
+
+def fingerprint_workdir(workdir: str) -> str:
+    """Identifies the batch by its directory; each processed file carries its own signature."""
+    return hashlib.sha1(os.path.abspath(workdir).encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def _tracker_state(tracker: IssueTracker) -> dict:
+    return {
+        "warnings": list(tracker.warnings),
+        "errors": list(tracker.errors),
+        "fatals": list(tracker.fatals),
+        "counters": dict(tracker.counters),
+    }
+
+
+class Checkpoint:
+    """Periodic, resumable progress of a batch job stored in `<workdir>/.checkpoint_<job>/`.
+
+    Each processed file contributes one pickled record. Records are spilled to numbered
+    part files and the state (processed names, parts, tracker contents) is replaced
+    atomically, so a crash at any point leaves the last complete checkpoint readable.
+
+    Every record is stored with the file's (size, mtime_ns). On resume a file whose
+    signature changed is processed again and its old record dropped, and records of files
+    that are no longer in the directory are dropped too.
+    """
+
+    def __init__(self, workdir: str, job: str, fingerprint: str) -> None:
+        self.directory = os.path.join(workdir, f".checkpoint_{job}")
+        self.state_path = os.path.join(self.directory, "estado.json")
+        self.job = job
+        self.fingerprint = fingerprint
+        self.processed: Dict[str, Signature] = {}
+        self.parts: List[str] = []
+        # Signature of every file discovered in this run
+        self._current: Dict[str, Signature] = {}
+        self._pending: List[Tuple[str, Signature, Any]] = []
+        self._last_save = time.monotonic()
+        self._reading_state: Optional[dict] = None
+        self.seen = 0
+
+    def load(self, tracker: IssueTracker) -> bool:
+        """Restore a previous run of the same batch; returns True when resuming."""
+        if not os.path.exists(self.state_path):
+            return False
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as handle:
+                state = json.load(handle)
+        except Exception as exc:
+            tracker.warn(f"Checkpoint ilegible en {self.directory}, se inicia desde cero: {exc}")
+            self.clear()
+            return False
+        if (
+            state.get("version") != CHECKPOINT_VERSION
+            or state.get("job") != self.job
+            or state.get("fingerprint") != self.fingerprint
+        ):
+            print_progress("Checkpoint de otro lote encontrado; se descarta.")
+            self.clear()
+            return False
+
+        self.processed = {name: (size, mtime_ns) for name, size, mtime_ns in state.get("processed", [])}
+        self.parts = list(state.get("parts", []))
+        saved = state.get("tracker", {})
+        tracker.warnings[:0] = saved.get("warnings", [])
+        tracker.errors[:0] = saved.get("errors", [])
+        tracker.fatals[:0] = saved.get("fatals", [])
+        for key, value in saved.get("counters", {}).items():
+            tracker.count(key, value)
+        print_progress(f"Reanudando desde checkpoint: {len(self.processed)} archivo(s) ya procesados")
+        return True
+
+    def done(self, name: str) -> bool:
+        return name in self.processed and self.processed[name] == self._current.get(name)
+
+    def pending(self, entries: Iterable[XmlEntry]) -> Iterator[XmlEntry]:
+        """Pass through discovered entries not yet processed, or changed since; `seen` counts all of them."""
+        for entry in entries:
+            self.seen += 1
+            self._current[entry.relpath] = (entry.size, entry.mtime_ns)
+            if not self.done(entry.relpath):
+                yield entry
+
+    def add(self, name: str, record: Any, tracker: IssueTracker) -> None:
+        """Register a processed file and save if the file/time threshold was reached."""
+        self._pending.append((name, self._current.get(name, (0, 0)), record))
+        if (
+            len(self._pending) >= CHECKPOINT_EVERY_FILES
+            or time.monotonic() - self._last_save >= CHECKPOINT_EVERY_SECONDS
+        ):
+            self.save(tracker)
+
+    def end_reading(self, tracker: IssueTracker) -> None:
+        """Freeze the tracker state saved from now on.
+
+        Messages from writing the outputs (a failed workbook, audit warnings) are not replayed
+        on resume; the next run produces its own.
+        """
+        self._reading_state = _tracker_state(tracker)
+
+    def save(self, tracker: IssueTracker) -> None:
+        if not self._pending and os.path.exists(self.state_path):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pending:
+            part_name = f"parte_{len(self.parts) + 1:05d}.pkl"
+            part_path = os.path.join(self.directory, part_name)
+            with open(part_path + ".tmp", "wb") as handle:
+                pickle.dump(self._pending, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(part_path + ".tmp", part_path)
+            self.parts.append(part_name)
+            for name, signature, _ in self._pending:
+                self.processed[name] = signature
+            self._pending = []
+
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "job": self.job,
+            "fingerprint": self.fingerprint,
+            "processed": [[name, size, mtime_ns] for name, (size, mtime_ns) in self.processed.items()],
+            "parts": self.parts,
+            "tracker": self._reading_state or _tracker_state(tracker),
+        }
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as handle:
+            json.dump(state, handle, ensure_ascii=False)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        self._last_save = time.monotonic()
+
+    def records(self) -> Iterator[Any]:
+        """Records of the files discovered in this run, in processing order: spilled parts
+        first, then unsaved ones. Stale records (changed or removed files) are skipped."""
+        for part_name in self.parts:
+            with open(os.path.join(self.directory, part_name), "rb") as handle:
+                for name, signature, record in pickle.load(handle):
+                    if self._current.get(name) == signature:
+                        yield record
+        for _, _, record in self._pending:
+            yield record
+
+    def clear(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.processed = {}
+        self.parts = []
+        self._pending = []
+
+
+def open_checkpoint(workdir: str, job: str, tracker: IssueTracker) -> Checkpoint:
+    checkpoint = Checkpoint(workdir, job, fingerprint_workdir(workdir))
+    checkpoint.load(tracker)
+    return checkpoint
+
+
+def finish_checkpoint(checkpoint: Optional[Checkpoint], success: bool, tracker: IssueTracker) -> None:
+    """Remove the checkpoint after a successful run; otherwise persist what is pending."""
+    if checkpoint is None:
+        return
+    if success:
+        checkpoint.clear()
+    else:
+        checkpoint.save(tracker)
@@ -8,8 +8,11 @@ import os
 import sys
 import json
 import shutil
-import zipfile
-from xml_utils import IssueTracker, load_xml_root, find_first, print_progress
+from progress_utils import ProgressReporter, open_progress
+from report_utils import manifest_path, shard_path, write_manifest
+from watch_folder import split_watch_flag, vigilar
+from zip_utils import ZipWriter, comprimir_en_paralelo, directorio
+from xml_utils import IssueTracker, load_xml_root, find_first, print_progress, print_file_progress, iter_xml_files, prefetch_xml_files, env_int
 
 # Namespaces comunes
 NAMESPACES_CFDI_40 = {
@@ -22,27 +25,35 @@ NAMESPACES_CFDI_33 = {
     "tfd": "http://www.sat.gob.mx/TimbreFiscalDigital",
 }
 
+# Tamaño máximo de cada parte del ZIP de salida; 0 = un solo ZIP
+ZIP_MAX_BYTES = env_int("XML_ZIP_MAX_BYTES", 0)
+
 NAMESPACES_NOMINA = {
     "cfdi": "http://www.sat.gob.mx/cfd/3",
     "nomina12": "http://www.sat.gob.mx/nomina12",
 }
 
 
-def detect_xml_type(filepath: str, tracker: IssueTracker) -> str:
+def detect_xml_type(filepath: str, tracker: IssueTracker, contenido=None) -> str:
     """
     Detecta el tipo de XML: 'nomina', 'gasto', o 'vacio'
 
     Args:
         filepath: Ruta al archivo XML
         tracker: IssueTracker para registrar problemas
+        contenido: Bytes del archivo ya leídos (opcional)
 
     Returns:
         String con el tipo: 'nomina', 'gasto', 'vacio'
     """
-    root = load_xml_root(filepath, tracker)
+    root = load_xml_root(filepath, tracker, contenido)
     if root is None:
         return 'vacio'
+    return tipo_de_raiz(root, filepath, tracker)
+
 
+def tipo_de_raiz(root, filepath: str, tracker: IssueTracker) -> str:
+    """Tipo ('nomina', 'gasto', 'vacio') de un XML ya cargado; `filepath` solo se usa en el aviso."""
     # Detectar Nómina (buscar complemento Nomina12)
     nomina_elem = find_first(root, ".//nomina12:Nomina", NAMESPACES_NOMINA)
     if nomina_elem is not None:
@@ -69,26 +80,61 @@ def detect_xml_type(filepath: str, tracker: IssueTracker) -> str:
     return 'vacio'
 
 
-def clasificar_archivos(workdir: str, tracker: IssueTracker) -> dict:
+CARPETAS_TIPO = {'nomina': 'Nomina', 'gasto': 'Gasto', 'vacio': 'Vacios'}
+
+
+def clasificar_archivo(workdir: str, entrada, contenido, tracker: IssueTracker) -> str:
     """
-    Clasifica todos los archivos XML en el directorio
+    Detecta el tipo de un archivo y lo copia a su carpeta conservando la subcarpeta de origen
 
     Args:
-        workdir: Directorio con los XMLs a clasificar
+        workdir: Directorio de trabajo donde están Nomina/, Gasto/ y Vacios/
+        entrada: XmlEntry del archivo
+        contenido: Bytes del archivo ya leídos (opcional)
         tracker: IssueTracker para registrar problemas
 
     Returns:
-        Dict con estadísticas y path del ZIP
+        String con el tipo: 'nomina', 'gasto', 'vacio'
     """
-    # Crear subdirectorios
-    nomina_dir = os.path.join(workdir, 'Nomina')
-    gasto_dir = os.path.join(workdir, 'Gasto')
-    vacios_dir = os.path.join(workdir, 'Vacios')
+    filename = entrada.relpath
+
+    # Detectar tipo
+    xml_type = detect_xml_type(entrada.path, tracker, contenido)
+    dest = os.path.join(workdir, CARPETAS_TIPO[xml_type], filename)
+
+    try:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if isinstance(contenido, bytes):
+            # Ya está en memoria: se escribe sin volver a leer el origen
+            with open(dest, 'wb') as destino:
+                destino.write(contenido)
+            shutil.copystat(entrada.path, dest)
+        else:
+            shutil.copy2(entrada.path, dest)
+        print_file_progress(f"✓ {filename} → {xml_type.capitalize()}")
+    except Exception as e:
+        tracker.error(f"No se pudo copiar '{filename}': {e}")
+    return xml_type
+
+
+def crear_carpetas(workdir: str) -> None:
+    for carpeta in CARPETAS_TIPO.values():
+        os.makedirs(os.path.join(workdir, carpeta), exist_ok=True)
 
-    os.makedirs(nomina_dir, exist_ok=True)
-    os.makedirs(gasto_dir, exist_ok=True)
-    os.makedirs(vacios_dir, exist_ok=True)
 
+def resumir_clasificacion(workdir: str, tipos, tracker: IssueTracker, progreso: ProgressReporter) -> dict:
+    """
+    Cuenta los tipos clasificados y empaqueta las carpetas en el ZIP
+
+    Args:
+        workdir: Directorio de trabajo
+        tipos: Tipo de cada archivo clasificado, en orden de lote
+        tracker: IssueTracker para registrar problemas
+        progreso: Canal de progreso NDJSON
+
+    Returns:
+        Dict con estadísticas y path del ZIP (solo estadísticas si no hubo archivos o falló el ZIP)
+    """
     # Contadores
     stats = {
         'nomina': 0,
@@ -96,100 +142,193 @@ def clasificar_archivos(workdir: str, tracker: IssueTracker) -> dict:
         'vacios': 0,
         'total': 0
     }
+    for xml_type in tipos:
+        stats['total'] += 1
+        stats['vacios' if xml_type == 'vacio' else xml_type] += 1
 
-    # Obtener lista de archivos XML
-    xml_files = [f for f in os.listdir(workdir) if f.lower().endswith('.xml')]
-
-    if not xml_files:
+    if not stats['total']:
         tracker.error("No se encontraron archivos XML en el directorio")
         return stats
 
-    print_progress(f"Clasificando {len(xml_files)} archivo(s) XML...")
-
-    # Clasificar cada archivo
-    for filename in xml_files:
-        filepath = os.path.join(workdir, filename)
-
-        # Detectar tipo
-        xml_type = detect_xml_type(filepath, tracker)
-        stats['total'] += 1
-
-        # Mover a carpeta correspondiente
-        if xml_type == 'nomina':
-            dest = os.path.join(nomina_dir, filename)
-            stats['nomina'] += 1
-        elif xml_type == 'gasto':
-            dest = os.path.join(gasto_dir, filename)
-            stats['gasto'] += 1
-        else:  # vacio
-            dest = os.path.join(vacios_dir, filename)
-            stats['vacios'] += 1
-
-        try:
-            shutil.copy2(filepath, dest)
-            print_progress(f"✓ {filename} → {xml_type.capitalize()}")
-        except Exception as e:
-            tracker.error(f"No se pudo copiar '{filename}': {e}")
-
     print_progress(f"\nClasificación completada:")
     print_progress(f"  - Nómina: {stats['nomina']}")
     print_progress(f"  - Gasto: {stats['gasto']}")
     print_progress(f"  - Vacíos/No reconocidos: {stats['vacios']}")
+    stats['lectura'] = tracker.read_stats()
 
     # Crear archivo ZIP
     zip_filename = f"XML_Clasificados.zip"
     zip_path = os.path.join(workdir, zip_filename)
 
     print_progress(f"\nCreando archivo ZIP...")
+    progreso.stage('zip')
 
     try:
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Agregar archivos de cada carpeta al ZIP
-            for folder_name in ['Nomina', 'Gasto', 'Vacios']:
-                folder_path = os.path.join(workdir, folder_name)
-                files_in_folder = os.listdir(folder_path)
-
-                if not files_in_folder:
-                    # Crear carpeta vacía en el ZIP
-                    zipf.writestr(f"{folder_name}/", '')
-                else:
-                    for filename in files_in_folder:
-                        file_path = os.path.join(folder_path, filename)
-                        arcname = os.path.join(folder_name, filename)
-                        zipf.write(file_path, arcname)
-
-        print_progress(f"✓ ZIP creado: {zip_filename}")
+        zip_paths = crear_zip(workdir, zip_path)
+        if len(zip_paths) > 1:
+            print_progress(f"✓ ZIP creado en {len(zip_paths)} partes: {manifest_path(zip_path)}")
+        else:
+            print_progress(f"✓ ZIP creado: {zip_filename}")
 
     except Exception as e:
         tracker.fatal(f"Error al crear ZIP: {e}")
         return stats
 
-    return {'stats': stats, 'zip_path': zip_path}
+    return {'stats': stats, 'zip_path': zip_path, 'partes': zip_paths}
+
+
+def clasificar_archivos(workdir: str, tracker: IssueTracker, progreso: ProgressReporter = None) -> dict:
+    """
+    Clasifica todos los archivos XML en el directorio
+
+    Args:
+        workdir: Directorio con los XMLs a clasificar
+        tracker: IssueTracker para registrar problemas
+        progreso: Canal de progreso NDJSON (opcional)
+
+    Returns:
+        Dict con estadísticas y path del ZIP
+    """
+    # Crear subdirectorios
+    crear_carpetas(workdir)
+
+    print_progress("Clasificando archivos XML...")
+    progreso = progreso or ProgressReporter('clasificador_xml', None)
+    progreso.count_in_background(workdir)
+    progreso.stage('clasificacion')
+
+    # Clasificar cada archivo conforme se descubre (incluye subcarpetas)
+    tipos = []
+    for entrada, contenido in prefetch_xml_files(progreso.discover(iter_xml_files(workdir, order="name"))):
+        tipos.append(clasificar_archivo(workdir, entrada, contenido, tracker))
+        progreso.advance(1, entrada.size)
+
+    return resumir_clasificacion(workdir, tipos, tracker, progreso)
+
+
+def crear_zip(workdir: str, zip_path: str) -> list:
+    """
+    Empaqueta Nomina/, Gasto/ y Vacios/ en el ZIP, dividiéndolo en partes numeradas
+    (XML_Clasificados_2.zip, ...) cuando una parte llegaría a ZIP_MAX_BYTES.
+
+    Los archivos se comprimen en paralelo (zip_utils) y se escriben en orden de carpeta y
+    ruta, así que el ZIP sale igual con cualquier número de hilos.
+
+    Args:
+        workdir: Directorio con las carpetas clasificadas
+        zip_path: Ruta de la primera parte
+
+    Returns:
+        Lista de rutas de las partes; el manifiesto JSON describe su contenido
+    """
+    _borrar_partes_anteriores(zip_path)
+    partes = []
+    zip_paths = []
+    zipf = None
+
+    def nueva_parte():
+        nonlocal zipf
+        if zipf is not None:
+            zipf.close()
+        ruta = shard_path(zip_path, len(zip_paths) + 1)
+        zip_paths.append(ruta)
+        partes.append({'archivo': os.path.basename(ruta), 'entradas': 0, 'carpetas': []})
+        zipf = ZipWriter(ruta)
+
+    carpetas = [
+        (folder_name, list(iter_xml_files(os.path.join(workdir, folder_name), order="name")))
+        for folder_name in ['Nomina', 'Gasto', 'Vacios']
+    ]
+    miembros = comprimir_en_paralelo(
+        (entrada.path, os.path.join(folder_name, entrada.relpath), entrada.size)
+        for folder_name, entradas in carpetas
+        for entrada in entradas
+    )
+
+    nueva_parte()
+    try:
+        # Agregar archivos de cada carpeta al ZIP
+        for folder_name, entradas in carpetas:
+            if not entradas:
+                # Crear carpeta vacía en el ZIP
+                zipf.add(directorio(folder_name))
+                partes[-1]['carpetas'].append(folder_name)
+                continue
+
+            for _ in entradas:
+                miembro = next(miembros)
+                # Ya comprimido: se sabe exactamente cuánto crecería la parte
+                if ZIP_MAX_BYTES and partes[-1]['entradas'] and zipf.tamano_con(miembro) > ZIP_MAX_BYTES:
+                    nueva_parte()
+                zipf.add(miembro)
+                partes[-1]['entradas'] += 1
+                if folder_name not in partes[-1]['carpetas']:
+                    partes[-1]['carpetas'].append(folder_name)
+    finally:
+        miembros.close()
+        zipf.close()
+
+    for parte, ruta in zip(partes, zip_paths):
+        parte['bytes'] = os.path.getsize(ruta)
+    write_manifest(manifest_path(zip_path), {
+        'archivo': os.path.basename(zip_path),
+        'limite_bytes': ZIP_MAX_BYTES,
+        'partes': partes,
+    })
+    return zip_paths
+
+
+def _borrar_partes_anteriores(zip_path: str) -> None:
+    """Quita las partes _2, _3, ... que dejó una corrida anterior con más partes."""
+    try:
+        with open(manifest_path(zip_path), 'r', encoding='utf-8') as handle:
+            anteriores = json.load(handle).get('partes', [])
+    except (OSError, ValueError):
+        return
+    for parte in anteriores[1:]:
+        try:
+            os.remove(os.path.join(os.path.dirname(zip_path), os.path.basename(parte.get('archivo', ''))))
+        except OSError:
+            pass
 
 
 def main():
-    if len(sys.argv) < 2:
+    # preview_utils usa detect_xml_type de este módulo; se importa aquí para evitar el ciclo.
+    from preview_utils import run_preview, split_preview_flag
+
+    argumentos, preview = split_preview_flag(sys.argv[1:])
+    argumentos, vigilar_carpeta = split_watch_flag(argumentos)
+    if not argumentos:
         print("ERROR: Falta el directorio de trabajo", file=sys.stderr)
         sys.exit(2)
 
-    workdir = sys.argv[1]
+    workdir = argumentos[0]
 
     if not os.path.isdir(workdir):
         print(f"ERROR: '{workdir}' no es un directorio válido", file=sys.stderr)
         sys.exit(2)
 
+    if preview:
+        sys.exit(run_preview(workdir, "clasificador_xml"))
+    if vigilar_carpeta:
+        sys.exit(vigilar(workdir, "clasificador_xml"))
+
     tracker = IssueTracker()
+    progreso = open_progress(workdir, 'clasificador_xml')
+    codigo_salida = 2
 
     try:
-        result = clasificar_archivos(workdir, tracker)
+        result = clasificar_archivos(workdir, tracker, progreso)
 
         # Reportar problemas
         tracker.report()
+        codigo_salida = tracker.exit_code
 
         # Output JSON con path y stats
         if 'zip_path' in result:
             output = {
                 'path': result['zip_path'],
+                'partes': result['partes'],
                 'stats': result['stats']
             }
             print(json.dumps(output))
@@ -200,10 +339,13 @@ def main():
         sys.exit(tracker.exit_code)
 
     except Exception as e:
+        codigo_salida = 2
         print(f"FATAL: Error inesperado: {e}", file=sys.stderr)
         import traceback
         traceback.print_exc(file=sys.stderr)
         sys.exit(2)
+    finally:
+        progreso.finish(codigo_salida)
 
 
 if __name__ == "__main__":
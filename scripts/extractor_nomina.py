@@ -1,20 +1,53 @@
 import os
 import sys
-import openpyxl
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from operator import itemgetter
 from openpyxl.styles import PatternFill, Font
-from typing import Dict, List, Optional, Set, Tuple
-
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from audit_utils import (
+    HOJA_EXCEPCIONES,
+    REGLA_FECHA_FUERA_PERIODO,
+    REGLA_PAGO_DUPLICADO,
+    REGLA_PERIODO_INVERTIDO,
+    REGLA_PERIODO_OTRO_LOTE,
+    REGLA_UUID_DUPLICADO,
+    REGLA_UUID_OTRO_LOTE,
+    diferencias_de_total,
+    excepciones_de_indice,
+    fechas_fuera_de_periodo,
+    ordenar_por_regla,
+    periodos_traslapados,
+    reportar_excepciones,
+    unir_excepciones,
+    uuids_duplicados,
+)
+from cfdi_store import lote_de, open_store
+from checkpoint_utils import finish_checkpoint, open_checkpoint
+from indice_lotes import IndiceLotes, open_indice
+from preview_utils import run_preview, split_preview_flag
+from progress_utils import ProgressReporter, open_progress
+from report_utils import ShardedWorkbook, manifest_path
+from schema_utils import Campo, Esquema
+from spill_utils import CorridasOrdenadas, en_bloques, memoria_acotada, por_grupos, rss_bytes
 from xml_utils import (
+    EXACT_AMOUNTS,
     IssueTracker,
+    XmlBuffer,
     find_all,
     find_all_local,
     find_first,
     find_first_local,
     get_attr,
+    iter_xml_files,
     load_xml_root,
+    prefetch_xml_files,
+    print_file_progress,
     print_progress,
     summarize_namespaces,
-    to_float,
+    to_numeric_column,
 )
 
 # Colores para celdas
@@ -46,262 +79,827 @@ def _nomina_elements(root, tag_name: str) -> List[object]:
     return elems
 
 
-def procesar_nomina_xml(directorio: str, tracker: IssueTracker) -> Optional[str]:
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Perc_Deduc_Sub"
-    ws.append(
-        [
-            "Archivo",
-            "Tipo",
-            "TipoPercepcion/Deduccion/Subsidio",
-            "Clave",
-            "Concepto",
-            "ImporteGravado",
-            "ImporteExento",
-            "ImporteTotal",
+# Fila cruda de Perc_Deduc_Sub: (archivo, tipo, tipo SAT, clave, concepto, gravado, exento, importe)
+FilaDetalle = Tuple[str, str, str, str, str, Optional[str], Optional[str], Optional[str]]
+
+PREFIJO_TIPO: Dict[str, str] = {"Percepción": "P", "Deducción": "D", "Subsidio": "S"}
+RELLENO_TIPO = {"Percepción": green_fill, "Deducción": red_fill, "Subsidio": blue_fill}
+# Estilo de la columna Tipo (índice 1) en Perc_Deduc_Sub.
+RELLENO_FILA = {tipo: {1: {"fill": relleno}} for tipo, relleno in RELLENO_TIPO.items()}
+ESTILO_ENCABEZADO_NOMINA = {"fill": header_fill, "font": Font(bold=True)}
+
+
+# Columnas 2 a 7 de FilaDetalle por tipo de nodo; el archivo y el tipo las pone _leer_detalle.
+_DETALLE_TEXTO = [Campo("Clave", "nodo", "Clave", ""), Campo("Concepto", "nodo", "Concepto", "")]
+ESQUEMAS_DETALLE: Dict[str, Esquema] = {
+    "Percepción": Esquema(
+        [Campo("Tipo", "nodo", "TipoPercepcion", "")]
+        + _DETALLE_TEXTO
+        + [
+            Campo("ImporteGravado", "nodo", "ImporteGravado", tipo="monto"),
+            Campo("ImporteExento", "nodo", "ImporteExento", tipo="monto"),
+            Campo("Importe", None, tipo="monto"),
         ]
-    )
+    ),
+    "Deducción": Esquema(
+        [Campo("Tipo", "nodo", "TipoDeduccion", "")]
+        + _DETALLE_TEXTO
+        + [
+            Campo("ImporteGravado", None, tipo="monto"),
+            Campo("ImporteExento", None, tipo="monto"),
+            Campo("Importe", "nodo", "Importe", tipo="monto"),
+        ]
+    ),
+    "Subsidio": Esquema(
+        [Campo("Tipo", "nodo", "TipoOtroPago", "")]
+        + _DETALLE_TEXTO
+        + [
+            Campo("ImporteGravado", None, tipo="monto"),
+            Campo("ImporteExento", None, tipo="monto"),
+            Campo("Importe", "nodo", "Importe", tipo="monto"),
+        ]
+    ),
+}
+
+# Encabezado de cada recibo; los ámbitos son los elementos que resuelve _leer_encabezado.
+ESQUEMA_ENCABEZADO = Esquema(
+    [
+        Campo("uuid", "tfd", "UUID", ""),
+        Campo("num_empleado", "receptor_nomina", "NumEmpleado", ""),
+        Campo("nombre", "receptor_cfdi", "Nombre", ""),
+        Campo("rfc", "receptor_cfdi", "Rfc", ""),
+        Campo("curp", "receptor_nomina", "Curp", ""),
+        Campo("puesto", "receptor_nomina", "Puesto", ""),
+        Campo("departamento", "receptor_nomina", "Departamento", ""),
+        Campo("tipo_nomina", "nomina", "TipoNomina", ""),
+        Campo("fecha_comprobante", "comprobante", "Fecha", ""),
+        Campo("num_dias_pagados", "nomina", "NumDiasPagados", ""),
+        Campo("fecha_inicial_pago", "nomina", "FechaInicialPago", ""),
+        Campo("fecha_final_pago", "nomina", "FechaFinalPago", ""),
+        Campo("fecha_pago", "nomina", "FechaPago", ""),
+        Campo("total_percepciones", "nomina", "TotalPercepciones", tipo="monto"),
+        Campo("total_deducciones", "nomina", "TotalDeducciones", tipo="monto"),
+    ]
+)
 
-    percepciones_catalogo: Set[Tuple[str, str]] = set()
-    deducciones_catalogo: Set[Tuple[str, str]] = set()
-    subsidios_catalogo: Set[Tuple[str, str]] = set()
 
-    xml_files = sorted(file for file in os.listdir(directorio) if file.lower().endswith(".xml"))
-    if not xml_files:
-        tracker.fatal(f"No se encontraron archivos XML en {directorio}")
+def _leer_detalle(root, filename: str, tracker: IssueTracker, detalle: List[FilaDetalle]) -> None:
+    """Agrega a `detalle` las percepciones, deducciones y subsidios del XML con importes crudos."""
+    percepciones = _nomina_elements(root, "Percepcion")
+    deducciones = _nomina_elements(root, "Deduccion")
+    otros_pagos = _nomina_elements(root, "OtroPago")
+
+    if not (percepciones or deducciones or otros_pagos):
+        tracker.warn(f"{filename}: No se detectaron nodos de nómina. Namespaces encontrados: {summarize_namespaces(root)}")
+
+    # Solo los otros pagos de tipo 002 (subsidio para el empleo) van al detalle.
+    subsidios = [otro_pago for otro_pago in otros_pagos if get_attr(otro_pago, "TipoOtroPago") == "002"]
+    for tipo, nodos in (("Percepción", percepciones), ("Deducción", deducciones), ("Subsidio", subsidios)):
+        esquema = ESQUEMAS_DETALLE[tipo]
+        for nodo in nodos:
+            fila = esquema.nueva_fila()
+            esquema.llenar("nodo", nodo, fila)
+            detalle.append((filename, tipo, *fila))
+
+
+def _leer_encabezado(root, filename: str, tracker: IssueTracker) -> Optional[Dict[str, Optional[str]]]:
+    """Datos del receptor y del complemento de nómina; None si la estructura está incompleta."""
+    receptor_cfdi = find_first(root, ".//cfdi:Receptor", NAMESPACES)
+    if receptor_cfdi is None:
+        receptor_cfdi = find_first(root, ".//cfdi3:Receptor", NAMESPACES)
+    if receptor_cfdi is None:
+        receptor_cfdi = _first_by_local_attr(
+            root, "Receptor", ("UsoCFDI", "RegimenFiscalReceptor", "DomicilioFiscalReceptor")
+        )
+
+    receptor_nomina = find_first(root, ".//nomina12:Receptor", NAMESPACES)
+    if receptor_nomina is None:
+        receptor_nomina = _first_by_local_attr(root, "Receptor", ("NumEmpleado", "Curp"))
+
+    nomina = find_first(root, ".//nomina12:Nomina", NAMESPACES)
+    if nomina is None:
+        nomina = find_first_local(root, "Nomina")
+
+    if receptor_cfdi is None or receptor_nomina is None or nomina is None:
+        tracker.warn(
+            f"Estructura de nómina incompleta en {filename}. "
+            f"Receptor CFDI: {'OK' if receptor_cfdi is not None else 'No'}; "
+            f"Receptor Nómina: {'OK' if receptor_nomina is not None else 'No'}; "
+            f"Nomina: {'OK' if nomina is not None else 'No'}."
+        )
         return None
 
-    archivos_con_error: List[Tuple[str, str]] = []
+    tfd = find_first(root, ".//tfd:TimbreFiscalDigital", NAMESPACES)
+    if tfd is None:
+        tfd = find_first_local(root, "TimbreFiscalDigital")
+
+    elementos = {
+        "tfd": tfd,
+        "receptor_nomina": receptor_nomina,
+        "receptor_cfdi": receptor_cfdi,
+        "nomina": nomina,
+        "comprobante": root,
+    }
+    encabezado: Dict[str, Optional[str]] = {"archivo": filename}
+    encabezado.update(ESQUEMA_ENCABEZADO.como_dict(ESQUEMA_ENCABEZADO.extraer(elementos)))
+    return encabezado
+
+
+def _convertir_detalle(detalle: List[FilaDetalle], tracker: IssueTracker) -> Tuple[List[Any], List[Any], List[Any]]:
+    """Convierte los importes de todo el lote por columna y devuelve el ImporteTotal de cada fila."""
+    gravados = to_numeric_column((fila[5] for fila in detalle), "ImporteGravado", tracker, exact=EXACT_AMOUNTS)
+    exentos = to_numeric_column((fila[6] for fila in detalle), "ImporteExento", tracker, exact=EXACT_AMOUNTS)
+    importes = to_numeric_column((fila[7] for fila in detalle), "Importe", tracker, exact=EXACT_AMOUNTS)
+    totales: List[Any] = []
+    for fila, gravado, exento, importe in zip(detalle, gravados, exentos, importes):
+        totales.append(gravado + exento if fila[1] == "Percepción" else importe)
+    return gravados, exentos, totales
+
+
+REGLA_TOTAL_PERCEPCIONES = "TotalPercepciones distinto de la suma de nodos"
+REGLA_TOTAL_DEDUCCIONES = "TotalDeducciones distinto de la suma de nodos"
+# Orden en que _auditar_recibos produce las reglas.
+REGLAS_RECIBO: List[str] = [
+    REGLA_TOTAL_PERCEPCIONES,
+    REGLA_TOTAL_DEDUCCIONES,
+    REGLA_UUID_DUPLICADO,
+    REGLA_PERIODO_INVERTIDO,
+    REGLA_FECHA_FUERA_PERIODO,
+    REGLA_PAGO_DUPLICADO,
+    REGLA_UUID_OTRO_LOTE,
+    REGLA_PERIODO_OTRO_LOTE,
+]
+
+
+def _auditar_recibos(
+    recibos: List[Tuple[Dict[str, Optional[str]], int, int]],
+    detalle: List[FilaDetalle],
+    totales: List[Any],
+    totales_percepciones: List[Any],
+    totales_deducciones: List[Any],
+) -> pd.DataFrame:
+    """Excepciones del lote: totales declarados contra la suma de sus nodos, UUID repetidos y fechas de pago."""
+    encabezados = pd.DataFrame([encabezado for encabezado, _, _ in recibos])
+    if encabezados.empty:
+        return unir_excepciones([])
+    archivos = encabezados["archivo"] if "archivo" in encabezados else pd.Series([""] * len(encabezados))
+
+    # Cada fila de detalle pertenece al último recibo que empieza antes de ella, si cae dentro de su rango.
+    inicios = np.fromiter((inicio for _, inicio, _ in recibos), dtype=np.int64, count=len(recibos))
+    fines = np.fromiter((fin for _, _, fin in recibos), dtype=np.int64, count=len(recibos))
+    posiciones = np.arange(len(detalle))
+    recibo = np.searchsorted(inicios, posiciones, side="right") - 1
+    dentro = (recibo >= 0) & (posiciones < fines[recibo.clip(min=0)])
+    filas = pd.DataFrame(
+        {
+            "recibo": recibo[dentro],
+            "tipo": np.array([fila[1] for fila in detalle], dtype=object)[dentro],
+            "total": np.array(totales, dtype=object if EXACT_AMOUNTS else float)[dentro],
+        }
+    )
+    agrupado = filas.groupby(["recibo", "tipo"])["total"]
+    sumas = agrupado.sum().unstack(fill_value=0).reindex(range(len(recibos)), fill_value=0)
+    conteos = agrupado.size().unstack(fill_value=0).reindex(range(len(recibos)), fill_value=0)
+
+    partes = []
+    for tipo, regla, declarados in (
+        ("Percepción", REGLA_TOTAL_PERCEPCIONES, totales_percepciones),
+        ("Deducción", REGLA_TOTAL_DEDUCCIONES, totales_deducciones),
+    ):
+        calculado = sumas[tipo] if tipo in sumas else pd.Series(0, index=sumas.index)
+        partidas = conteos[tipo] if tipo in conteos else pd.Series(0, index=conteos.index)
+        partes.append(
+            diferencias_de_total(
+                regla,
+                encabezados["uuid"],
+                archivos,
+                pd.Series(declarados, dtype=object if EXACT_AMOUNTS else float),
+                calculado,
+                partidas,
+            )
+        )
+    partes.append(uuids_duplicados(encabezados["uuid"], archivos))
+    partes.append(
+        fechas_fuera_de_periodo(
+            encabezados["uuid"],
+            archivos,
+            encabezados["fecha_pago"],
+            encabezados["fecha_inicial_pago"],
+            encabezados["fecha_final_pago"],
+            "Fecha de pago",
+        )
+    )
+    return unir_excepciones(partes)
 
-    for filename in xml_files:
-        ruta_archivo = os.path.join(directorio, filename)
-        print_progress(f"Procesando nómina: {filename}")
-        root = load_xml_root(ruta_archivo, tracker)
-        if root is None:
-            continue
 
-        try:
-            percepciones = _nomina_elements(root, "Percepcion")
-            deducciones = _nomina_elements(root, "Deduccion")
-            otros_pagos = _nomina_elements(root, "OtroPago")
+Recibo = Tuple[List[FilaDetalle], Optional[Dict[str, Optional[str]]], Optional[Tuple[str, str]]]
 
-            if not (percepciones or deducciones or otros_pagos):
-                tracker.warn(
-                    f"{filename}: No se detectaron nodos de nómina. Namespaces encontrados: {summarize_namespaces(root)}"
-                )
 
-            for percepcion in percepciones:
-                tipo_percepcion = get_attr(percepcion, "TipoPercepcion") or ""
-                clave = get_attr(percepcion, "Clave") or ""
-                concepto = get_attr(percepcion, "Concepto") or ""
-                importe_gravado = to_float(get_attr(percepcion, "ImporteGravado"), 0.0, tracker, "ImporteGravado")
-                importe_exento = to_float(get_attr(percepcion, "ImporteExento"), 0.0, tracker, "ImporteExento")
-                importe_total = importe_gravado + importe_exento
-                ws.append(
-                    [
-                        filename,
-                        "Percepción",
-                        tipo_percepcion,
-                        clave,
-                        concepto,
-                        importe_gravado,
-                        importe_exento,
-                        importe_total,
-                    ]
-                )
-                ws.cell(row=ws.max_row, column=2).fill = green_fill
-                if clave and concepto:
-                    percepciones_catalogo.add((clave, concepto))
-
-            for deduccion in deducciones:
-                tipo_deduccion = get_attr(deduccion, "TipoDeduccion") or ""
-                clave = get_attr(deduccion, "Clave") or ""
-                concepto = get_attr(deduccion, "Concepto") or ""
-                importe = to_float(get_attr(deduccion, "Importe"), 0.0, tracker, "Importe Deducción")
-                ws.append([filename, "Deducción", tipo_deduccion, clave, concepto, "", "", importe])
-                ws.cell(row=ws.max_row, column=2).fill = red_fill
-                if clave and concepto:
-                    deducciones_catalogo.add((clave, concepto))
-
-            for otro_pago in otros_pagos:
-                tipo_otro_pago = get_attr(otro_pago, "TipoOtroPago") or ""
-                if tipo_otro_pago == "002":
-                    clave = get_attr(otro_pago, "Clave") or ""
-                    concepto = get_attr(otro_pago, "Concepto") or ""
-                    importe = to_float(get_attr(otro_pago, "Importe"), 0.0, tracker, "Importe Subsidio")
-                    ws.append([filename, "Subsidio", tipo_otro_pago, clave, concepto, "", "", importe])
-                    ws.cell(row=ws.max_row, column=2).fill = blue_fill
-                    if clave and concepto:
-                        subsidios_catalogo.add((clave, concepto))
-
-        except Exception as exc:
-            archivos_con_error.append((filename, str(exc)))
-            tracker.error(f"Error procesando {filename}: {exc}")
-
-    catalog_ws = wb.create_sheet("Catalogo")
-    catalog_ws.append(["Código", "Clave", "Concepto"])
-    for clave, concepto in sorted(percepciones_catalogo):
-        catalog_ws.append([f"P-{clave[:20]}", clave[:20], concepto[:50]])
-    catalog_ws.append([])
-    for clave, concepto in sorted(deducciones_catalogo):
-        catalog_ws.append([f"D-{clave[:20]}", clave[:20], concepto[:50]])
-    catalog_ws.append([])
-    for clave, concepto in sorted(subsidios_catalogo):
-        catalog_ws.append([f"S-{clave[:20]}", clave[:20], concepto[:50]])
-
-    nomina_ws = wb.create_sheet("Nomina")
-    nomina_headers = [
-        "UUID",
-        "Consecutivo",
-        "Núm Empleado",
-        "Nombre",
-        "RFC",
-        "CURP",
-        "Puesto",
-        "Departamento",
-        "Tipo de Nomina",
-        "Fecha Comprobante",
-        "Num Días Pagados",
-        "Fecha Inicial Pago",
-        "Fecha Final Pago",
-        "Fecha Pago",
-        "Total Percepciones",
-        "Total Deducciones",
-        "Total Subsidios",
-        "Total Neto",
-    ]
-    conceptos_headers: List[str] = []
-    for clave, concepto in sorted(percepciones_catalogo):
-        conceptos_headers.append(f"P-{clave[:15]}-{concepto[:20]}")
-    for clave, concepto in sorted(deducciones_catalogo):
-        conceptos_headers.append(f"D-{clave[:15]}-{concepto[:20]}")
-    for clave, concepto in sorted(subsidios_catalogo):
-        conceptos_headers.append(f"S-{clave[:15]}-{concepto[:20]}")
-
-    nomina_ws.append(nomina_headers + conceptos_headers)
-    for cell in nomina_ws[1]:
-        cell.fill = header_fill
-        cell.font = Font(bold=True)
-
-    consecutivo = 1
-    for filename in xml_files:
-        ruta_archivo = os.path.join(directorio, filename)
-        root = load_xml_root(ruta_archivo, tracker)
-        if root is None:
+def _procesar_recibo(
+    ruta_archivo: str, filename: str, tracker: IssueTracker, contenido: Optional[XmlBuffer] = None
+) -> Recibo:
+    """Lee un XML de nómina: (filas de detalle, encabezado o None, error o None)."""
+    print_file_progress(f"Procesando nómina: {filename}")
+    root = load_xml_root(ruta_archivo, tracker, contenido)
+    if root is None:
+        return [], None, None
+
+    filas: List[FilaDetalle] = []
+    try:
+        _leer_detalle(root, filename, tracker, filas)
+        encabezado = _leer_encabezado(root, filename, tracker)
+    except Exception as exc:
+        tracker.error(f"Error procesando {filename}: {exc}")
+        return [], None, (filename, str(exc))
+    return filas, encabezado, None
+
+
+ENCABEZADOS_DETALLE: List[str] = [
+    "Archivo",
+    "Tipo",
+    "TipoPercepcion/Deduccion/Subsidio",
+    "Clave",
+    "Concepto",
+    "ImporteGravado",
+    "ImporteExento",
+    "ImporteTotal",
+]
+
+ENCABEZADOS_NOMINA: List[str] = [
+    "UUID",
+    "Consecutivo",
+    "Núm Empleado",
+    "Nombre",
+    "RFC",
+    "CURP",
+    "Puesto",
+    "Departamento",
+    "Tipo de Nomina",
+    "Fecha Comprobante",
+    "Num Días Pagados",
+    "Fecha Inicial Pago",
+    "Fecha Final Pago",
+    "Fecha Pago",
+    "Total Percepciones",
+    "Total Deducciones",
+    "Total Subsidios",
+    "Total Neto",
+]
+
+# Claves (clave, concepto) vistas por tipo; define las columnas de conceptos de la hoja Nomina.
+CatalogoConceptos = Dict[str, Set[Tuple[str, str]]]
+
+
+def _reunir_recibos(
+    registros: Iterable[Recibo], archivos_con_error: List[Tuple[str, str]]
+) -> Tuple[List[FilaDetalle], List[Tuple[Dict[str, Optional[str]], int, int]]]:
+    """Filas de detalle y, por recibo válido, su encabezado y el rango de sus filas dentro del detalle."""
+    detalle: List[FilaDetalle] = []
+    recibos: List[Tuple[Dict[str, Optional[str]], int, int]] = []
+    for filas, encabezado, error in registros:
+        if error is not None:
+            archivos_con_error.append(error)
             continue
+        inicio = len(detalle)
+        detalle.extend(filas)
+        if encabezado is not None:
+            recibos.append((encabezado, inicio, len(detalle)))
+    return detalle, recibos
+
+
+def _convertir_totales(
+    recibos: List[Tuple[Dict[str, Optional[str]], int, int]], tracker: IssueTracker
+) -> Tuple[List[Any], List[Any]]:
+    totales_percepciones = to_numeric_column(
+        (encabezado["total_percepciones"] for encabezado, _, _ in recibos), "TotalPercepciones", tracker, exact=EXACT_AMOUNTS
+    )
+    totales_deducciones = to_numeric_column(
+        (encabezado["total_deducciones"] for encabezado, _, _ in recibos), "TotalDeducciones", tracker, exact=EXACT_AMOUNTS
+    )
+    return totales_percepciones, totales_deducciones
+
+
+def _escribir_detalle(
+    ws, detalle: List[FilaDetalle], gravados: List[Any], exentos: List[Any], totales: List[Any], catalogo: CatalogoConceptos
+) -> None:
+    for fila, gravado, exento, total in zip(detalle, gravados, exentos, totales):
+        filename, tipo, tipo_sat, clave, concepto = fila[:5]
+        if tipo == "Percepción":
+            ws.append([filename, tipo, tipo_sat, clave, concepto, gravado, exento, total], RELLENO_FILA[tipo])
+        else:
+            ws.append([filename, tipo, tipo_sat, clave, concepto, "", "", total], RELLENO_FILA[tipo])
+        if clave and concepto:
+            catalogo[tipo].add((clave, concepto))
+
+
+def _escribir_catalogo(libro: ShardedWorkbook, catalogo: CatalogoConceptos) -> List[str]:
+    """Escribe la hoja Catalogo y devuelve los encabezados de las columnas de conceptos de Nomina."""
+    catalog_ws = libro.add_sheet("Catalogo", ["Código", "Clave", "Concepto"], header_style={})
+    for tipo in ("Percepción", "Deducción", "Subsidio"):
+        if tipo != "Percepción":
+            catalog_ws.append([])
+        for clave, concepto in sorted(catalogo[tipo]):
+            catalog_ws.append([f"{PREFIJO_TIPO[tipo]}-{clave[:20]}", clave[:20], concepto[:50]])
+    catalog_ws.close()
+
+    conceptos_headers: List[str] = []
+    for tipo in ("Percepción", "Deducción", "Subsidio"):
+        for clave, concepto in sorted(catalogo[tipo]):
+            conceptos_headers.append(f"{PREFIJO_TIPO[tipo]}-{clave[:15]}-{concepto[:20]}")
+    return conceptos_headers
+
+
+def _fila_nomina(
+    consecutivo: int,
+    encabezado: Dict[str, Optional[str]],
+    filas: List[FilaDetalle],
+    totales: List[Any],
+    total_percepciones: Any,
+    total_deducciones: Any,
+    conceptos_headers: List[str],
+) -> Tuple[List[Any], Any, Any]:
+    """Fila de la hoja Nomina de un recibo, con su total de subsidios y su neto."""
+    total_subsidios: Any = Decimal(0) if EXACT_AMOUNTS else 0.0
+    conceptos_valores: Dict[str, Any] = {header: "" for header in conceptos_headers}
+    for fila, total in zip(filas, totales):
+        tipo, clave, concepto_texto = fila[1], fila[3], fila[4]
+        if tipo == "Subsidio":
+            total_subsidios += total
+        header_key = f"{PREFIJO_TIPO[tipo]}-{clave[:15]}-{concepto_texto[:20]}"
+        if header_key in conceptos_valores and conceptos_valores[header_key] in ("", None):
+            conceptos_valores[header_key] = total
+    total_neto = total_percepciones - total_deducciones + total_subsidios
+
+    fila_nomina = [
+        encabezado["uuid"],
+        consecutivo,
+        encabezado["num_empleado"],
+        encabezado["nombre"],
+        encabezado["rfc"],
+        encabezado["curp"],
+        encabezado["puesto"],
+        encabezado["departamento"],
+        encabezado["tipo_nomina"],
+        encabezado["fecha_comprobante"],
+        encabezado["num_dias_pagados"],
+        encabezado["fecha_inicial_pago"],
+        encabezado["fecha_final_pago"],
+        encabezado["fecha_pago"],
+        total_percepciones,
+        total_deducciones,
+        total_subsidios,
+        total_neto,
+    ] + [conceptos_valores[header] for header in conceptos_headers]
+    return fila_nomina, total_subsidios, total_neto
+
+
+ENCABEZADOS_RESUMEN: List[str] = [
+    "Núm Empleado",
+    "RFC",
+    "CURP",
+    "Nombre",
+    "Recibos",
+    "Periodos",
+    "Primer Periodo",
+    "Último Periodo",
+    "Num Días Pagados",
+    "Total Percepciones",
+    "Total Deducciones",
+    "Total Subsidios",
+    "Total Neto",
+]
+
+# Solo los recibos ordinarios entran al índice de periodos: una nómina extraordinaria
+# (aguinaldo, finiquito) cae dentro de una quincena sin ser un pago repetido.
+TIPOS_NOMINA_PERIODICA = ("O", "")
+
+
+def _dias(valor: Optional[str]) -> float:
+    try:
+        return float(valor) if valor else 0.0
+    except ValueError:
+        return 0.0
+
+
+class _AcumuladoEmpleado:
+    __slots__ = ("nombre", "recibos", "periodos", "primero", "ultimo", "dias", "montos", "conceptos")
+
+    def __init__(self, nombre: str) -> None:
+        cero: Any = Decimal(0) if EXACT_AMOUNTS else 0.0
+        self.nombre = nombre
+        self.recibos = 0
+        self.periodos: Set[Tuple[str, str]] = set()
+        self.primero = ""
+        self.ultimo = ""
+        self.dias = 0.0
+        self.montos = [cero, cero, cero, cero]
+        self.conceptos: Dict[str, Any] = {}
+
+
+class ResumenEmpleados:
+    """Totales por empleado (NumEmpleado, RFC, CURP) acumulados recibo por recibo.
+
+    Cada empleado es una entrada de un dict con sus sumas, sus periodos distintos y la suma anual
+    de cada columna de conceptos de Nomina; de cada recibo solo queda su periodo en el índice
+    de intervalos que revisa periodos_traslapados.
+    """
+
+    def __init__(self) -> None:
+        self.empleados: Dict[Tuple[str, str, str], _AcumuladoEmpleado] = {}
+        self._periodos: List[Tuple[str, str, str, str, str]] = []
+
+    @staticmethod
+    def clave(encabezado: Dict[str, Optional[str]]) -> Tuple[str, str, str]:
+        return tuple(
+            str(encabezado.get(campo) or "").strip().upper() for campo in ("num_empleado", "rfc", "curp")
+        )
 
-        receptor_cfdi = find_first(root, ".//cfdi:Receptor", NAMESPACES)
-        if receptor_cfdi is None:
-            receptor_cfdi = find_first(root, ".//cfdi3:Receptor", NAMESPACES)
-        if receptor_cfdi is None:
-            receptor_cfdi = _first_by_local_attr(
-                root, "Receptor", ("UsoCFDI", "RegimenFiscalReceptor", "DomicilioFiscalReceptor")
+    def agregar(
+        self,
+        encabezado: Dict[str, Optional[str]],
+        filas: List[FilaDetalle],
+        totales: List[Any],
+        montos: Tuple[Any, Any, Any, Any],
+    ) -> None:
+        """Suma un recibo; `montos` son sus percepciones, deducciones, subsidios y neto."""
+        clave = self.clave(encabezado)
+        acumulado = self.empleados.get(clave)
+        if acumulado is None:
+            acumulado = self.empleados[clave] = _AcumuladoEmpleado(encabezado.get("nombre") or "")
+        acumulado.recibos += 1
+        acumulado.dias += _dias(encabezado.get("num_dias_pagados"))
+        for posicion, monto in enumerate(montos):
+            acumulado.montos[posicion] += monto
+        for fila, total in zip(filas, totales):
+            header_key = f"{PREFIJO_TIPO[fila[1]]}-{fila[3][:15]}-{fila[4][:20]}"
+            acumulado.conceptos[header_key] = acumulado.conceptos.get(header_key, 0) + total
+
+        inicio = str(encabezado.get("fecha_inicial_pago") or "")
+        fin = str(encabezado.get("fecha_final_pago") or "")
+        if inicio or fin:
+            acumulado.periodos.add((inicio, fin))
+            if inicio and (not acumulado.primero or inicio < acumulado.primero):
+                acumulado.primero = inicio
+            if fin > acumulado.ultimo:
+                acumulado.ultimo = fin
+        if any(clave) and (encabezado.get("tipo_nomina") or "").strip().upper() in TIPOS_NOMINA_PERIODICA:
+            self._periodos.append(("/".join(clave), encabezado.get("uuid") or "", encabezado.get("archivo") or "", inicio, fin))
+
+    def filas(self, conceptos_headers: List[str]) -> Iterable[List[Any]]:
+        """Filas de Resumen_Empleado en orden de clave; conceptos sin movimientos quedan vacíos."""
+        for clave in sorted(self.empleados):
+            acumulado = self.empleados[clave]
+            yield [
+                *clave,
+                acumulado.nombre,
+                acumulado.recibos,
+                len(acumulado.periodos),
+                acumulado.primero,
+                acumulado.ultimo,
+                acumulado.dias,
+                *acumulado.montos,
+            ] + [acumulado.conceptos.get(header, "") for header in conceptos_headers]
+
+    def pagos_duplicados(self) -> pd.DataFrame:
+        columnas = list(zip(*self._periodos)) or [()] * 5
+        return periodos_traslapados(*(pd.Series(list(columna), dtype=object) for columna in columnas))
+
+
+def _cruzar_indice(
+    indice: IndiceLotes, recibos: List[Tuple[Dict[str, Optional[str]], int, int]], lote: str
+) -> pd.DataFrame:
+    """Recibos cuyo UUID, o cuyo periodo para el mismo CURP, el índice ya tenía de otro lote."""
+    encabezados = [encabezado for encabezado, _, _ in recibos]
+    uuids = indice.revisar_uuids(((encabezado["uuid"] or "", encabezado["archivo"]) for encabezado in encabezados), lote)
+    periodos = indice.revisar_periodos(
+        (
+            (
+                encabezado["curp"] or "",
+                encabezado["fecha_inicial_pago"] or "",
+                encabezado["fecha_final_pago"] or "",
+                encabezado["uuid"] or "",
+                encabezado["archivo"],
             )
+            for encabezado in encabezados
+            if (encabezado["tipo_nomina"] or "").strip().upper() in TIPOS_NOMINA_PERIODICA
+        ),
+        lote,
+        (uuid for uuid, _, _, _ in uuids),
+    )
+    return unir_excepciones(
+        [
+            excepciones_de_indice(
+                REGLA_UUID_OTRO_LOTE,
+                [(uuid, archivo, f"Visto antes en el lote {lote_previo} ({archivo_previo})") for uuid, archivo, lote_previo, archivo_previo in uuids],
+            ),
+            excepciones_de_indice(
+                REGLA_PERIODO_OTRO_LOTE,
+                [
+                    (uuid, archivo, f"CURP {curp}: periodo {inicio} a {fin} ya pagado con {uuid_previo} en el lote {lote_previo} ({archivo_previo})")
+                    for uuid, archivo, curp, inicio, fin, uuid_previo, lote_previo, archivo_previo in periodos
+                ],
+            ),
+        ]
+    )
+
 
-        receptor_nomina = find_first(root, ".//nomina12:Receptor", NAMESPACES)
-        if receptor_nomina is None:
-            receptor_nomina = _first_by_local_attr(root, "Receptor", ("NumEmpleado", "Curp"))
+def revisar_indice(
+    recibos: List[Tuple[Dict[str, Optional[str]], int, int]], directorio: str, tracker: IssueTracker
+) -> Optional[pd.DataFrame]:
+    """Cruza los recibos con el índice de XML_INDICE_DB, si está configurado."""
+    indice = open_indice(tracker)
+    if indice is None:
+        return None
+    try:
+        return _cruzar_indice(indice, recibos, lote_de(directorio))
+    except Exception as exc:
+        tracker.error(f"No se pudo consultar el índice entre lotes: {exc}")
+        return None
+    finally:
+        indice.close()
 
-        nomina = find_first(root, ".//nomina12:Nomina", NAMESPACES)
-        if nomina is None:
-            nomina = find_first_local(root, "Nomina")
 
-        if receptor_cfdi is None or receptor_nomina is None or nomina is None:
-            tracker.warn(
-                f"Estructura de nómina incompleta en {filename}. "
-                f"Receptor CFDI: {'OK' if receptor_cfdi is not None else 'No'}; "
-                f"Receptor Nómina: {'OK' if receptor_nomina is not None else 'No'}; "
-                f"Nomina: {'OK' if nomina is not None else 'No'}."
+def _escribir_resumen(libro: ShardedWorkbook, resumen: ResumenEmpleados, conceptos_headers: List[str]) -> None:
+    hoja = libro.add_sheet(
+        "Resumen_Empleado", ENCABEZADOS_RESUMEN + conceptos_headers, key_columns=4, header_style=ESTILO_ENCABEZADO_NOMINA
+    )
+    hoja.append_rows(resumen.filas(conceptos_headers))
+    hoja.close()
+
+
+def _datos_almacen(
+    encabezado: Dict[str, Optional[str]],
+    filas: List[FilaDetalle],
+    gravados: List[Any],
+    exentos: List[Any],
+    totales: List[Any],
+    montos: Dict[str, Any],
+) -> Tuple[Dict[str, Any], List[Tuple[Any, ...]]]:
+    """Recibo y conceptos en la forma de CfdiStore.cargar_nomina; `montos` trae los totales del recibo."""
+    recibo = dict(encabezado, fecha=encabezado["fecha_comprobante"], **montos)
+    conceptos: List[Tuple[Any, ...]] = []
+    for fila, gravado, exento, total in zip(filas, gravados, exentos, totales):
+        percepcion = fila[1] == "Percepción"
+        conceptos.append(
+            (
+                encabezado["uuid"],
+                fila[1],
+                fila[2],
+                fila[3],
+                fila[4],
+                gravado if percepcion else None,
+                exento if percepcion else None,
+                total,
             )
-            continue
+        )
+    return recibo, conceptos
+
+
+def _cargar_almacen(
+    store, recibos: List[Dict[str, Any]], conceptos: List[Tuple[Any, ...]], directorio: str, tracker: IssueTracker
+) -> Optional[int]:
+    """Recibos cargados en SQLite; None (y un error en el tracker) si la carga falló."""
+    try:
+        return store.cargar_nomina(recibos, conceptos, lote_de(directorio))
+    except Exception as exc:
+        tracker.error(f"No se pudo cargar el lote en SQLite: {exc}")
+        return None
+
+
+def escribir_resultados(
+    directorio: str, registros: Iterable[Recibo], tracker: IssueTracker, progreso: ProgressReporter
+) -> str:
+    """Arma y escribe el libro a partir del resultado de cada archivo, en orden de lote.
+
+    Los errores al escribir se propagan.
+    """
+    if memoria_acotada():
+        return _escribir_resultados_por_bloques(directorio, registros, tracker, progreso)
+
+    archivos_con_error: List[Tuple[str, str]] = []
+    detalle, recibos = _reunir_recibos(registros, archivos_con_error)
+
+    progreso.stage("conversion")
+    gravados, exentos, totales = _convertir_detalle(detalle, tracker)
 
-        tfd = find_first(root, ".//tfd:TimbreFiscalDigital", NAMESPACES)
-        if tfd is None:
-            tfd = find_first_local(root, "TimbreFiscalDigital")
-        uuid = get_attr(tfd, "UUID") or ""
-
-        num_empleado = get_attr(receptor_nomina, "NumEmpleado") or ""
-        nombre = get_attr(receptor_cfdi, "Nombre") or ""
-        rfc = get_attr(receptor_cfdi, "Rfc") or ""
-        curp = get_attr(receptor_nomina, "Curp") or ""
-        puesto = get_attr(receptor_nomina, "Puesto") or ""
-        departamento = get_attr(receptor_nomina, "Departamento") or ""
-        tipo_nomina = get_attr(nomina, "TipoNomina") or ""
-        fecha_comprobante = get_attr(root, "Fecha") or ""
-        num_dias_pagados = get_attr(nomina, "NumDiasPagados") or ""
-        fecha_inicial_pago = get_attr(nomina, "FechaInicialPago") or ""
-        fecha_final_pago = get_attr(nomina, "FechaFinalPago") or ""
-        fecha_pago = get_attr(nomina, "FechaPago") or ""
-
-        total_percepciones = to_float(get_attr(nomina, "TotalPercepciones"), 0.0, tracker, "TotalPercepciones")
-        total_deducciones = to_float(get_attr(nomina, "TotalDeducciones"), 0.0, tracker, "TotalDeducciones")
-        total_subsidios = 0.0
-        for otro_pago in _nomina_elements(root, "OtroPago"):
-            if get_attr(otro_pago, "TipoOtroPago") == "002":
-                total_subsidios += to_float(get_attr(otro_pago, "Importe"), 0.0, tracker, "Subsidios")
-        total_neto = total_percepciones - total_deducciones + total_subsidios
-
-        conceptos_valores: Dict[str, float] = {header: "" for header in conceptos_headers}
-        for percepcion in _nomina_elements(root, "Percepcion"):
-            clave = get_attr(percepcion, "Clave") or ""
-            concepto_texto = get_attr(percepcion, "Concepto") or ""
-            importe_total = to_float(get_attr(percepcion, "ImporteGravado"), 0.0, tracker, "ImporteGravado") + to_float(
-                get_attr(percepcion, "ImporteExento"), 0.0, tracker, "ImporteExento"
+    output_path = os.path.join(directorio, "Percepciones_Deducciones_Subsidios.xlsx")
+    progreso.stage("excel")
+    with ShardedWorkbook(output_path) as libro:
+        ws = libro.add_sheet("Perc_Deduc_Sub", ENCABEZADOS_DETALLE, header_style={})
+        catalogo: CatalogoConceptos = {tipo: set() for tipo in PREFIJO_TIPO}
+        _escribir_detalle(ws, detalle, gravados, exentos, totales, catalogo)
+        ws.close()
+
+        conceptos_headers = _escribir_catalogo(libro, catalogo)
+
+        # Con un catálogo enorme las columnas de conceptos se reparten en hojas que repiten el UUID.
+        nomina_ws = libro.add_sheet("Nomina", ENCABEZADOS_NOMINA + conceptos_headers, header_style=ESTILO_ENCABEZADO_NOMINA)
+
+        totales_percepciones, totales_deducciones = _convertir_totales(recibos, tracker)
+
+        resumen = ResumenEmpleados()
+        store = open_store(tracker)
+        recibos_almacen: List[Dict[str, Any]] = []
+        conceptos_almacen: List[Tuple[Any, ...]] = []
+
+        for consecutivo, ((encabezado, inicio, fin), total_percepciones, total_deducciones) in enumerate(
+            zip(recibos, totales_percepciones, totales_deducciones), start=1
+        ):
+            fila_nomina, total_subsidios, total_neto = _fila_nomina(
+                consecutivo, encabezado, detalle[inicio:fin], totales[inicio:fin], total_percepciones, total_deducciones, conceptos_headers
             )
-            header_key = f"P-{clave[:15]}-{concepto_texto[:20]}"
-            if header_key in conceptos_valores and conceptos_valores[header_key] in ("", None):
-                conceptos_valores[header_key] = importe_total
-
-        for deduccion in _nomina_elements(root, "Deduccion"):
-            clave = get_attr(deduccion, "Clave") or ""
-            concepto_texto = get_attr(deduccion, "Concepto") or ""
-            importe = to_float(get_attr(deduccion, "Importe"), 0.0, tracker, "Importe Deducción")
-            header_key = f"D-{clave[:15]}-{concepto_texto[:20]}"
-            if header_key in conceptos_valores and conceptos_valores[header_key] in ("", None):
-                conceptos_valores[header_key] = importe
-
-        for otro_pago in _nomina_elements(root, "OtroPago"):
-            if get_attr(otro_pago, "TipoOtroPago") != "002":
-                continue
-            clave = get_attr(otro_pago, "Clave") or ""
-            concepto_texto = get_attr(otro_pago, "Concepto") or ""
-            importe = to_float(get_attr(otro_pago, "Importe"), 0.0, tracker, "Importe Subsidio")
-            header_key = f"S-{clave[:15]}-{concepto_texto[:20]}"
-            if header_key in conceptos_valores and conceptos_valores[header_key] in ("", None):
-                conceptos_valores[header_key] = importe
-
-        nomina_ws.append(
+            nomina_ws.append(fila_nomina)
+            resumen.agregar(
+                encabezado, detalle[inicio:fin], totales[inicio:fin], (total_percepciones, total_deducciones, total_subsidios, total_neto)
+            )
+
+            if store is not None:
+                recibo, conceptos = _datos_almacen(
+                    encabezado,
+                    detalle[inicio:fin],
+                    gravados[inicio:fin],
+                    exentos[inicio:fin],
+                    totales[inicio:fin],
+                    dict(
+                        total_percepciones=total_percepciones,
+                        total_deducciones=total_deducciones,
+                        total_subsidios=total_subsidios,
+                        total_neto=total_neto,
+                    ),
+                )
+                recibos_almacen.append(recibo)
+                conceptos_almacen.extend(conceptos)
+
+        nomina_ws.close()
+        _escribir_resumen(libro, resumen, conceptos_headers)
+
+        if store is not None:
+            progreso.stage("almacen")
+            try:
+                cargados = _cargar_almacen(store, recibos_almacen, conceptos_almacen, directorio, tracker)
+                if cargados is not None:
+                    print_progress(f"Almacén SQLite: {cargados} recibo(s) cargados en {store.path}")
+            finally:
+                store.close()
+
+        progreso.stage("auditoria")
+        excepciones = unir_excepciones(
             [
-                uuid,
-                consecutivo,
-                num_empleado,
-                nombre,
-                rfc,
-                curp,
-                puesto,
-                departamento,
-                tipo_nomina,
-                fecha_comprobante,
-                num_dias_pagados,
-                fecha_inicial_pago,
-                fecha_final_pago,
-                fecha_pago,
-                total_percepciones,
-                total_deducciones,
-                total_subsidios,
-                total_neto,
+                _auditar_recibos(recibos, detalle, totales, totales_percepciones, totales_deducciones),
+                resumen.pagos_duplicados(),
+                revisar_indice(recibos, directorio, tracker),
             ]
-            + [conceptos_valores[header] for header in conceptos_headers]
         )
-        consecutivo += 1
+        reportar_excepciones(tracker, excepciones)
+        if not excepciones.empty:
+            libro.write_frame(HOJA_EXCEPCIONES, excepciones)
+
+        archivos = libro.close()
+    if len(archivos) > 1:
+        print_progress(f"Salida dividida en {len(archivos)} archivos; ver {manifest_path(output_path)}")
+
+    if archivos_con_error:
+        tracker.error(f"{len(archivos_con_error)} archivo(s) con error durante el procesamiento.")
+
+    return output_path
 
+
+def _escribir_resultados_por_bloques(
+    directorio: str, registros: Iterable[Recibo], tracker: IssueTracker, progreso: ProgressReporter
+) -> str:
+    """escribir_resultados con memoria acotada (XML_MEMORIA_MB).
+
+    Primera pasada: Perc_Deduc_Sub por bloques; el catálogo, que es pequeño, se acumula aparte y
+    los recibos convertidos se vuelcan a disco. Segunda: las filas de Nomina salen de la mezcla
+    en orden de lote, ya con el catálogo completo. Tercera: almacén y auditoría sobre la mezcla
+    ordenada por UUID, en lotes que nunca parten un UUID; las excepciones de cada regla salen en
+    orden de UUID.
+    """
+    archivos_con_error: List[Tuple[str, str]] = []
     output_path = os.path.join(directorio, "Percepciones_Deducciones_Subsidios.xlsx")
-    try:
-        wb.save(output_path)
-    except Exception as exc:
-        tracker.fatal(f"No se pudo guardar el archivo Excel: {exc}")
-        return None
+    with ShardedWorkbook(output_path) as libro:
+        ws = libro.add_sheet("Perc_Deduc_Sub", ENCABEZADOS_DETALLE, header_style={})
+        catalogo: CatalogoConceptos = {tipo: set() for tipo in PREFIJO_TIPO}
+        store = open_store(tracker)
+        consecutivo = 0
+
+        with CorridasOrdenadas("nomina") as por_lote, CorridasOrdenadas("nomina_uuid") as por_uuid:
+            for bloque in en_bloques(registros, lambda recibo: len(recibo[0]) or 1):
+                detalle, recibos = _reunir_recibos(bloque, archivos_con_error)
+                del bloque
+                progreso.stage("conversion")
+                gravados, exentos, totales = _convertir_detalle(detalle, tracker)
+                totales_percepciones, totales_deducciones = _convertir_totales(recibos, tracker)
+                progreso.stage("excel")
+                _escribir_detalle(ws, detalle, gravados, exentos, totales, catalogo)
+                for (encabezado, inicio, fin), total_percepciones, total_deducciones in zip(
+                    recibos, totales_percepciones, totales_deducciones
+                ):
+                    consecutivo += 1
+                    por_lote.agregar(
+                        consecutivo,
+                        (
+                            encabezado,
+                            detalle[inicio:fin],
+                            gravados[inicio:fin],
+                            exentos[inicio:fin],
+                            totales[inicio:fin],
+                            total_percepciones,
+                            total_deducciones,
+                        ),
+                    )
+                por_lote.volcar()
+            ws.close()
+            print_progress(
+                f"Memoria acotada: {consecutivo} recibo(s) en {len(por_lote.archivos)} corrida(s) en disco; "
+                f"RSS {rss_bytes() // (1024 * 1024)} MB"
+            )
+
+            conceptos_headers = _escribir_catalogo(libro, catalogo)
+            nomina_ws = libro.add_sheet("Nomina", ENCABEZADOS_NOMINA + conceptos_headers, header_style=ESTILO_ENCABEZADO_NOMINA)
+            resumen = ResumenEmpleados()
+            for numero, (encabezado, filas, gravados, exentos, totales, total_percepciones, total_deducciones) in por_lote.mezclar():
+                fila_nomina, total_subsidios, total_neto = _fila_nomina(
+                    numero, encabezado, filas, totales, total_percepciones, total_deducciones, conceptos_headers
+                )
+                nomina_ws.append(fila_nomina)
+                resumen.agregar(encabezado, filas, totales, (total_percepciones, total_deducciones, total_subsidios, total_neto))
+                almacen = None
+                if store is not None:
+                    almacen = _datos_almacen(
+                        encabezado,
+                        filas,
+                        gravados,
+                        exentos,
+                        totales,
+                        dict(
+                            total_percepciones=total_percepciones,
+                            total_deducciones=total_deducciones,
+                            total_subsidios=total_subsidios,
+                            total_neto=total_neto,
+                        ),
+                    )
+                por_uuid.agregar(
+                    (str(encabezado["uuid"]).upper(), numero),
+                    (encabezado, filas, totales, total_percepciones, total_deducciones, almacen),
+                )
+            nomina_ws.close()
+            _escribir_resumen(libro, resumen, conceptos_headers)
+
+            progreso.stage("auditoria")
+            partes: List[pd.DataFrame] = [resumen.pagos_duplicados()]
+            recibos_cargados = 0
+            indice = open_indice(tracker)
+            lote = lote_de(directorio)
+            try:
+                for valores in por_grupos(por_uuid.mezclar(), itemgetter(0)):
+                    recibos = []
+                    detalle = []
+                    totales = []
+                    totales_percepciones = []
+                    totales_deducciones = []
+                    recibos_almacen: List[Dict[str, Any]] = []
+                    conceptos_almacen: List[Tuple[Any, ...]] = []
+                    for encabezado, filas, totales_recibo, total_percepciones, total_deducciones, almacen in valores:
+                        recibos.append((encabezado, len(detalle), len(detalle) + len(filas)))
+                        detalle.extend(filas)
+                        totales.extend(totales_recibo)
+                        totales_percepciones.append(total_percepciones)
+                        totales_deducciones.append(total_deducciones)
+                        if almacen is not None:
+                            recibos_almacen.append(almacen[0])
+                            conceptos_almacen.extend(almacen[1])
+                    partes.append(_auditar_recibos(recibos, detalle, totales, totales_percepciones, totales_deducciones))
+                    if indice is not None:
+                        try:
+                            partes.append(_cruzar_indice(indice, recibos, lote))
+                        except Exception as exc:
+                            tracker.error(f"No se pudo consultar el índice entre lotes: {exc}")
+                            indice.close()
+                            indice = None
+                    if store is not None:
+                        cargados = _cargar_almacen(store, recibos_almacen, conceptos_almacen, directorio, tracker)
+                        if cargados is not None:
+                            recibos_cargados += cargados
+                        else:
+                            store.close()
+                            store = None
+                if store is not None:
+                    print_progress(f"Almacén SQLite: {recibos_cargados} recibo(s) cargados en {store.path}")
+            finally:
+                if store is not None:
+                    store.close()
+                if indice is not None:
+                    indice.close()
+
+        excepciones = ordenar_por_regla(unir_excepciones(partes), REGLAS_RECIBO)
+        reportar_excepciones(tracker, excepciones)
+        if not excepciones.empty:
+            libro.write_frame(HOJA_EXCEPCIONES, excepciones)
+
+        archivos = libro.close()
+    if len(archivos) > 1:
+        print_progress(f"Salida dividida en {len(archivos)} archivos; ver {manifest_path(output_path)}")
 
     if archivos_con_error:
         tracker.error(f"{len(archivos_con_error)} archivo(s) con error durante el procesamiento.")
@@ -309,17 +907,55 @@ def procesar_nomina_xml(directorio: str, tracker: IssueTracker) -> Optional[str]
     return output_path
 
 
+def procesar_nomina_xml(
+    directorio: str, tracker: IssueTracker, progreso: Optional[ProgressReporter] = None
+) -> Optional[str]:
+    progreso = progreso or ProgressReporter("extractor_nomina", None)
+    checkpoint = open_checkpoint(directorio, "extractor_nomina", tracker)
+    progreso.restore(len(checkpoint.processed))
+    progreso.count_in_background(directorio)
+    progreso.stage("lectura")
+    entradas = checkpoint.pending(progreso.discover(iter_xml_files(directorio, order="name")))
+    for entrada, contenido in prefetch_xml_files(entradas):
+        recibo = _procesar_recibo(entrada.path, entrada.relpath, tracker, contenido)
+        checkpoint.add(entrada.relpath, recibo, tracker)
+        progreso.advance(1, entrada.size, len(recibo[0]))
+
+    if not checkpoint.seen:
+        tracker.fatal(f"No se encontraron archivos XML en {directorio}")
+        finish_checkpoint(checkpoint, True, tracker)
+        return None
+
+    checkpoint.end_reading(tracker)
+    try:
+        output_path = escribir_resultados(directorio, checkpoint.records(), tracker, progreso)
+    except Exception as exc:
+        tracker.fatal(f"No se pudo guardar el archivo Excel: {exc}")
+        finish_checkpoint(checkpoint, False, tracker)
+        return None
+    finish_checkpoint(checkpoint, True, tracker)
+    return output_path
+
+
 if __name__ == "__main__":
     tracker = IssueTracker()
 
-    if len(sys.argv) > 1:
-        directorio = sys.argv[1]
+    argumentos, preview = split_preview_flag(sys.argv[1:])
+    if argumentos:
+        directorio = argumentos[0]
     else:
         directorio = os.path.dirname(os.path.abspath(__file__))
+    if preview:
+        sys.exit(run_preview(directorio, "extractor_nomina"))
 
-    excel_file = procesar_nomina_xml(directorio, tracker)
-
-    tracker.report("Nómina")
+    progreso = open_progress(directorio, "extractor_nomina")
+    codigo_salida = 2
+    try:
+        excel_file = procesar_nomina_xml(directorio, tracker, progreso)
+        tracker.report("Nómina")
+        codigo_salida = tracker.exit_code
+    finally:
+        progreso.finish(codigo_salida)
 
     if excel_file and tracker.exit_code == 0:
         print(excel_file)
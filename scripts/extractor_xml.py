@@ -1,161 +1,322 @@
 import os
 import sys
 import pandas as pd
-from typing import Dict, List, Optional
-
+from decimal import Decimal, InvalidOperation
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from cfdi_store import lote_de, open_store
+from audit_utils import (
+    HOJA_EXCEPCIONES,
+    REGLA_UUID_DUPLICADO,
+    REGLA_UUID_OTRO_LOTE,
+    diferencias_de_total,
+    excepciones_de_indice,
+    ordenar_por_regla,
+    reportar_excepciones,
+    unir_excepciones,
+    uuids_duplicados,
+)
+from checkpoint_utils import finish_checkpoint, open_checkpoint
+from indice_lotes import IndiceLotes, open_indice
+from preview_utils import run_preview, split_preview_flag
+from progress_utils import ProgressReporter, open_progress
+from report_utils import ShardedWorkbook, manifest_path
+from schema_utils import Campo, Esquema
+from spill_utils import CorridasOrdenadas, en_bloques, memoria_acotada, por_grupos, rss_bytes
+from watch_folder import split_watch_flag, vigilar
 from xml_utils import (
+    EXACT_AMOUNTS,
     IssueTracker,
-    find_all,
-    find_first,
+    XmlBuffer,
+    XmlEntry,
+    family_tag,
     get_attr,
+    iter_xml_files,
     load_xml_root,
     normalize_text,
+    prefetch_xml_files,
+    print_file_progress,
     print_progress,
-    to_float,
+    to_numeric_column,
 )
 
 
+# Prefijos de las rutas de los esquemas. Son los nombres de familia de NAMESPACE_FAMILIES, así que
+# el recorrido de extraer_datos_cfdi resuelve igual CFDI 3.3/4.0 y Pagos 1.0/2.0.
 NAMESPACES: Dict[str, str] = {
     "cfdi": "http://www.sat.gob.mx/cfd/4",
     "tfd": "http://www.sat.gob.mx/TimbreFiscalDigital",
-    "pago20": "http://www.sat.gob.mx/Pagos20",
+}
+
+# Campos de apoyo que viajan en las filas pero no se escriben en la hoja de detalle.
+COLUMNAS_INTERNAS: List[str] = ["_ImpPagado", "_Descuento", "_Archivo", "_Impuestos"]
+
+REGLA_TOTAL_CONCEPTOS = "Total distinto de la suma de conceptos"
+
+# Diferencia máxima (pesos) para considerar una factura totalmente pagada.
+TOLERANCIA_SALDO = 0.01
+
+# Columnas de baja cardinalidad que se repiten en todo el lote; se guardan como categorías.
+COLUMNAS_CATEGORICAS: List[str] = [
+    "Tipo de Comprobante",
+    "Tipo Relación",
+    "RFC Proveedor",
+    "Nombre Proveedor",
+    "Régimen Fiscal Proveedor",
+    "CP del Proveedor",
+    "RFC del Cliente",
+    "Nombre del Cliente",
+    "Uso del CFDI",
+    "Método de Pago",
+    "Forma de Pago",
+    "Unidad",
+    "Clave Impuesto Trasladado",
+    "Clave Impuesto Retenido",
+    "Versión CFDI",
+]
+
+
+# Columnas comunes a conceptos y pagos, en el orden de la hoja. Solo cambian las filas entre
+# "Folio CFDI (UUID)" y "Total General" y el campo interno del final.
+_UUID = [
+    Campo("Tipo de Comprobante", "comprobante", "TipoDeComprobante", "N/A"),
+    Campo("Folio CFDI (UUID)", "comprobante", "UUID", "N/A", ruta=".//tfd:TimbreFiscalDigital"),
+]
+_PARTES = [
+    Campo("Fecha", "comprobante", "Fecha", "N/A"),
+    Campo("RFC Proveedor", "comprobante", "Rfc", "N/A", ruta=".//cfdi:Emisor"),
+    Campo("Nombre Proveedor", "comprobante", "Nombre", "Desconocido", ruta=".//cfdi:Emisor"),
+    Campo("Régimen Fiscal Proveedor", "comprobante", "RegimenFiscal", "N/A", ruta=".//cfdi:Emisor"),
+    Campo("CP del Proveedor", "comprobante", "LugarExpedicion", "N/A"),
+    Campo("RFC del Cliente", "comprobante", "Rfc", "N/A", ruta=".//cfdi:Receptor"),
+    Campo("Nombre del Cliente", "comprobante", "Nombre", "Desconocido", ruta=".//cfdi:Receptor"),
+    Campo("Uso del CFDI", "comprobante", "UsoCFDI", "N/A", ruta=".//cfdi:Receptor"),
+    Campo("Método de Pago", "comprobante", "MetodoPago", "N/A"),
+]
+_CIERRE = [
+    Campo("Total General", "comprobante", "Total", tipo="monto"),
+    Campo("Versión CFDI", "comprobante", "Version", "N/A"),
+]
+
+# Una fila por concepto de ingresos/egresos.
+ESQUEMA_CONCEPTO = Esquema(
+    _UUID
+    + [
+        Campo("Folio CFDI (UUID) Relacionados", None, defecto="N/A"),
+        Campo("Tipo Relación", "comprobante", "TipoRelacion", "N/A", ruta=".//cfdi:CfdiRelacionados"),
+    ]
+    + _PARTES
+    + [
+        Campo("Forma de Pago", "comprobante", "FormaPago", "N/A"),
+        Campo("Descripción", "concepto", "Descripcion", "N/A"),
+        Campo("Cantidad", "concepto", "Cantidad", tipo="numero"),
+        Campo("Unidad", "concepto", "Unidad", "N/A"),
+        Campo("Valor Unitario", "concepto", "ValorUnitario", tipo="monto"),
+        Campo("Importe", "concepto", "Importe", tipo="monto"),
+        Campo("Clave Impuesto Trasladado", "concepto", "Impuesto", "N/A", ruta=".//cfdi:Traslado"),
+        Campo("Impuesto Trasladado", "concepto", "Importe", ruta=".//cfdi:Traslado", tipo="monto"),
+        Campo("Clave Impuesto Retenido", "concepto", "Impuesto", "N/A", ruta=".//cfdi:Retencion"),
+        Campo("Impuesto Retenido", "concepto", "Importe", ruta=".//cfdi:Retencion", tipo="monto"),
+    ]
+    + _CIERRE
+    + [Campo("_Descuento", "concepto", "Descuento")],
+    NAMESPACES,
+)
+
+# Una fila por documento relacionado de cada pago de un complemento de pagos.
+ESQUEMA_PAGO = Esquema(
+    _UUID
+    + [
+        Campo("Folio CFDI (UUID) Relacionados", "docto", "IdDocumento", "N/A"),
+        Campo("Tipo Relación", "docto", "TipoRelacion", "N/A"),
+    ]
+    + _PARTES
+    + [
+        Campo("Forma de Pago", "pago", "FormaDePagoP", "N/A"),
+        Campo("Descripción", None, defecto="Pago"),
+        Campo("Cantidad", None, defecto=1, tipo="numero"),
+        Campo("Unidad", None, defecto="N/A"),
+        Campo("Valor Unitario", "pago", "Monto", tipo="monto"),
+        Campo("Importe", "pago", "Monto", tipo="monto"),
+        Campo("Clave Impuesto Trasladado", None, defecto="N/A"),
+        Campo("Impuesto Trasladado", None, tipo="monto"),
+        Campo("Clave Impuesto Retenido", None, defecto="N/A"),
+        Campo("Impuesto Retenido", None, tipo="monto"),
+    ]
+    + _CIERRE
+    + [Campo("_ImpPagado", "docto", "ImpPagado", respaldo="Importe")],
+    NAMESPACES,
+)
+
+# Columnas numéricas: se guardan como texto crudo y se convierten en una sola pasada por columna.
+COLUMNAS_MONTO: List[str] = ESQUEMA_CONCEPTO.columnas_de_tipo("monto")
+COLUMNAS_NUMERICAS: List[str] = ESQUEMA_CONCEPTO.columnas_de_tipo("numero", "monto")
+_POSICION_UUID = ESQUEMA_CONCEPTO.posicion("Folio CFDI (UUID)")
+
+
+def _llaves_de_rutas(*rutas: str) -> Dict[str, str]:
+    """'cfdi:Emisor' -> './/cfdi:Emisor'. El recorrido solo resuelve rutas de un paso a cualquier profundidad."""
+    llaves = {}
+    for ruta in rutas:
+        llave = ruta[3:] if ruta.startswith(".//") else ""
+        if not llave or "/" in llave:
+            raise ValueError(f"Ruta no soportada por el recorrido: {ruta}")
+        llaves[llave] = ruta
+    return llaves
+
+
+_RUTAS_COMPROBANTE = _llaves_de_rutas(*ESQUEMA_CONCEPTO.rutas("comprobante"), *ESQUEMA_PAGO.rutas("comprobante"))
+_RUTAS_CONCEPTO = _llaves_de_rutas(*ESQUEMA_CONCEPTO.rutas("concepto"))
+_RUTAS_PAGO = _llaves_de_rutas(*ESQUEMA_PAGO.rutas("pago"))
+_RUTAS_DOCTO = _llaves_de_rutas(*ESQUEMA_PAGO.rutas("docto"))
+
+Ambito = Tuple[Any, Dict[str, Any]]  # (elemento, hijos ruta -> elemento para Esquema.llenar)
+
+
+# Traslados y retenciones de un concepto: ("Trasladado" | "Retenido", elemento)
+_TIPOS_IMPUESTO = {"cfdi:Traslado": "Trasladado", "cfdi:Retencion": "Retenido"}
+
+
+class RecorridoCfdi(NamedTuple):
+    comprobante: Dict[str, Any]
+    conceptos: List[Tuple[Any, Dict[str, Any], List[Tuple[str, Any]]]]
+    pagos: Optional[List[Tuple[Ambito, List[Ambito]]]]  # None: sin complemento de pagos
+
+
+def recorrer_cfdi(root) -> RecorridoCfdi:
+    """
+    Un solo recorrido en preorden que reúne todo lo que leen los esquemas
+
+    Los elementos se reconocen por familia de namespace (cfdi, tfd, pago), no por versión. Cada
+    elemento se anota en los ámbitos abiertos que lo buscan, en orden de documento, igual que
+    el `find` de cada ruta. Los pagos son los del primer complemento, como antes. De cada
+    concepto se juntan además todos sus traslados y retenciones, no solo el primero.
+    """
+    comprobante: Dict[str, Any] = {}
+    conceptos: List[Tuple[Any, Dict[str, Any], List[Tuple[str, Any]]]] = []
+    pagos: Optional[List[Tuple[Ambito, List[Ambito]]]] = None
+    # (elemento, ámbitos abiertos [(llaves, hijos)], doctos del pago abierto, dentro del complemento,
+    #  impuestos del concepto abierto)
+    pendientes = [(root, ((_RUTAS_COMPROBANTE, comprobante),), None, False, None)]
+    while pendientes:
+        elemento, abiertos, doctos, en_pagos, impuestos = pendientes.pop()
+        siguientes = []
+        for hijo in elemento:
+            if not isinstance(hijo.tag, str):
+                continue
+            llave = family_tag(hijo.tag)
+            for llaves, hijos in abiertos:
+                ruta = llaves.get(llave)
+                if ruta is not None and ruta not in hijos:
+                    hijos[ruta] = hijo
+
+            hijo_abiertos, hijo_doctos, hijo_en_pagos, hijo_impuestos = abiertos, doctos, en_pagos, impuestos
+            if impuestos is not None and llave in _TIPOS_IMPUESTO:
+                impuestos.append((_TIPOS_IMPUESTO[llave], hijo))
+            if llave == "cfdi:Concepto":
+                hijo_impuestos = []
+                conceptos.append((hijo, {}, hijo_impuestos))
+                hijo_abiertos = abiertos + ((_RUTAS_CONCEPTO, conceptos[-1][1]),)
+            elif llave == "pago:Pagos" and pagos is None:
+                pagos = []
+                hijo_en_pagos = True
+            elif en_pagos and llave == "pago:Pago":
+                ambito = (hijo, {})
+                hijo_doctos = []
+                pagos.append((ambito, hijo_doctos))
+                hijo_abiertos = abiertos + ((_RUTAS_PAGO, ambito[1]),)
+            elif doctos is not None and llave == "pago:DoctoRelacionado":
+                ambito = (hijo, {})
+                doctos.append(ambito)
+                hijo_abiertos = abiertos + ((_RUTAS_DOCTO, ambito[1]),)
+            siguientes.append((hijo, hijo_abiertos, hijo_doctos, hijo_en_pagos, hijo_impuestos))
+        # La pila saca primero al primer hijo: preorden en orden de documento.
+        pendientes.extend(reversed(siguientes))
+    return RecorridoCfdi(comprobante, conceptos, pagos)
+
+
+# Columnas de detalle de cada tipo de impuesto: (clave, importe)
+_COLUMNAS_IMPUESTO = {
+    "Trasladado": ("Clave Impuesto Trasladado", "Impuesto Trasladado"),
+    "Retenido": ("Clave Impuesto Retenido", "Impuesto Retenido"),
 }
 
 
-def extraer_datos_cfdi(xml_file: str, tracker: IssueTracker) -> List[Dict[str, Optional[str]]]:
-    print_progress(f"Procesando: {os.path.basename(xml_file)}")
-    root = load_xml_root(xml_file, tracker)
+def _sumar_impuestos(datos: Dict[str, Any], impuestos: List[Tuple[str, Any]]) -> None:
+    """
+    Lleva todos los traslados y retenciones del concepto a la fila
+
+    "_Impuestos" guarda cada uno como (tipo, clave, importe crudo) para Resumen Impuestos. Con
+    más de un impuesto del mismo tipo (IVA + IEPS, ISR + IVA retenidos), la columna de importe
+    es su suma exacta y la de clave lista las claves; con uno solo quedan tal como se leyeron.
+    """
+    detalle = tuple(
+        (tipo, get_attr(elemento, "Impuesto") or "N/A", elemento.attrib.get("Importe")) for tipo, elemento in impuestos
+    )
+    datos["_Impuestos"] = detalle
+    for tipo, (columna_clave, columna_importe) in _COLUMNAS_IMPUESTO.items():
+        del_tipo = [(clave, importe) for tipo_impuesto, clave, importe in detalle if tipo_impuesto == tipo]
+        if len(del_tipo) < 2:
+            continue
+        datos[columna_clave] = ", ".join(dict.fromkeys(clave for clave, _ in del_tipo))
+        importes = [importe.strip() for _, importe in del_tipo if importe and importe.strip()]
+        if not importes:
+            continue
+        try:
+            datos[columna_importe] = str(sum(Decimal(importe) for importe in importes))
+        except InvalidOperation:
+            # Se deja el primer valor; la conversión por columna reporta el inválido.
+            datos[columna_importe] = importes[0]
+
+
+def extraer_datos_cfdi(
+    xml_file: str, tracker: IssueTracker, contenido: Optional[XmlBuffer] = None
+) -> List[Dict[str, Optional[str]]]:
+    print_file_progress(f"Procesando: {os.path.basename(xml_file)}")
+    root = load_xml_root(xml_file, tracker, contenido)
     if root is None:
         return []
 
     filas_datos: List[Dict[str, Optional[str]]] = []
-    version_cfdi = get_attr(root, "Version") or "N/A"
     tipo_comprobante = get_attr(root, "TipoDeComprobante") or "N/A"
+    esquema = ESQUEMA_PAGO if tipo_comprobante == "P" else ESQUEMA_CONCEPTO
+    recorrido = recorrer_cfdi(root)
 
-    tfd = find_first(root, ".//tfd:TimbreFiscalDigital", NAMESPACES)
-    uuid = get_attr(tfd, "UUID") or "N/A"
-    if uuid == "N/A":
+    # Los campos del comprobante se leen una vez; cada fila parte de una copia.
+    comprobante = esquema.nueva_fila()
+    esquema.llenar("comprobante", root, comprobante, recorrido.comprobante)
+    if comprobante[_POSICION_UUID] == "N/A":
         tracker.warn(f"UUID no encontrado en {os.path.basename(xml_file)}")
 
-    emisor = find_first(root, ".//cfdi:Emisor", NAMESPACES)
-    receptor = find_first(root, ".//cfdi:Receptor", NAMESPACES)
-
-    rfc_emisor = get_attr(emisor, "Rfc") or "N/A"
-    nombre_emisor = get_attr(emisor, "Nombre") or "Desconocido"
-    regimen_fiscal_emisor = get_attr(emisor, "RegimenFiscal") or "N/A"
-
-    rfc_receptor = get_attr(receptor, "Rfc") or "N/A"
-    nombre_receptor = get_attr(receptor, "Nombre") or "Desconocido"
-    uso_cfdi = get_attr(receptor, "UsoCFDI") or "N/A"
-
-    fecha = get_attr(root, "Fecha") or "N/A"
-    metodo_pago = get_attr(root, "MetodoPago") or "N/A"
-    forma_pago = get_attr(root, "FormaPago") or "N/A"
-    total_general = get_attr(root, "Total") or "0"
-    cp_proveedor = get_attr(root, "LugarExpedicion") or "N/A"
-
     try:
         if tipo_comprobante == "P":
-            complemento_pagos = find_first(root, ".//pago20:Pagos", NAMESPACES)
-            if complemento_pagos is None:
+            if recorrido.pagos is None:
                 tracker.error(f"Complemento de pagos faltante en {os.path.basename(xml_file)}")
                 return filas_datos
 
-            for pago in find_all(complemento_pagos, ".//pago20:Pago", NAMESPACES):
-                forma_pago_pago = get_attr(pago, "FormaDePagoP") or "N/A"
-                monto_pago = to_float(get_attr(pago, "Monto"), 0.0, tracker, "Monto pago")
+            for (pago, hijos_pago), doctos in recorrido.pagos:
+                fila_pago = comprobante.copy()
+                esquema.llenar("pago", pago, fila_pago, hijos_pago)
 
-                doctos = find_all(pago, ".//pago20:DoctoRelacionado", NAMESPACES)
                 if not doctos:
                     tracker.warn(f"No hay DoctoRelacionado en pago de {os.path.basename(xml_file)}")
 
-                for docto_relacionado in doctos:
-                    filas_datos.append(
-                        {
-                            "Tipo de Comprobante": tipo_comprobante,
-                            "Folio CFDI (UUID)": uuid,
-                            "Folio CFDI (UUID) Relacionados": get_attr(docto_relacionado, "IdDocumento") or "N/A",
-                            "Tipo Relación": get_attr(docto_relacionado, "TipoRelacion") or "N/A",
-                            "Fecha": fecha,
-                            "RFC Proveedor": rfc_emisor,
-                            "Nombre Proveedor": nombre_emisor,
-                            "Régimen Fiscal Proveedor": regimen_fiscal_emisor,
-                            "CP del Proveedor": cp_proveedor,
-                            "RFC del Cliente": rfc_receptor,
-                            "Nombre del Cliente": nombre_receptor,
-                            "Uso del CFDI": uso_cfdi,
-                            "Método de Pago": metodo_pago,
-                            "Forma de Pago": forma_pago_pago,
-                            "Descripción": "Pago",
-                            "Cantidad": 1,
-                            "Unidad": "N/A",
-                            "Valor Unitario": monto_pago,
-                            "Importe": monto_pago,
-                            "Clave Impuesto Trasladado": "N/A",
-                            "Impuesto Trasladado": 0.0,
-                            "Clave Impuesto Retenido": "N/A",
-                            "Impuesto Retenido": 0.0,
-                            "Total por Concepto": monto_pago,
-                            "Total General": total_general,
-                            "Versión CFDI": version_cfdi,
-                        }
-                    )
+                for docto_relacionado, hijos_docto in doctos:
+                    fila = fila_pago.copy()
+                    esquema.llenar("docto", docto_relacionado, fila, hijos_docto)
+                    filas_datos.append(esquema.como_dict(fila))
 
         else:
-            cfdi_relacionados = find_first(root, ".//cfdi:CfdiRelacionados", NAMESPACES)
-            tipo_relacion = get_attr(cfdi_relacionados, "TipoRelacion") or "N/A"
-
-            conceptos = find_all(root, ".//cfdi:Concepto", NAMESPACES)
-            if not conceptos:
+            if not recorrido.conceptos:
                 tracker.warn(f"No se encontraron conceptos en {os.path.basename(xml_file)}")
 
-            for concepto in conceptos:
-                descripcion = get_attr(concepto, "Descripcion") or "N/A"
-                cantidad = to_float(get_attr(concepto, "Cantidad"), 0.0, tracker, "Cantidad")
-                unidad = get_attr(concepto, "Unidad") or "N/A"
-                valor_unitario = to_float(get_attr(concepto, "ValorUnitario"), 0.0, tracker, "ValorUnitario")
-                importe = to_float(get_attr(concepto, "Importe"), 0.0, tracker, "Importe")
-
-                traslado = find_first(concepto, ".//cfdi:Traslado", NAMESPACES)
-                impuesto_trasladado = to_float(get_attr(traslado, "Importe"), 0.0, tracker, "Traslado")
-                clave_impuesto_trasladado = get_attr(traslado, "Impuesto") or "N/A"
-
-                retencion = find_first(concepto, ".//cfdi:Retencion", NAMESPACES)
-                impuesto_retenido = to_float(get_attr(retencion, "Importe"), 0.0, tracker, "Retención")
-                clave_impuesto_retenido = get_attr(retencion, "Impuesto") or "N/A"
-
-                total_por_concepto = importe + impuesto_trasladado - impuesto_retenido
-
-                filas_datos.append(
-                    {
-                        "Tipo de Comprobante": tipo_comprobante,
-                        "Folio CFDI (UUID)": uuid,
-                        "Folio CFDI (UUID) Relacionados": "N/A",
-                        "Tipo Relación": tipo_relacion,
-                        "Fecha": fecha,
-                        "RFC Proveedor": rfc_emisor,
-                        "Nombre Proveedor": nombre_emisor,
-                        "Régimen Fiscal Proveedor": regimen_fiscal_emisor,
-                        "CP del Proveedor": cp_proveedor,
-                        "RFC del Cliente": rfc_receptor,
-                        "Nombre del Cliente": nombre_receptor,
-                        "Uso del CFDI": uso_cfdi,
-                        "Método de Pago": metodo_pago,
-                        "Forma de Pago": forma_pago,
-                        "Descripción": descripcion,
-                        "Cantidad": cantidad,
-                        "Unidad": unidad,
-                        "Valor Unitario": valor_unitario,
-                        "Importe": importe,
-                        "Clave Impuesto Trasladado": clave_impuesto_trasladado,
-                        "Impuesto Trasladado": impuesto_trasladado,
-                        "Clave Impuesto Retenido": clave_impuesto_retenido,
-                        "Impuesto Retenido": impuesto_retenido,
-                        "Total por Concepto": total_por_concepto,
-                        "Total General": total_general,
-                        "Versión CFDI": version_cfdi,
-                    }
-                )
+            for concepto, hijos_concepto, impuestos in recorrido.conceptos:
+                fila = comprobante.copy()
+                esquema.llenar("concepto", concepto, fila, hijos_concepto)
+                datos = esquema.como_dict(fila)
+                _sumar_impuestos(datos, impuestos)
+                filas_datos.append(datos)
 
     except Exception as exc:
         tracker.error(f"Error procesando {os.path.basename(xml_file)}: {exc}")
@@ -164,45 +325,518 @@ def extraer_datos_cfdi(xml_file: str, tracker: IssueTracker) -> List[Dict[str, O
     return filas_datos
 
 
-def procesar_archivos_xml_subidos(directorio: str, tracker: IssueTracker) -> Optional[str]:
-    todos_los_datos: List[Dict[str, Optional[str]]] = []
-    archivos = [f for f in os.listdir(directorio) if f.lower().endswith(".xml")]
+def convertir_columnas_numericas(df: pd.DataFrame, tracker: IssueTracker, exact: bool = EXACT_AMOUNTS) -> pd.DataFrame:
+    """Convierte las columnas numéricas crudas en una pasada vectorizada y calcula Total por Concepto."""
+    for columna in COLUMNAS_NUMERICAS:
+        df[columna] = to_numeric_column(df[columna], columna, tracker, exact=exact and columna in COLUMNAS_MONTO)
+
+    total_por_concepto = df["Importe"] + df["Impuesto Trasladado"] - df["Impuesto Retenido"]
+    df.insert(df.columns.get_loc("Total General"), "Total por Concepto", total_por_concepto)
+    return df
+
+
+COLUMNAS_CONCILIACION: List[str] = [
+    "Folio CFDI (UUID) Factura",
+    "Fecha Factura",
+    "RFC Proveedor",
+    "Nombre Proveedor",
+    "Método de Pago",
+    "Total Factura",
+    "Importe Pagado",
+    "Saldo Pendiente",
+    "Número de Pagos",
+    "Folios de Pago",
+    "Estatus",
+]
+
+
+class ConciliacionPagos:
+    """Índice hash de las facturas del lote y los DoctoRelacionado de pagos que apuntan a ellas.
+
+    Se alimenta archivo por archivo durante la extracción; los importes se guardan crudos
+    y se convierten por columna al generar la hoja.
+    """
+
+    def __init__(self) -> None:
+        # UUID en mayúsculas -> (UUID, fecha, RFC, nombre, método de pago, total crudo)
+        self.facturas: Dict[str, Tuple[str, str, str, str, str, Optional[str]]] = {}
+        # (UUID relacionado en mayúsculas, UUID del pago, importe pagado crudo)
+        self.pagos: List[Tuple[str, str, Optional[str]]] = []
+
+    def agregar(self, filas: List[Dict[str, Optional[str]]]) -> None:
+        for fila in filas:
+            uuid = fila["Folio CFDI (UUID)"]
+            if fila["Tipo de Comprobante"] == "P":
+                relacionado = fila["Folio CFDI (UUID) Relacionados"]
+                if relacionado and relacionado != "N/A":
+                    self.pagos.append((relacionado.upper(), uuid, fila.get("_ImpPagado")))
+            elif uuid and uuid != "N/A" and uuid.upper() not in self.facturas:
+                self.facturas[uuid.upper()] = (
+                    uuid,
+                    fila["Fecha"],
+                    fila["RFC Proveedor"],
+                    fila["Nombre Proveedor"],
+                    fila["Método de Pago"],
+                    fila["Total General"],
+                )
 
-    if not archivos:
-        tracker.fatal("No se encontraron archivos XML para procesar.")
+    def tabla(self, tracker: IssueTracker, exact: bool = EXACT_AMOUNTS) -> pd.DataFrame:
+        """Una fila por factura pagada (o PPD) y por factura ajena al lote que recibió pagos."""
+        # Los totales ya se reportaron al convertir la hoja de detalle; aquí no se repiten avisos.
+        totales = dict(
+            zip(self.facturas, to_numeric_column((f[5] for f in self.facturas.values()), "Total General", None, exact=exact))
+        )
+        importes = to_numeric_column((p[2] for p in self.pagos), "ImpPagado", tracker, exact=exact)
+        cero: Any = Decimal(0) if exact else 0.0
+
+        pagado: Dict[str, Any] = {}
+        folios: Dict[str, List[str]] = {}
+        for (relacionado, uuid_pago, _), importe in zip(self.pagos, importes):
+            pagado[relacionado] = pagado.get(relacionado, cero) + importe
+            folios.setdefault(relacionado, []).append(uuid_pago)
+
+        filas: List[Dict[str, Any]] = []
+        for clave, (uuid, fecha, rfc, nombre, metodo, _) in self.facturas.items():
+            if clave not in pagado and metodo != "PPD":
+                continue
+            total = totales[clave]
+            importe_pagado = pagado.get(clave, cero)
+            saldo = total - importe_pagado
+            if clave not in pagado:
+                estatus = "Sin pagos"
+            elif saldo < -TOLERANCIA_SALDO:
+                estatus = "Sobrepago"
+            elif saldo <= TOLERANCIA_SALDO:
+                estatus = "Pagada"
+            else:
+                estatus = "Parcial"
+            filas.append(
+                {
+                    "Folio CFDI (UUID) Factura": uuid,
+                    "Fecha Factura": fecha,
+                    "RFC Proveedor": rfc,
+                    "Nombre Proveedor": nombre,
+                    "Método de Pago": metodo,
+                    "Total Factura": total,
+                    "Importe Pagado": importe_pagado,
+                    "Saldo Pendiente": saldo,
+                    "Número de Pagos": len(folios.get(clave, [])),
+                    "Folios de Pago": ", ".join(dict.fromkeys(folios.get(clave, []))),
+                    "Estatus": estatus,
+                }
+            )
+
+        for clave, importe_pagado in pagado.items():
+            if clave in self.facturas:
+                continue
+            filas.append(
+                {
+                    "Folio CFDI (UUID) Factura": clave,
+                    "Fecha Factura": "N/A",
+                    "RFC Proveedor": "N/A",
+                    "Nombre Proveedor": "N/A",
+                    "Método de Pago": "N/A",
+                    "Total Factura": None,
+                    "Importe Pagado": importe_pagado,
+                    "Saldo Pendiente": None,
+                    "Número de Pagos": len(folios[clave]),
+                    "Folios de Pago": ", ".join(dict.fromkeys(folios[clave])),
+                    "Estatus": "Factura fuera del lote",
+                }
+            )
+        return pd.DataFrame(filas, columns=COLUMNAS_CONCILIACION)
+
+
+# Montos que suman las hojas de resumen y el nombre con que aparecen.
+MONTOS_RESUMEN: Dict[str, str] = {
+    "Importe": "Importe",
+    "Impuesto Trasladado": "Impuesto Trasladado",
+    "Impuesto Retenido": "Impuesto Retenido",
+    "Total por Concepto": "Total",
+}
+
+
+# Claves de agrupación de cada hoja de resumen; las demás columnas son sumables.
+CLAVES_RESUMEN: Dict[str, List[str]] = {
+    "Resumen Proveedor": ["RFC Proveedor", "Nombre Proveedor"],
+    "Resumen Mes": ["Mes"],
+    "Resumen Forma Pago": ["Método de Pago", "Forma de Pago"],
+    "Resumen Impuestos": ["Tipo", "Clave Impuesto"],
+}
+
+
+def _resumir(df: pd.DataFrame, claves: List[str]) -> pd.DataFrame:
+    agregados = {nombre: (columna, "sum") for columna, nombre in MONTOS_RESUMEN.items()}
+    resumen = df.groupby(claves, sort=True, observed=True).agg(
+        Comprobantes=("Folio CFDI (UUID)", "nunique"), Conceptos=("Importe", "size"), **agregados
+    )
+    return resumen.reset_index()
+
+
+def resumenes_gasto(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Tablas que los auditores arman como tablas dinámicas, en una pasada de groupby cada una.
+
+    Solo comprobantes con conceptos; los complementos de pago ya se resumen en Conciliación Pagos.
+    """
+    conceptos = df[df["Tipo de Comprobante"] != "P"].assign(Mes=lambda d: d["Fecha"].astype(str).str.slice(0, 7))
+    return {
+        "Resumen Proveedor": _resumir(conceptos, CLAVES_RESUMEN["Resumen Proveedor"]),
+        "Resumen Mes": _resumir(conceptos, CLAVES_RESUMEN["Resumen Mes"]),
+        "Resumen Forma Pago": _resumir(conceptos, CLAVES_RESUMEN["Resumen Forma Pago"]),
+        "Resumen Impuestos": _resumen_impuestos(conceptos),
+    }
+
+
+def _resumen_impuestos(conceptos: pd.DataFrame, exact: bool = EXACT_AMOUNTS) -> pd.DataFrame:
+    """Un renglón por tipo y clave de impuesto con todos los traslados/retenciones de cada concepto.
+
+    La base es el importe del concepto, contado una vez por clave aunque la clave se repita.
+    """
+    columnas = ["Tipo", "Clave Impuesto", "Conceptos", "Base", "Impuesto"]
+    if "_Impuestos" not in conceptos:
+        return pd.DataFrame(columns=columnas)
+    impuestos = conceptos[["Importe", "_Impuestos"]].explode("_Impuestos").dropna(subset=["_Impuestos"])
+    if impuestos.empty:
+        return pd.DataFrame(columns=columnas)
+    tipo, clave, importe = zip(*impuestos["_Impuestos"])
+    # Los importes inválidos ya se reportaron en la columna de detalle.
+    impuestos = pd.DataFrame(
+        {
+            "Concepto": impuestos.index,
+            "Tipo": pd.Categorical(tipo, ["Trasladado", "Retenido"]),
+            "Clave Impuesto": clave,
+            "Base": impuestos["Importe"].to_numpy(),
+            "Impuesto": to_numeric_column(list(importe), "Importe de impuesto", None, exact=exact),
+        }
+    )
+    por_concepto = impuestos.groupby(["Tipo", "Clave Impuesto", "Concepto"], sort=False, observed=True).agg(
+        Base=("Base", "first"), Impuesto=("Impuesto", "sum")
+    )
+    tabla = por_concepto.groupby(["Tipo", "Clave Impuesto"], sort=True, observed=True).agg(
+        Conceptos=("Base", "size"), Base=("Base", "sum"), Impuesto=("Impuesto", "sum")
+    )
+    tabla = tabla.reset_index()
+    tabla["Tipo"] = tabla["Tipo"].astype(str)
+    return tabla[columnas]
+
+
+def combinar_resumenes(partes: List[Dict[str, pd.DataFrame]]) -> Dict[str, pd.DataFrame]:
+    """Suma los resúmenes de partes del lote sin comprobantes en común (Comprobantes también es sumable)."""
+    combinados: Dict[str, pd.DataFrame] = {}
+    for hoja, claves in CLAVES_RESUMEN.items():
+        tabla = pd.concat([parte[hoja] for parte in partes], ignore_index=True)
+        if hoja == "Resumen Impuestos":
+            # Trasladados antes que retenidos, como en resumenes_gasto.
+            tabla["Tipo"] = pd.Categorical(tabla["Tipo"], ["Trasladado", "Retenido"])
+        combinado = tabla.groupby(claves, sort=True, observed=True).sum().reset_index()
+        if hoja == "Resumen Impuestos":
+            combinado["Tipo"] = combinado["Tipo"].astype(str)
+            combinado = combinado[["Tipo", "Clave Impuesto", "Conceptos", "Base", "Impuesto"]]
+        combinados[hoja] = combinado
+    return combinados
+
+
+def auditar_lote(df: pd.DataFrame, tracker: IssueTracker, exact: bool = EXACT_AMOUNTS) -> pd.DataFrame:
+    """Excepciones del lote: Total General contra la suma de sus conceptos y UUID repetidos entre archivos."""
+    comprobantes = df[(df["Tipo de Comprobante"] != "P") & (df["Folio CFDI (UUID)"] != "N/A")]
+    neto = comprobantes["Total por Concepto"]
+    if "_Descuento" in comprobantes:
+        descuentos = to_numeric_column(comprobantes["_Descuento"].tolist(), "Descuento", tracker, exact=exact)
+        neto = neto - pd.Series(descuentos, index=comprobantes.index)
+    grupos = (
+        comprobantes.assign(_Neto=neto)
+        .groupby(["Folio CFDI (UUID)", "_Archivo"], sort=False, observed=True)
+        .agg(declarado=("Total General", "first"), calculado=("_Neto", "sum"), partidas=("_Neto", "size"))
+        .reset_index()
+    )
+    return unir_excepciones(
+        [
+            diferencias_de_total(
+                REGLA_TOTAL_CONCEPTOS,
+                grupos["Folio CFDI (UUID)"],
+                grupos["_Archivo"],
+                grupos["declarado"],
+                grupos["calculado"],
+                grupos["partidas"],
+            ),
+            uuids_duplicados(df["Folio CFDI (UUID)"], df["_Archivo"]),
+        ]
+    )
+
+
+def _cruzar_indice(indice: IndiceLotes, df: pd.DataFrame, lote: str) -> pd.DataFrame:
+    """Comprobantes cuyo UUID el índice ya tenía de otro lote; los nuevos quedan registrados."""
+    documentos = df[["Folio CFDI (UUID)", "_Archivo"]].astype(str).drop_duplicates()
+    vistos = indice.revisar_uuids(zip(documentos["Folio CFDI (UUID)"], documentos["_Archivo"]), lote)
+    return excepciones_de_indice(
+        REGLA_UUID_OTRO_LOTE,
+        [(uuid, archivo, f"Visto antes en el lote {lote_previo} ({archivo_previo})") for uuid, archivo, lote_previo, archivo_previo in vistos],
+    )
+
+
+def revisar_indice(df: pd.DataFrame, directorio: str, tracker: IssueTracker) -> Optional[pd.DataFrame]:
+    """Cruza el lote con el índice de XML_INDICE_DB, si está configurado."""
+    indice = open_indice(tracker)
+    if indice is None:
         return None
+    try:
+        return _cruzar_indice(indice, df, lote_de(directorio))
+    except Exception as exc:
+        tracker.error(f"No se pudo consultar el índice entre lotes: {exc}")
+        return None
+    finally:
+        indice.close()
+
+
+def _cargar_gasto(store, df: pd.DataFrame, lote: str) -> int:
+    if "_ImpPagado" in df:
+        df = df.assign(_ImpPagado=pd.to_numeric(df["_ImpPagado"], errors="coerce"))
+    return store.cargar_gasto(df, lote)
+
+
+def cargar_en_almacen(df: pd.DataFrame, directorio: str, tracker: IssueTracker) -> None:
+    """Carga el lote en la base SQLite de XML_SQLITE_DB, si está configurada."""
+    store = open_store(tracker)
+    if store is None:
+        return
+    try:
+        cargados = _cargar_gasto(store, df, lote_de(directorio))
+        print_progress(f"Almacén SQLite: {cargados} comprobante(s) cargados en {store.path}")
+    except Exception as exc:
+        tracker.error(f"No se pudo cargar el lote en SQLite: {exc}")
+    finally:
+        store.close()
+
+
+def procesar_entrada(entrada: XmlEntry, contenido: Optional[XmlBuffer], tracker: IssueTracker) -> List[Dict[str, Optional[str]]]:
+    """Filas de un archivo del lote, marcadas con su ruta relativa."""
+    filas = extraer_datos_cfdi(entrada.path, tracker, contenido)
+    for fila in filas:
+        fila["_Archivo"] = entrada.relpath
+    return filas
 
-    for filename in archivos:
-        ruta_archivo = os.path.join(directorio, filename)
-        filas = extraer_datos_cfdi(ruta_archivo, tracker)
+
+def escribir_resultados(
+    directorio: str,
+    registros: Iterable[List[Dict[str, Optional[str]]]],
+    tracker: IssueTracker,
+    progreso: ProgressReporter,
+) -> Optional[str]:
+    """Arma y escribe el libro a partir de las filas de cada archivo, en orden de lote.
+
+    Devuelve None si no hubo datos; los errores al escribir se propagan.
+    """
+    if memoria_acotada():
+        return _escribir_resultados_por_bloques(directorio, registros, tracker, progreso)
+
+    todos_los_datos: List[Dict[str, Optional[str]]] = []
+    conciliacion = ConciliacionPagos()
+    for filas in registros:
         if filas:
             todos_los_datos.extend(filas)
+            conciliacion.agregar(filas)
 
     if not todos_los_datos:
         tracker.error("No se generaron datos procesables de los XML.")
         return None
 
+    progreso.stage("conversion")
+    df = convertir_columnas_numericas(pd.DataFrame(todos_los_datos), tracker)
+    df = df.astype({columna: "category" for columna in COLUMNAS_CATEGORICAS})
+    df_conciliacion = conciliacion.tabla(tracker)
+    df_excepciones = unir_excepciones([auditar_lote(df, tracker), revisar_indice(df, directorio, tracker)])
+    reportar_excepciones(tracker, df_excepciones)
+    df_resumenes = resumenes_gasto(df)
+    progreso.stage("almacen")
+    cargar_en_almacen(df, directorio, tracker)
+    df = df.drop(columns=COLUMNAS_INTERNAS, errors="ignore")
+    archivo_salida = os.path.join(directorio, "cfdi_datos_extraidos.xlsx")
+    progreso.stage("excel")
+    with ShardedWorkbook(archivo_salida) as libro:
+        libro.write_frame("Sheet1", df)
+        for hoja, resumen in df_resumenes.items():
+            if not resumen.empty:
+                libro.write_frame(hoja, resumen)
+        if not df_conciliacion.empty:
+            libro.write_frame("Conciliación Pagos", df_conciliacion)
+        if not df_excepciones.empty:
+            libro.write_frame(HOJA_EXCEPCIONES, df_excepciones)
+        archivos = libro.close()
+    if len(archivos) > 1:
+        print_progress(f"Salida dividida en {len(archivos)} archivos; ver {manifest_path(archivo_salida)}")
+    return archivo_salida
+
+
+def _escribir_resultados_por_bloques(
+    directorio: str,
+    registros: Iterable[List[Dict[str, Optional[str]]]],
+    tracker: IssueTracker,
+    progreso: ProgressReporter,
+) -> Optional[str]:
+    """escribir_resultados con memoria acotada (XML_MEMORIA_MB).
+
+    Sheet1 se escribe por bloques conforme llegan las filas. Cada bloque convertido se vuelca a
+    disco ordenado por UUID, y auditoría, resúmenes y almacén se calculan sobre la mezcla externa
+    en lotes que nunca parten un UUID. Las excepciones de cada regla salen en orden de UUID.
+    """
+    archivo_salida = os.path.join(directorio, "cfdi_datos_extraidos.xlsx")
+    conciliacion = ConciliacionPagos()
+    libro: Optional[ShardedWorkbook] = None
+    detalle = None
+    columnas: List[str] = []
+    visibles: List[str] = []
+    secuencia = 0
+
     try:
-        df = pd.DataFrame(todos_los_datos)
-        archivo_salida = os.path.join(directorio, "cfdi_datos_extraidos.xlsx")
-        df.to_excel(archivo_salida, index=False)
-        return archivo_salida
+        with CorridasOrdenadas("gasto") as corridas:
+            for bloque in en_bloques(registros, len):
+                filas = [fila for filas_archivo in bloque for fila in filas_archivo]
+                for filas_archivo in bloque:
+                    if filas_archivo:
+                        conciliacion.agregar(filas_archivo)
+                if not filas:
+                    continue
+                progreso.stage("conversion")
+                df = convertir_columnas_numericas(pd.DataFrame(filas), tracker)
+                del filas, bloque
+                for columna in COLUMNAS_INTERNAS:
+                    if columna not in df:
+                        df[columna] = None
+                if libro is None:
+                    columnas = list(df.columns)
+                    visibles = [columna for columna in columnas if columna not in COLUMNAS_INTERNAS]
+                    libro = ShardedWorkbook(archivo_salida)
+                    detalle = libro.add_sheet("Sheet1", visibles)
+                progreso.stage("excel")
+                detalle.append_frame(df[visibles])
+                claves = df["Folio CFDI (UUID)"].astype(str).str.upper().tolist()
+                for clave, fila in zip(claves, df[columnas].itertuples(index=False, name=None)):
+                    corridas.agregar((clave, secuencia), fila)
+                    secuencia += 1
+                corridas.volcar()
+
+            if libro is None:
+                tracker.error("No se generaron datos procesables de los XML.")
+                return None
+            detalle.close()
+            print_progress(
+                f"Memoria acotada: {secuencia} fila(s) en {len(corridas.archivos)} corrida(s) en disco; "
+                f"RSS {rss_bytes() // (1024 * 1024)} MB"
+            )
+
+            progreso.stage("auditoria")
+            partes_excepciones: List[pd.DataFrame] = []
+            partes_resumen: List[Dict[str, pd.DataFrame]] = []
+            store = open_store(tracker)
+            indice = open_indice(tracker)
+            lote = lote_de(directorio)
+            cargados = 0
+            try:
+                for valores in por_grupos(corridas.mezclar(), itemgetter(0)):
+                    df = pd.DataFrame(valores, columns=columnas)
+                    df = df.astype({columna: "category" for columna in COLUMNAS_CATEGORICAS})
+                    partes_excepciones.append(auditar_lote(df, tracker))
+                    if indice is not None:
+                        try:
+                            partes_excepciones.append(_cruzar_indice(indice, df, lote))
+                        except Exception as exc:
+                            tracker.error(f"No se pudo consultar el índice entre lotes: {exc}")
+                            indice.close()
+                            indice = None
+                    partes_resumen.append(resumenes_gasto(df))
+                    if store is not None:
+                        try:
+                            cargados += _cargar_gasto(store, df, lote)
+                        except Exception as exc:
+                            tracker.error(f"No se pudo cargar el lote en SQLite: {exc}")
+                            store.close()
+                            store = None
+                if store is not None:
+                    print_progress(f"Almacén SQLite: {cargados} comprobante(s) cargados en {store.path}")
+            finally:
+                if store is not None:
+                    store.close()
+                if indice is not None:
+                    indice.close()
+
+        df_excepciones = ordenar_por_regla(
+            unir_excepciones(partes_excepciones), [REGLA_TOTAL_CONCEPTOS, REGLA_UUID_DUPLICADO, REGLA_UUID_OTRO_LOTE]
+        )
+        reportar_excepciones(tracker, df_excepciones)
+        df_conciliacion = conciliacion.tabla(tracker)
+        progreso.stage("excel")
+        for hoja, resumen in combinar_resumenes(partes_resumen).items():
+            if not resumen.empty:
+                libro.write_frame(hoja, resumen)
+        if not df_conciliacion.empty:
+            libro.write_frame("Conciliación Pagos", df_conciliacion)
+        if not df_excepciones.empty:
+            libro.write_frame(HOJA_EXCEPCIONES, df_excepciones)
+        archivos = libro.close()
+    except BaseException:
+        # El libro se crea con el primer bloque; si algo falla después, sus hojas se sueltan.
+        if libro is not None:
+            libro.discard()
+        raise
+    if len(archivos) > 1:
+        print_progress(f"Salida dividida en {len(archivos)} archivos; ver {manifest_path(archivo_salida)}")
+    return archivo_salida
+
+
+def procesar_archivos_xml_subidos(
+    directorio: str, tracker: IssueTracker, progreso: Optional[ProgressReporter] = None
+) -> Optional[str]:
+    progreso = progreso or ProgressReporter("extractor_xml", None)
+    checkpoint = open_checkpoint(directorio, "extractor_xml", tracker)
+    progreso.restore(len(checkpoint.processed))
+    progreso.count_in_background(directorio)
+    progreso.stage("lectura")
+    entradas = checkpoint.pending(progreso.discover(iter_xml_files(directorio, order="name")))
+    for entrada, contenido in prefetch_xml_files(entradas):
+        filas = procesar_entrada(entrada, contenido, tracker)
+        checkpoint.add(entrada.relpath, filas, tracker)
+        progreso.advance(1, entrada.size, len(filas))
+
+    if not checkpoint.seen:
+        tracker.fatal("No se encontraron archivos XML para procesar.")
+        finish_checkpoint(checkpoint, True, tracker)
+        return None
+
+    checkpoint.end_reading(tracker)
+    try:
+        archivo_salida = escribir_resultados(directorio, checkpoint.records(), tracker, progreso)
     except Exception as exc:
         tracker.fatal(f"No se pudo generar el archivo Excel: {exc}")
+        finish_checkpoint(checkpoint, False, tracker)
         return None
 
+    finish_checkpoint(checkpoint, True, tracker)
+    return archivo_salida
+
 
 if __name__ == "__main__":
     tracker = IssueTracker()
 
-    if len(sys.argv) <= 1:
+    argumentos, preview = split_preview_flag(sys.argv[1:])
+    argumentos, vigilar_carpeta = split_watch_flag(argumentos)
+    if not argumentos:
         print("ERROR: No se proporcionó directorio", file=sys.stderr)
         sys.exit(2)
 
-    directorio = sys.argv[1]
-    excel_path = procesar_archivos_xml_subidos(directorio, tracker)
+    directorio = argumentos[0]
+    if preview:
+        sys.exit(run_preview(directorio, "extractor_xml"))
+    if vigilar_carpeta:
+        sys.exit(vigilar(directorio, "extractor_xml"))
 
-    tracker.report("CFDI")
+    progreso = open_progress(directorio, "extractor_xml")
+    codigo_salida = 2
+    try:
+        excel_path = procesar_archivos_xml_subidos(directorio, tracker, progreso)
+        tracker.report("CFDI")
+        codigo_salida = tracker.exit_code
+    finally:
+        progreso.finish(codigo_salida)
 
     if excel_path and tracker.exit_code == 0:
         print(excel_path)
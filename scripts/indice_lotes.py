@@ -0,0 +1,229 @@
+"""Índice persistente entre lotes para detectar UUID y periodos de nómina ya vistos en otra carga.
+
+Dos tablas SQLite WITHOUT ROWID (ordenadas en disco por su llave):
+    uuids     UUID -> lote y archivo donde se vio por primera vez
+    periodos  (CURP, FechaInicialPago, FechaFinalPago) -> UUID del recibo, lote y archivo
+
+Delante de cada tabla va un filtro de Bloom en memoria: una llave que el filtro no contiene no
+se busca en disco, así que un lote sin duplicados casi no hace consultas. Los filtros se guardan
+en la misma base al cerrar y se reconstruyen si el número de llaves ya no coincide (otra
+herramienta escribió en la base) o se llenaron.
+
+Se habilita con XML_INDICE_DB; el lote es el de cfdi_store.lote_de (XML_LOTE_ID o el nombre del
+directorio). Volver a procesar el mismo lote no marca nada.
+"""
+
+import hashlib
+import math
+import os
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from xml_utils import IssueTracker, env_float, env_int
+
+# Tasa de falsos positivos del filtro a su capacidad; un falso positivo solo cuesta una consulta.
+BLOOM_TASA = env_float("XML_INDICE_BLOOM_TASA", 0.01)
+# Llaves nuevas que caben en el filtro además de las que ya tiene la base.
+BLOOM_MARGEN = env_int("XML_INDICE_BLOOM_MARGEN", 1_000_000)
+# Llaves por consulta IN (...) al confirmar candidatos.
+LOTE_CONSULTA = 500
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS uuids (
+    uuid TEXT PRIMARY KEY,
+    lote TEXT,
+    archivo TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS periodos (
+    curp TEXT,
+    inicio TEXT,
+    fin TEXT,
+    uuid TEXT,
+    lote TEXT,
+    archivo TEXT,
+    PRIMARY KEY (curp, inicio, fin)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS filtros (
+    tabla TEXT PRIMARY KEY,
+    llaves INTEGER,
+    capacidad INTEGER,
+    funciones INTEGER,
+    bits BLOB
+);
+"""
+
+
+class FiltroBloom:
+    """Filtro de Bloom sobre un bytearray con doble hash (blake2b de 128 bits)."""
+
+    def __init__(self, capacidad: int, tasa: float = BLOOM_TASA, bits: Optional[bytes] = None, funciones: int = 0) -> None:
+        self.capacidad = max(capacidad, 1)
+        if bits is None:
+            total = max(int(-self.capacidad * math.log(tasa) / (math.log(2) ** 2)), 64)
+            self.bits = bytearray((total + 7) // 8)
+            self.funciones = max(round(total / self.capacidad * math.log(2)), 1)
+        else:
+            self.bits = bytearray(bits)
+            self.funciones = funciones
+        self.tamano = len(self.bits) * 8
+        self.llaves = 0
+
+    def _posiciones(self, llave: str) -> Iterator[int]:
+        digest = hashlib.blake2b(llave.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.tamano for i in range(self.funciones))
+
+    def agregar(self, llave: str) -> None:
+        for posicion in self._posiciones(llave):
+            self.bits[posicion >> 3] |= 1 << (posicion & 7)
+        self.llaves += 1
+
+    def __contains__(self, llave: str) -> bool:
+        return all(self.bits[posicion >> 3] & (1 << (posicion & 7)) for posicion in self._posiciones(llave))
+
+    @property
+    def lleno(self) -> bool:
+        return self.llaves > self.capacidad
+
+
+# tabla -> (columnas de la llave, SELECT que produce la llave del filtro: las columnas unidas por '|')
+_LLAVES: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    "uuids": (("uuid",), "SELECT uuid FROM uuids"),
+    "periodos": (("curp", "inicio", "fin"), "SELECT curp || '|' || inicio || '|' || fin FROM periodos"),
+}
+
+
+class IndiceLotes:
+    """Base del índice con un filtro de Bloom por tabla."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(ESQUEMA)
+        self._modificados: set = set()
+        self.filtros: Dict[str, FiltroBloom] = {tabla: self._abrir_filtro(tabla) for tabla in _LLAVES}
+
+    def _contar(self, tabla: str) -> int:
+        return self.conn.execute(f"SELECT count(*) FROM {tabla}").fetchone()[0]
+
+    def _abrir_filtro(self, tabla: str) -> FiltroBloom:
+        llaves = self._contar(tabla)
+        guardado = self.conn.execute(
+            "SELECT llaves, capacidad, funciones, bits FROM filtros WHERE tabla = ?", (tabla,)
+        ).fetchone()
+        if guardado is not None and guardado[0] == llaves and llaves + BLOOM_MARGEN // 2 <= guardado[1]:
+            filtro = FiltroBloom(guardado[1], bits=guardado[3], funciones=guardado[2])
+            filtro.llaves = llaves
+            return filtro
+        return self._reconstruir(tabla, llaves)
+
+    def _reconstruir(self, tabla: str, llaves: int) -> FiltroBloom:
+        filtro = FiltroBloom(llaves + BLOOM_MARGEN)
+        for (llave,) in self.conn.execute(_LLAVES[tabla][1]):
+            filtro.agregar(llave)
+        self._modificados.add(tabla)
+        return filtro
+
+    def _buscar(self, tabla: str, columnas: Sequence[str], llaves: List[Tuple[str, ...]]) -> Dict[Tuple[str, ...], Tuple[str, ...]]:
+        """Filas existentes para las llaves dadas (solo las que pasaron el filtro)."""
+        encontrados: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        ancho = len(columnas)
+        for inicio in range(0, len(llaves), LOTE_CONSULTA):
+            grupo = llaves[inicio : inicio + LOTE_CONSULTA]
+            if ancho == 1:
+                sql = f"SELECT * FROM {tabla} WHERE {columnas[0]} IN ({', '.join('?' for _ in grupo)})"
+            else:
+                fila = "(" + ", ".join("?" * ancho) + ")"
+                sql = f"SELECT * FROM {tabla} WHERE ({', '.join(columnas)}) IN (VALUES {', '.join(fila for _ in grupo)})"
+            for fila in self.conn.execute(sql, [valor for llave in grupo for valor in llave]):
+                encontrados[tuple(fila[:ancho])] = tuple(fila[ancho:])
+        return encontrados
+
+    def _revisar(
+        self, tabla: str, registros: List[Tuple[Tuple[str, ...], Tuple[str, ...]]], lote: str
+    ) -> List[Tuple[int, Tuple[str, ...]]]:
+        """(posición, fila previa) de los registros vistos en otro lote; registra los nuevos con `lote`."""
+        columnas = _LLAVES[tabla][0]
+        filtro = self.filtros[tabla]
+        candidatos = list({llave for llave, _ in registros if "|".join(llave) in filtro})
+        previos = self._buscar(tabla, columnas, candidatos) if candidatos else {}
+
+        vistos: List[Tuple[int, Tuple[str, ...]]] = []
+        nuevos: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        for posicion, (llave, datos) in enumerate(registros):
+            previo = previos.get(llave)
+            if previo is None:
+                nuevos.setdefault(llave, datos)
+            elif previo[-2] != lote:
+                vistos.append((posicion, previo))
+        if nuevos:
+            marcadores = ", ".join("?" * (len(columnas) + len(next(iter(nuevos.values())))))
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT OR IGNORE INTO {tabla} VALUES ({marcadores})", [llave + datos for llave, datos in nuevos.items()]
+                )
+            for llave in nuevos:
+                filtro.agregar("|".join(llave))
+            self._modificados.add(tabla)
+        return vistos
+
+    def revisar_uuids(self, documentos: Iterable[Tuple[str, str]], lote: str) -> List[Tuple[str, str, str, str]]:
+        """(uuid, archivo, lote previo, archivo previo) de cada documento cuyo UUID ya estaba en otro lote."""
+        documentos = [(uuid, archivo) for uuid, archivo in documentos if uuid and uuid != "N/A"]
+        registros = [((uuid.strip().upper(),), (lote, archivo)) for uuid, archivo in documentos]
+        return [(*documentos[posicion], *previo) for posicion, previo in self._revisar("uuids", registros, lote)]
+
+    def revisar_periodos(
+        self, recibos: Iterable[Tuple[str, str, str, str, str]], lote: str, uuids_vistos: Iterable[str] = ()
+    ) -> List[Tuple[str, str, str, str, str, str, str, str]]:
+        """Recibos (curp, inicio, fin, uuid, archivo) cuyo periodo ya se pagó al mismo CURP en otro lote.
+
+        Devuelve (uuid, archivo, curp, inicio, fin, uuid previo, lote previo, archivo previo). No se
+        repiten aquí los recibos que ya salen como UUID de otro lote: los de `uuids_vistos` (lo que
+        devolvió revisar_uuids) y los que tienen el mismo UUID que el previo. Así un lote que se
+        vuelve a subir no reporta otra vez sus propios traslapes internos.
+        """
+        omitir = {str(uuid).strip().upper() for uuid in uuids_vistos}
+        registros = [
+            ((curp.strip().upper(), inicio[:10], fin[:10]), (uuid, lote, archivo))
+            for curp, inicio, fin, uuid, archivo in recibos
+            if curp and inicio and fin
+        ]
+        vistos = []
+        for posicion, previo in self._revisar("periodos", registros, lote):
+            (curp, inicio, fin), (uuid, _, archivo) = registros[posicion]
+            if str(uuid).strip().upper() not in omitir and str(uuid).upper() != str(previo[0]).upper():
+                vistos.append((uuid, archivo, curp, inicio, fin, *previo))
+        return vistos
+
+    def close(self) -> None:
+        """Guarda los filtros modificados junto con el número de llaves que representan."""
+        try:
+            with self.conn:
+                for tabla in self._modificados:
+                    filtro = self.filtros[tabla]
+                    if filtro.lleno:
+                        continue
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO filtros VALUES (?, ?, ?, ?, ?)",
+                        (tabla, self._contar(tabla), filtro.capacidad, filtro.funciones, bytes(filtro.bits)),
+                    )
+        finally:
+            self.conn.close()
+
+
+def open_indice(tracker: IssueTracker, path: Optional[str] = None) -> Optional[IndiceLotes]:
+    """Abre el índice de XML_INDICE_DB; None si no está habilitado."""
+    path = path or os.environ.get("XML_INDICE_DB")
+    if not path:
+        return None
+    try:
+        return IndiceLotes(path)
+    except Exception as exc:
+        tracker.error(f"No se pudo abrir el índice entre lotes '{path}': {exc}")
+        return None
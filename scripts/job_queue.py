@@ -0,0 +1,419 @@
+"""Modo distribuido: cola de unidades de trabajo con lease sobre un sistema de archivos compartido.
+
+Uso:
+    job_queue.py preparar <trabajo> <workdir>   # coordinador: particiona el lote en unidades
+    job_queue.py trabajar <trabajo> <workdir>   # cualquier número de procesos o servidores
+    job_queue.py combinar <trabajo> <workdir>   # genera los mismos archivos que el modo normal
+    job_queue.py estado <trabajo> <workdir>
+
+La cola vive en `<workdir>/.cola_<trabajo>/`. Las unidades guardan rutas relativas, así que cada
+servidor puede montar el almacenamiento en otra ruta. Un lease es un archivo creado con O_EXCL
+que el trabajador renueva mientras procesa; si expira (el proceso o el servidor murió), otro
+trabajador toma la unidad y suma un intento. Los relojes de los servidores deben estar sincronizados.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import socket
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from progress_utils import open_progress
+from xml_utils import (
+    IssueTracker,
+    XmlEntry,
+    env_float,
+    env_int,
+    iter_xml_files,
+    prefetch_xml_files,
+    print_progress,
+)
+
+TRABAJOS = ("extractor_xml", "extractor_nomina", "validador_xml", "clasificador_xml")
+
+# Una unidad se cierra al llegar a cualquiera de los dos límites.
+UNIDAD_ARCHIVOS = env_int("XML_UNIDAD_ARCHIVOS", 500)
+UNIDAD_BYTES = env_int("XML_UNIDAD_BYTES", 256 * 1024 * 1024)
+LEASE_SEGUNDOS = env_float("XML_LEASE_SEGUNDOS", 300.0)
+MAX_INTENTOS = env_int("XML_UNIDAD_INTENTOS", 3)
+# Pausa entre revisiones cuando solo quedan unidades tomadas por otros trabajadores.
+ESPERA_SEGUNDOS = env_float("XML_COLA_ESPERA", 5.0)
+
+
+class LeasePerdido(Exception):
+    """Otro trabajador tomó la unidad porque el lease expiró."""
+
+
+def _escribir_json(path: str, data: Dict[str, Any]) -> None:
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as handle:
+        json.dump(data, handle, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _leer_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _estado_tracker(tracker: IssueTracker) -> Dict[str, Any]:
+    return {"warnings": tracker.warnings, "errors": tracker.errors, "fatals": tracker.fatals, "counters": tracker.counters}
+
+
+class ColaTrabajo:
+    def __init__(self, workdir: str, job: str) -> None:
+        self.workdir = workdir
+        self.job = job
+        self.directorio = os.path.join(workdir, f".cola_{job}")
+        self.meta_path = os.path.join(self.directorio, "cola.json")
+
+    def _ruta(self, carpeta: str, numero: int, extension: str) -> str:
+        return os.path.join(self.directorio, carpeta, f"{numero:05d}.{extension}")
+
+    def unidades(self) -> int:
+        meta = _leer_json(self.meta_path)
+        return int(meta["unidades"]) if meta else 0
+
+    def existe(self) -> bool:
+        return os.path.exists(self.meta_path)
+
+    def terminada(self, numero: int) -> bool:
+        return os.path.exists(self._ruta("parciales", numero, "pkl"))
+
+    def fallida(self, numero: int) -> bool:
+        return os.path.exists(self._ruta("fallidas", numero, "json"))
+
+    # --- coordinador -------------------------------------------------------------------------
+
+    def preparar(self) -> Dict[str, int]:
+        """Particiona el lote en unidades en orden de descubrimiento, el mismo del modo normal."""
+        for carpeta in ("unidades", "leases", "parciales", "fallidas"):
+            os.makedirs(os.path.join(self.directorio, carpeta), exist_ok=True)
+        numero = 0
+        archivos = 0
+        actual: List[List[Any]] = []
+        bytes_actual = 0
+        for entrada in iter_xml_files(self.workdir, order="name"):
+            if actual and (len(actual) >= UNIDAD_ARCHIVOS or bytes_actual + entrada.size > UNIDAD_BYTES):
+                numero += 1
+                _escribir_json(self._ruta("unidades", numero, "json"), {"archivos": actual})
+                actual, bytes_actual = [], 0
+            actual.append([entrada.relpath, entrada.size])
+            bytes_actual += entrada.size
+            archivos += 1
+        if actual:
+            numero += 1
+            _escribir_json(self._ruta("unidades", numero, "json"), {"archivos": actual})
+        # cola.json se escribe al final: los trabajadores no empiezan con una partición a medias.
+        _escribir_json(self.meta_path, {"trabajo": self.job, "unidades": numero, "archivos": archivos, "creada": time.time()})
+        return {"unidades": numero, "archivos": archivos}
+
+    def estado(self) -> Dict[str, int]:
+        total = self.unidades()
+        terminadas = sum(1 for numero in range(1, total + 1) if self.terminada(numero))
+        fallidas = sum(1 for numero in range(1, total + 1) if self.fallida(numero))
+        ahora = time.time()
+        en_proceso = 0
+        for numero in range(1, total + 1):
+            lease = _leer_json(self._ruta("leases", numero, "json"))
+            if lease and lease.get("expira", 0) > ahora and not self.terminada(numero):
+                en_proceso += 1
+        return {
+            "unidades": total,
+            "terminadas": terminadas,
+            "fallidas": fallidas,
+            "en_proceso": en_proceso,
+            "pendientes": total - terminadas - fallidas - en_proceso,
+        }
+
+    # --- trabajador --------------------------------------------------------------------------
+
+    def reclamar(self, numero: int, trabajador: str) -> Optional[Dict[str, Any]]:
+        """Toma la unidad si está libre o su lease expiró; None si otro la tiene."""
+        path = self._ruta("leases", numero, "json")
+        ahora = time.time()
+        lease = {"trabajador": trabajador, "token": uuid.uuid4().hex, "expira": ahora + LEASE_SEGUNDOS, "intentos": 1}
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            actual = _leer_json(path)
+            if actual is None:
+                # Recién creado y aún sin contenido, o basura de un proceso muerto: decide la antigüedad.
+                try:
+                    if ahora - os.path.getmtime(path) < LEASE_SEGUNDOS:
+                        return None
+                except OSError:
+                    return None
+                actual = {}
+            elif actual.get("expira", 0) > ahora:
+                return None
+            intentos = int(actual.get("intentos", 0))
+            if intentos >= MAX_INTENTOS:
+                _escribir_json(self._ruta("fallidas", numero, "json"), actual)
+                return None
+            lease["intentos"] = intentos + 1
+            # Dos trabajadores pueden ver el mismo lease vencido: la toma de cada intento es un
+            # archivo aparte creado con O_EXCL, así que solo uno la gana y los demás se retiran.
+            try:
+                os.close(os.open(f"{path}.{lease['intentos']}", os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            except FileExistsError:
+                return None
+            _escribir_json(path, lease)
+            return lease
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            json.dump(lease, handle)
+        return lease
+
+    def renovar(self, numero: int, lease: Dict[str, Any]) -> None:
+        path = self._ruta("leases", numero, "json")
+        if (_leer_json(path) or {}).get("token") != lease["token"]:
+            raise LeasePerdido(f"unidad {numero}")
+        lease["expira"] = time.time() + LEASE_SEGUNDOS
+        _escribir_json(path, lease)
+
+    def liberar(self, numero: int, lease: Dict[str, Any], error: Optional[str] = None) -> None:
+        """Sin error borra el lease; con error lo deja vencido para que otro reintente."""
+        path = self._ruta("leases", numero, "json")
+        if (_leer_json(path) or {}).get("token") != lease["token"]:
+            return
+        if error is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        lease = dict(lease, expira=0, ultimo_error=error)
+        _escribir_json(path, lease)
+        if lease["intentos"] >= MAX_INTENTOS:
+            _escribir_json(self._ruta("fallidas", numero, "json"), lease)
+
+    def entradas(self, numero: int) -> List[XmlEntry]:
+        unidad = _leer_json(self._ruta("unidades", numero, "json")) or {"archivos": []}
+        return [XmlEntry(os.path.join(self.workdir, relpath), relpath, size) for relpath, size in unidad["archivos"]]
+
+    def guardar_parcial(self, numero: int, trabajador: str, registros: List[Any], tracker: IssueTracker) -> None:
+        path = self._ruta("parciales", numero, "pkl")
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as handle:
+            pickle.dump(
+                {"unidad": numero, "trabajador": trabajador, "registros": registros, "tracker": _estado_tracker(tracker)},
+                handle,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp, path)
+
+    def parciales(self, tracker: IssueTracker) -> Iterator[Any]:
+        """Registros de todas las unidades en orden; vuelca en `tracker` lo que cada una reportó."""
+        for numero in range(1, self.unidades() + 1):
+            if not self.terminada(numero):
+                continue
+            with open(self._ruta("parciales", numero, "pkl"), "rb") as handle:
+                parcial = pickle.load(handle)
+            guardado = parcial["tracker"]
+            tracker.warnings.extend(guardado["warnings"])
+            tracker.errors.extend(guardado["errors"])
+            tracker.fatals.extend(guardado["fatals"])
+            for clave, valor in guardado["counters"].items():
+                tracker.count(clave, valor)
+            yield from parcial["registros"]
+
+    def limpiar(self) -> None:
+        shutil.rmtree(self.directorio, ignore_errors=True)
+
+
+def _procesador(job: str, workdir: str) -> Callable[[XmlEntry, Any, IssueTracker], Any]:
+    """La función por archivo del modo normal; su resultado es el mismo registro del checkpoint."""
+    if job == "extractor_xml":
+        from extractor_xml import procesar_entrada
+
+        return procesar_entrada
+    if job == "extractor_nomina":
+        from extractor_nomina import _procesar_recibo
+
+        return lambda entrada, contenido, tracker: _procesar_recibo(entrada.path, entrada.relpath, tracker, contenido)
+    if job == "validador_xml":
+        from validador_xml import validar_archivo
+
+        return lambda entrada, contenido, tracker: validar_archivo(entrada.path, tracker, entrada.relpath, contenido)
+    from clasificador_xml import clasificar_archivo, crear_carpetas
+
+    crear_carpetas(workdir)
+    return lambda entrada, contenido, tracker: clasificar_archivo(workdir, entrada, contenido, tracker)
+
+
+def trabajar(cola: ColaTrabajo, trabajador: str, esperar: bool = True) -> int:
+    """Procesa unidades hasta que no quede ninguna pendiente; devuelve cuántas procesó."""
+    procesar = _procesador(cola.job, cola.workdir)
+    procesadas = 0
+    total = cola.unidades()
+    while True:
+        pendientes = False
+        avance = False
+        for numero in range(1, total + 1):
+            if cola.terminada(numero) or cola.fallida(numero):
+                continue
+            pendientes = True
+            lease = cola.reclamar(numero, trabajador)
+            if lease is None:
+                continue
+            if cola.terminada(numero):
+                cola.liberar(numero, lease)
+                continue
+            avance = True
+            print_progress(f"[{trabajador}] Unidad {numero}/{total} (intento {lease['intentos']})")
+            tracker = IssueTracker()
+            try:
+                registros = []
+                renovar_en = time.time() + LEASE_SEGUNDOS / 3
+                for entrada, contenido in prefetch_xml_files(cola.entradas(numero)):
+                    registros.append(procesar(entrada, contenido, tracker))
+                    if time.time() >= renovar_en:
+                        cola.renovar(numero, lease)
+                        renovar_en = time.time() + LEASE_SEGUNDOS / 3
+                cola.renovar(numero, lease)
+                cola.guardar_parcial(numero, trabajador, registros, tracker)
+            except LeasePerdido:
+                print_progress(f"[{trabajador}] Unidad {numero}: lease vencido, otro trabajador la retomó")
+                continue
+            except Exception as exc:
+                print_progress(f"[{trabajador}] Unidad {numero} falló: {exc}")
+                cola.liberar(numero, lease, str(exc))
+                continue
+            cola.liberar(numero, lease)
+            procesadas += 1
+        if not pendientes or (not avance and not esperar):
+            return procesadas
+        if not avance:
+            time.sleep(ESPERA_SEGUNDOS)
+
+
+def combinar(cola: ColaTrabajo, tracker: IssueTracker) -> int:
+    """Genera la salida del modo normal con los parciales, en el orden original del lote."""
+    estado = cola.estado()
+    if estado["pendientes"] or estado["en_proceso"]:
+        tracker.fatal(
+            f"La cola tiene {estado['pendientes'] + estado['en_proceso']} unidad(es) sin terminar; "
+            "ejecute más trabajadores antes de combinar."
+        )
+        tracker.report()
+        return tracker.exit_code
+    for numero in range(1, estado["unidades"] + 1):
+        if cola.fallida(numero):
+            fallo = _leer_json(cola._ruta("fallidas", numero, "json")) or {}
+            archivos = len(cola.entradas(numero))
+            tracker.error(
+                f"Unidad {numero} ({archivos} archivo(s)) falló tras {fallo.get('intentos', '?')} intento(s): "
+                f"{fallo.get('ultimo_error', 'lease vencido')}"
+            )
+
+    job = cola.job
+    workdir = cola.workdir
+    progreso = open_progress(workdir, job)
+    salida: Optional[str] = None
+    resultado: Optional[Dict[str, Any]] = None
+    codigo_salida = 2
+    try:
+        registros = cola.parciales(tracker)
+        if job == "extractor_xml":
+            from extractor_xml import escribir_resultados
+
+            if not estado["unidades"]:
+                tracker.fatal("No se encontraron archivos XML para procesar.")
+            else:
+                try:
+                    salida = escribir_resultados(workdir, registros, tracker, progreso)
+                except Exception as exc:
+                    tracker.fatal(f"No se pudo generar el archivo Excel: {exc}")
+        elif job == "extractor_nomina":
+            from extractor_nomina import escribir_resultados
+
+            if not estado["unidades"]:
+                tracker.fatal(f"No se encontraron archivos XML en {workdir}")
+            else:
+                try:
+                    salida = escribir_resultados(workdir, registros, tracker, progreso)
+                except Exception as exc:
+                    tracker.fatal(f"No se pudo guardar el archivo Excel: {exc}")
+        elif job == "validador_xml":
+            from validador_xml import escribir_reporte
+
+            if not estado["unidades"]:
+                tracker.error("No se encontraron archivos XML en el directorio")
+            else:
+                try:
+                    resultado = escribir_reporte(workdir, registros, tracker, progreso)
+                    salida = resultado["excel_path"]
+                except Exception as exc:
+                    tracker.fatal(f"Error al crear Excel: {exc}")
+        else:
+            from clasificador_xml import resumir_clasificacion
+
+            resultado = resumir_clasificacion(workdir, registros, tracker, progreso)
+            salida = resultado.get("zip_path")
+
+        tracker.report({"extractor_xml": "CFDI", "extractor_nomina": "Nómina"}.get(job, ""))
+        codigo_salida = tracker.exit_code
+    finally:
+        progreso.finish(codigo_salida)
+    if job in ("extractor_xml", "extractor_nomina"):
+        if salida and tracker.exit_code == 0:
+            print(salida)
+    elif job == "validador_xml":
+        print(json.dumps({"path": salida, "stats": resultado["stats"]} if resultado else {"error": "No se pudo generar el reporte"}))
+    else:
+        if salida:
+            print(json.dumps({"path": salida, "partes": resultado["partes"], "stats": resultado["stats"]}))
+        else:
+            print(json.dumps({"stats": resultado}))
+    if salida:
+        cola.limpiar()
+    return tracker.exit_code
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Procesamiento distribuido de lotes XML con una cola en disco compartido.")
+    parser.add_argument("accion", choices=("preparar", "trabajar", "combinar", "estado"))
+    parser.add_argument("trabajo", choices=TRABAJOS)
+    parser.add_argument("workdir")
+    parser.add_argument("--id", default=None, help="Identificador del trabajador (por omisión host:pid)")
+    parser.add_argument("--no-esperar", action="store_true", help="Terminar cuando no haya unidades libres")
+    parser.add_argument("--reiniciar", action="store_true", help="Descartar una cola existente al preparar")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        print(f"ERROR: '{args.workdir}' no es un directorio válido", file=sys.stderr)
+        return 2
+    cola = ColaTrabajo(args.workdir, args.trabajo)
+
+    if args.accion == "preparar":
+        if cola.existe() and not args.reiniciar:
+            print(f"ERROR: Ya existe una cola en {cola.directorio}; use --reiniciar para descartarla", file=sys.stderr)
+            return 2
+        cola.limpiar()
+        print(json.dumps(cola.preparar()))
+        return 0
+
+    if not cola.existe():
+        print(f"ERROR: No hay cola preparada en {cola.directorio}", file=sys.stderr)
+        return 2
+    if args.accion == "estado":
+        print(json.dumps(cola.estado()))
+        return 0
+    if args.accion == "trabajar":
+        trabajador = args.id or f"{socket.gethostname()}:{os.getpid()}"
+        procesadas = trabajar(cola, trabajador, esperar=not args.no_esperar)
+        print_progress(f"[{trabajador}] {procesadas} unidad(es) procesadas")
+        return 0
+    return combinar(cola, IssueTracker())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""Vista previa de un lote: muestra estratificada por tamaño y extrapolación al total."""
+
+import json
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+from clasificador_xml import tipo_de_raiz
+from xml_utils import (
+    IssueTracker,
+    XmlEntry,
+    collect_namespace_uris,
+    env_float,
+    env_int,
+    find_all_local,
+    iter_xml_files,
+    load_xml_root,
+    print_progress,
+)
+
+PREVIEW_FLAG = "--preview"
+
+# Archivos máximos de la muestra y tiempo máximo dedicado a leerlos.
+MUESTRA_ARCHIVOS = env_int("XML_MUESTRA_ARCHIVOS", 200)
+MUESTRA_SEGUNDOS = env_float("XML_MUESTRA_SEGUNDOS", 5.0)
+MUESTRA_SEMILLA = env_int("XML_MUESTRA_SEMILLA", 0)
+# Tope del recorrido del lote: la muestra se toma de lo descubierto hasta ahí (0 = sin tope).
+DESCUBRIMIENTO_SEGUNDOS = env_float("XML_MUESTRA_DESCUBRIMIENTO_SEGUNDOS", 10.0)
+DESCUBRIMIENTO_ARCHIVOS = env_int("XML_MUESTRA_DESCUBRIMIENTO_ARCHIVOS", 0)
+
+# Costo aproximado de cada trabajo relativo a leer y detectar el tipo de un XML; el validador
+# agrega la consulta al SAT por archivo.
+FACTOR_TRABAJO: Dict[str, float] = {
+    "clasificador_xml": 1.5,
+    "extractor_xml": 2.0,
+    "extractor_nomina": 2.0,
+    "validador_xml": 1.2,
+}
+SEGUNDOS_SAT = env_float("XML_SAT_SEGUNDOS_ESTIMADOS", 0.5)
+
+
+def split_preview_flag(argv: List[str]) -> Tuple[List[str], bool]:
+    """Separa `--preview` de los argumentos posicionales de la línea de comandos."""
+    return [arg for arg in argv if arg != PREVIEW_FLAG], PREVIEW_FLAG in argv
+
+
+def _estrato(size: int) -> int:
+    # Estratos por potencia de 2 del tamaño: los archivos de un estrato cuestan parecido.
+    return max(size, 1).bit_length()
+
+
+class _Estrato:
+    """Conteo completo del estrato y una muestra de reservorio de tamaño fijo."""
+
+    def __init__(self) -> None:
+        self.archivos = 0
+        self.bytes = 0
+        self.reservorio: List[XmlEntry] = []
+        self.observaciones: List[Dict[str, Any]] = []
+
+    def agregar(self, entry: XmlEntry, rng: random.Random) -> None:
+        self.archivos += 1
+        self.bytes += entry.size
+        if len(self.reservorio) < MUESTRA_ARCHIVOS:
+            self.reservorio.append(entry)
+        else:
+            posicion = rng.randrange(self.archivos)
+            if posicion < MUESTRA_ARCHIVOS:
+                self.reservorio[posicion] = entry
+
+
+def _asignar(estratos: Dict[int, _Estrato], rng: random.Random) -> List[Tuple[int, XmlEntry]]:
+    """Muestra proporcional a los bytes de cada estrato (mínimo uno), intercalada por rondas.
+
+    El intercalado hace que, si se agota el tiempo, lo leído siga cubriendo todos los estratos.
+    """
+    total_bytes = sum(estrato.bytes for estrato in estratos.values()) or 1
+    colas: List[Tuple[int, List[XmlEntry]]] = []
+    for clave, estrato in sorted(estratos.items(), key=lambda item: -item[1].bytes):
+        cuota = max(1, round(MUESTRA_ARCHIVOS * estrato.bytes / total_bytes))
+        seleccion = list(estrato.reservorio)
+        rng.shuffle(seleccion)
+        colas.append((clave, seleccion[:cuota]))
+    muestra: List[Tuple[int, XmlEntry]] = []
+    ronda = 0
+    while len(muestra) < MUESTRA_ARCHIVOS and any(ronda < len(cola) for _, cola in colas):
+        for clave, cola in colas:
+            if ronda < len(cola):
+                muestra.append((clave, cola[ronda]))
+        ronda += 1
+    return muestra[:MUESTRA_ARCHIVOS]
+
+
+def _observar(entry: XmlEntry, tracker: IssueTracker) -> Dict[str, Any]:
+    """Una lectura y un parseo por archivo; `segundos` cubre todo el trabajo de la muestra."""
+    inicio = time.perf_counter()
+    observacion = _leer_muestra(entry, tracker)
+    observacion["segundos"] = time.perf_counter() - inicio
+    return observacion
+
+
+def _leer_muestra(entry: XmlEntry, tracker: IssueTracker) -> Dict[str, Any]:
+    observacion: Dict[str, Any] = {"tipo": "vacio", "version": None, "namespaces": []}
+    observacion.update(filas_gasto=0, filas_nomina=0)
+    root = load_xml_root(entry.path, tracker)
+    if root is None:
+        return observacion
+    tipo = observacion["tipo"] = tipo_de_raiz(root, entry.path, tracker)
+    if tipo == "vacio":
+        return observacion
+    observacion["version"] = root.get("Version") or root.get("version")
+    observacion["namespaces"] = collect_namespace_uris(root)
+    if root.get("TipoDeComprobante") == "P":
+        observacion["filas_gasto"] = len(find_all_local(root, "DoctoRelacionado"))
+    else:
+        observacion["filas_gasto"] = len(find_all_local(root, "Concepto"))
+    if tipo == "nomina":
+        subsidios = [pago for pago in find_all_local(root, "OtroPago") if pago.get("TipoOtroPago") == "002"]
+        observacion["filas_nomina"] = (
+            len(find_all_local(root, "Percepcion")) + len(find_all_local(root, "Deduccion")) + len(subsidios)
+        )
+    return observacion
+
+
+def _extrapolar(estratos: Dict[int, _Estrato], valor) -> Dict[Any, float]:
+    """Suma por estrato de (archivos del estrato × media muestral); sin muestra usa la media global."""
+    global_obs = [obs for estrato in estratos.values() for obs in estrato.observaciones]
+    totales: Dict[Any, float] = {}
+    for estrato in estratos.values():
+        observaciones = estrato.observaciones or global_obs
+        if not observaciones:
+            continue
+        peso = estrato.archivos / len(observaciones)
+        for obs in observaciones:
+            for clave, cantidad in valor(obs):
+                totales[clave] = totales.get(clave, 0.0) + cantidad * peso
+    return totales
+
+
+def estimar_lote(directorio: str, job: str) -> Dict[str, Any]:
+    rng = random.Random(MUESTRA_SEMILLA)
+    inicio = time.perf_counter()
+    estratos: Dict[int, _Estrato] = {}
+    # La muestra de reservorio se llena mientras se descubre; el recorrido se corta por tiempo o cantidad.
+    completo = True
+    fin_descubrimiento = inicio + DESCUBRIMIENTO_SEGUNDOS if DESCUBRIMIENTO_SEGUNDOS > 0 else None
+    descubiertos = 0
+    entradas = iter_xml_files(directorio)
+    for entry in entradas:
+        if (DESCUBRIMIENTO_ARCHIVOS > 0 and descubiertos >= DESCUBRIMIENTO_ARCHIVOS) or (
+            fin_descubrimiento is not None and time.perf_counter() > fin_descubrimiento
+        ):
+            completo = False
+            break
+        estratos.setdefault(_estrato(entry.size), _Estrato()).agregar(entry, rng)
+        descubiertos += 1
+    entradas.close()
+    descubrimiento = time.perf_counter() - inicio
+
+    tracker_muestra = IssueTracker()
+    muestra = _asignar(estratos, rng)
+    leidos = 0
+    bytes_leidos = 0
+    limite = time.perf_counter() + MUESTRA_SEGUNDOS
+    for clave, entry in muestra:
+        if leidos and time.perf_counter() > limite:
+            break
+        estratos[clave].observaciones.append(_observar(entry, tracker_muestra))
+        leidos += 1
+        bytes_leidos += entry.size
+
+    archivos = sum(estrato.archivos for estrato in estratos.values())
+    tipos = _extrapolar(estratos, lambda obs: [(obs["tipo"], 1)])
+    versiones = _extrapolar(estratos, lambda obs: [(obs["version"] or "N/A", 1)] if obs["tipo"] != "vacio" else [])
+    namespaces = _extrapolar(estratos, lambda obs: [(uri, 1) for uri in obs["namespaces"]])
+    filas = _extrapolar(estratos, lambda obs: [("gasto", obs["filas_gasto"]), ("nomina", obs["filas_nomina"])])
+    lectura = _extrapolar(estratos, lambda obs: [("segundos", obs["segundos"])]).get("segundos", 0.0)
+
+    if job == "extractor_xml":
+        filas_estimadas = filas.get("gasto", 0.0)
+    elif job == "extractor_nomina":
+        filas_estimadas = filas.get("nomina", 0.0)
+    else:
+        filas_estimadas = float(archivos)
+    segundos = lectura * FACTOR_TRABAJO.get(job, 1.0)
+    if job == "validador_xml":
+        segundos += SEGUNDOS_SAT * (archivos - tipos.get("vacio", 0.0))
+
+    return {
+        "modo": "preview",
+        "trabajo": job,
+        "archivos": archivos,
+        "bytes": sum(estrato.bytes for estrato in estratos.values()),
+        "muestra": {
+            "archivos": leidos,
+            "bytes": bytes_leidos,
+            "estratos": len(estratos),
+            "avisos": len(tracker_muestra.warnings) + len(tracker_muestra.errors) + len(tracker_muestra.fatals),
+        },
+        "tipos": {tipo: round(tipos.get(tipo, 0.0)) for tipo in ("gasto", "nomina", "vacio")},
+        "versiones": {version: round(cantidad) for version, cantidad in sorted(versiones.items())},
+        "namespaces": {uri: round(cantidad) for uri, cantidad in sorted(namespaces.items())},
+        "filas_estimadas": round(filas_estimadas),
+        "segundos_estimados": round(segundos, 1),
+        "segundos_preview": round(time.perf_counter() - inicio, 2),
+        "segundos_descubrimiento": round(descubrimiento, 2),
+        # False: el recorrido se cortó y archivos/estimaciones cubren solo lo descubierto.
+        "descubrimiento_completo": completo,
+    }
+
+
+def run_preview(directorio: str, job: str) -> int:
+    """Imprime en stdout la estimación JSON del lote y devuelve el código de salida."""
+    tracker = IssueTracker()
+    try:
+        estimacion = estimar_lote(directorio, job)
+    except Exception as exc:
+        tracker.fatal(f"No se pudo estimar el lote: {exc}")
+        tracker.report("Preview")
+        return tracker.exit_code
+    if not estimacion["archivos"]:
+        tracker.error("No se encontraron archivos XML para estimar.")
+    print_progress(
+        f"Preview: {estimacion['muestra']['archivos']} de {estimacion['archivos']} archivo(s) muestreados "
+        f"en {estimacion['segundos_preview']} s"
+    )
+    if not estimacion["descubrimiento_completo"]:
+        tracker.warn(
+            f"Recorrido del lote cortado por XML_MUESTRA_DESCUBRIMIENTO_*: la estimación cubre solo "
+            f"los primeros {estimacion['archivos']} archivo(s)"
+        )
+    tracker.report("Preview")
+    print(json.dumps(estimacion, ensure_ascii=False))
+    return tracker.exit_code
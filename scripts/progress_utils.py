@@ -0,0 +1,181 @@
+"""Canal de progreso NDJSON: una línea JSON por evento en `<workdir>/.progreso_<job>.ndjson`."""
+
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from xml_utils import PROGRESS_LIGHT, XmlEntry, env_flag, env_float, env_int, iter_xml_files
+
+PROGRESS_ENABLED = env_flag("XML_PROGRESO", True)
+# Intervalo mínimo entre eventos; en modo ligero además solo se mira el reloj cada N archivos.
+PROGRESS_EVERY_SECONDS = env_float("XML_PROGRESO_SEGUNDOS", 2.0 if PROGRESS_LIGHT else 0.5)
+PROGRESS_BATCH = env_int("XML_PROGRESO_LOTE", 500 if PROGRESS_LIGHT else 1)
+# Conteo del total en un recorrido aparte (solo scandir, sin leer archivos) para tener ETA desde
+# el inicio. Con XML_PROGRESO_TOTAL=0 el total se conoce cuando el recorrido principal termina.
+PROGRESS_COUNT_TOTAL = env_flag("XML_PROGRESO_TOTAL", True)
+
+# Lectura desde el final del archivo: basta para el último evento completo.
+_TAIL_BYTES = 8192
+
+
+def progress_path(workdir: str, job: str) -> str:
+    return os.path.join(workdir, f".progreso_{job}.ndjson")
+
+
+class ProgressReporter:
+    """Acumula contadores del lote y escribe eventos con límite de frecuencia.
+
+    `advance` solo suma contadores; el reloj se consulta cada `PROGRESS_BATCH` llamadas,
+    así que en modo ligero el costo por archivo es de unas cuantas sumas.
+    """
+
+    def __init__(self, job: str, path: Optional[str]) -> None:
+        self.job = job
+        self.path = path
+        self.stage_name = "inicio"
+        self.files = 0
+        self.bytes = 0
+        self.rows = 0
+        self.total: Optional[int] = None
+        self._restored = 0
+        self._pending = 0
+        self._started = time.monotonic()
+        self._last_emit = 0.0
+        self._handle = None
+        if path is not None:
+            try:
+                self._handle = open(path, "w", encoding="utf-8")
+            except OSError:
+                self._handle = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._handle is not None
+
+    def restore(self, files: int) -> None:
+        """Archivos ya procesados en una corrida anterior (checkpoint); no cuentan para la tasa."""
+        self.files += files
+        self._restored += files
+
+    def count_in_background(self, directorio: str) -> None:
+        """Cuenta el total en un segundo recorrido para estimar el ETA antes de que termine el principal."""
+        if not self.enabled or not PROGRESS_COUNT_TOTAL:
+            return
+
+        def contar() -> None:
+            total = sum(1 for _ in iter_xml_files(directorio))
+            if self.total is None:
+                self.total = total
+
+        threading.Thread(target=contar, name=f"conteo-{self.job}", daemon=True).start()
+
+    def discover(self, entries: Iterable[XmlEntry]) -> Iterator[XmlEntry]:
+        """Pasa las entradas del recorrido principal y fija el total exacto cuando se agota."""
+        found = 0
+        for entry in entries:
+            found += 1
+            yield entry
+        self.total = found
+
+    def stage(self, name: str) -> None:
+        self.stage_name = name
+        self.emit()
+
+    def advance(self, files: int = 1, nbytes: int = 0, rows: int = 0) -> None:
+        self.files += files
+        self.bytes += nbytes
+        self.rows += rows
+        if self._handle is None:
+            return
+        self._pending += 1
+        if self._pending < PROGRESS_BATCH:
+            return
+        self._pending = 0
+        if time.monotonic() - self._last_emit >= PROGRESS_EVERY_SECONDS:
+            self.emit()
+
+    def event(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self._started
+        rate = (self.files - self._restored) / elapsed if elapsed > 0 else 0.0
+        total = self.total
+        eta = None
+        if total is not None and rate > 0:
+            eta = round(max(total - self.files, 0) / rate, 1)
+        return {
+            "t": round(time.time(), 3),
+            "trabajo": self.job,
+            "etapa": self.stage_name,
+            "archivos": self.files,
+            "total": total,
+            "bytes": self.bytes,
+            "filas": self.rows,
+            "tasa": round(rate, 2),
+            "eta": eta,
+            "segundos": round(elapsed, 1),
+        }
+
+    def emit(self, **extra: Any) -> None:
+        if self._handle is None:
+            return
+        evento = self.event()
+        evento.update(extra)
+        try:
+            self._handle.write(json.dumps(evento, ensure_ascii=False) + "\n")
+            self._handle.flush()
+        except (OSError, ValueError):
+            self._handle = None
+        self._last_emit = time.monotonic()
+
+    def finish(self, exit_code: int) -> None:
+        self.stage_name = "fin"
+        self.emit(codigo_salida=exit_code)
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+def open_progress(workdir: str, job: str) -> ProgressReporter:
+    path = progress_path(workdir, job) if PROGRESS_ENABLED and os.path.isdir(workdir) else None
+    return ProgressReporter(job, path)
+
+
+def read_last_event(path: str) -> Optional[Dict[str, Any]]:
+    """Último evento completo del archivo NDJSON, leyendo solo su final."""
+    try:
+        with open(path, "rb") as handle:
+            handle.seek(0, os.SEEK_END)
+            size = handle.tell()
+            handle.seek(max(size - _TAIL_BYTES, 0))
+            tail = handle.read()
+    except OSError:
+        return None
+    # La última línea puede estar a medio escribir; se toma la última que sea JSON válido.
+    for line in reversed(tail.split(b"\n")):
+        if not line.strip():
+            continue
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+
+def main() -> int:
+    """Uso: progress_utils.py <archivo.ndjson | workdir job>; imprime el último evento como JSON."""
+    if len(sys.argv) == 2:
+        path = sys.argv[1]
+    elif len(sys.argv) == 3:
+        path = progress_path(sys.argv[1], sys.argv[2])
+    else:
+        print("ERROR: Uso: progress_utils.py <archivo.ndjson> | <workdir> <trabajo>", file=sys.stderr)
+        return 2
+    evento = read_last_event(path)
+    print(json.dumps(evento if evento is not None else {"etapa": "sin datos"}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""Salida Excel en streaming que se divide en hojas y archivos numerados al llegar a los límites."""
+
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import openpyxl
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.formatting.rule import Rule
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+from xml_utils import env_int
+
+# Límites de una hoja de Excel (la fila de encabezado cuenta).
+EXCEL_MAX_ROWS = 1_048_576
+EXCEL_MAX_COLS = 16_384
+EXCEL_MAX_SHEET_NAME = 31
+
+MAX_FILAS_HOJA = min(env_int("XML_MAX_FILAS_HOJA", EXCEL_MAX_ROWS), EXCEL_MAX_ROWS)
+MAX_COLUMNAS_HOJA = min(env_int("XML_MAX_COLUMNAS_HOJA", EXCEL_MAX_COLS), EXCEL_MAX_COLS)
+# Filas de datos por archivo sumando todas sus hojas; 0 = sin límite.
+MAX_FILAS_ARCHIVO = env_int("XML_MAX_FILAS_ARCHIVO", 0)
+
+HEADER_STYLE: Dict[str, Any] = {"font": Font(bold=True)}
+# Ancho máximo de columna que se calcula a partir del contenido.
+MAX_ANCHO_COLUMNA = 50
+
+
+def manifest_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".manifest.json"
+
+
+def shard_path(path: str, numero: int) -> str:
+    """`reporte.xlsx`, `reporte_2.xlsx`, `reporte_3.xlsx`, ..."""
+    if numero == 1:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}_{numero}{extension}"
+
+
+def write_manifest(path: str, manifest: Dict[str, Any]) -> None:
+    with open(path + ".tmp", "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def column_widths(df, maximo: float = MAX_ANCHO_COLUMNA, margen: int = 2) -> List[float]:
+    """Ancho de cada columna según el texto más largo (encabezado incluido), sin recorrer celdas.
+
+    Las categóricas solo miden sus categorías; el resto usa `str.len()` sobre la columna entera.
+    """
+    anchos = []
+    for columna in df.columns:
+        serie = df[columna]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            valores = serie.cat.categories.to_series()
+        else:
+            valores = serie.dropna()
+        largo = valores.astype(str).str.len().max() if len(valores) else 0
+        anchos.append(min(max(int(largo), len(str(columna))) + margen, maximo))
+    return anchos
+
+
+def _cell_value(value: Any) -> Any:
+    # NaN/NaT de pandas se escriben como celda vacía, igual que DataFrame.to_excel.
+    if value is None or value != value:
+        return None
+    return value
+
+
+class ShardedSheet:
+    """Tabla lógica escrita en una o más hojas físicas.
+
+    Las filas se reparten en hojas `Nombre`, `Nombre_2`, ... de MAX_FILAS_HOJA filas; si hay más
+    columnas que MAX_COLUMNAS_HOJA, cada grupo extra va en `Nombre_c2`, ... repitiendo las
+    primeras `key_columns` columnas para poder cruzar los grupos.
+    """
+
+    def __init__(
+        self,
+        book: "ShardedWorkbook",
+        name: str,
+        headers: Sequence[Any],
+        key_columns: int = 1,
+        header_style: Optional[Dict[str, Any]] = None,
+        widths: Optional[Sequence[float]] = None,
+        rules: Sequence[Rule] = (),
+    ) -> None:
+        self.book = book
+        self.name = name
+        self.headers = list(headers)
+        self.header_style = HEADER_STYLE if header_style is None else header_style
+        self.widths = list(widths) if widths is not None else None
+        self.rules = list(rules)
+        ancho = max(len(self.headers), 1)
+        if ancho <= MAX_COLUMNAS_HOJA:
+            self.groups: List[Tuple[int, int]] = [(0, ancho)]
+            self.keys = 0
+        else:
+            self.keys = min(key_columns, MAX_COLUMNAS_HOJA - 1)
+            paso = MAX_COLUMNAS_HOJA - self.keys
+            self.groups = [(inicio, min(inicio + paso, ancho)) for inicio in range(self.keys, ancho, paso)]
+        self.rows = 0
+        self.part = 0
+        self._rows_in_sheet = 0
+        self._sheets: List[Any] = []
+        self._entries: List[Dict[str, Any]] = []
+        self._formatted = True
+        self.closed = False
+        self._open()
+
+    def _columns(self, grupo: Tuple[int, int]) -> List[int]:
+        inicio, fin = grupo
+        return list(range(self.keys)) + list(range(inicio, fin))
+
+    def _sheet_name(self, indice_grupo: int) -> str:
+        sufijo = ""
+        if self.part > 0:
+            sufijo += f"_{self.part + 1}"
+        if indice_grupo > 0:
+            sufijo += f"_c{indice_grupo + 1}"
+        return self.name[: EXCEL_MAX_SHEET_NAME - len(sufijo)] + sufijo
+
+    def _open(self) -> None:
+        self._sheets = []
+        for indice, grupo in enumerate(self.groups):
+            ws = self.book.workbook.create_sheet(self._sheet_name(indice))
+            columnas = self._columns(grupo)
+            if self.widths:
+                # En modo write-only las dimensiones se escriben antes de la primera fila.
+                for posicion, c in enumerate(columnas, start=1):
+                    if c < len(self.widths):
+                        ws.column_dimensions[get_column_letter(posicion)].width = self.widths[c]
+            ws.append([self._styled(ws, self.headers[c], self.header_style) for c in columnas])
+            self._sheets.append((ws, columnas))
+            self._entries.append(
+                {
+                    "tabla": self.name,
+                    "archivo": os.path.basename(self.book.current_path),
+                    "hoja": ws.title,
+                    "filas": [self.rows + 1, self.rows],
+                    "columnas": [grupo[0] + 1, grupo[1]],
+                    "columnas_llave": self.keys,
+                }
+            )
+        self._rows_in_sheet = 0
+        self._formatted = False
+
+    def _format(self) -> None:
+        """Aplica `rules` a las filas de datos de las hojas abiertas (una vez, antes de guardarlas).
+
+        Las fórmulas de las reglas usan las letras de la tabla y la fila 2, así que solo se
+        aplican al primer grupo de columnas, el único donde las letras coinciden.
+        """
+        if self._formatted:
+            return
+        self._formatted = True
+        if not self.rules or not self._rows_in_sheet:
+            return
+        ws, columnas = self._sheets[0]
+        rango = f"A2:{get_column_letter(len(columnas))}{self._rows_in_sheet + 1}"
+        for rule in self.rules:
+            ws.conditional_formatting.add(rango, rule)
+
+    def _rotate(self) -> None:
+        self._format()
+        self.part += 1
+        self._open()
+
+    @staticmethod
+    def _styled(ws, value: Any, style: Optional[Dict[str, Any]]):
+        value = _cell_value(value)
+        if not style:
+            return value
+        cell = WriteOnlyCell(ws, value=value)
+        for attribute, setting in style.items():
+            setattr(cell, attribute, setting)
+        return cell
+
+    def append(self, values: Sequence[Any], styles: Optional[Dict[int, Dict[str, Any]]] = None) -> None:
+        """Agrega una fila; `styles` mapea índice de columna (base 0) a atributos de celda."""
+        self.book.reserve(1)
+        if self._rows_in_sheet >= MAX_FILAS_HOJA - 1:
+            self._rotate()
+        self.rows += 1
+        self._rows_in_sheet += 1
+        for (ws, columnas), entrada in zip(self._sheets, self._entries[-len(self._sheets):]):
+            if styles:
+                ws.append([self._styled(ws, values[c] if c < len(values) else None, styles.get(c)) for c in columnas])
+            else:
+                ws.append([_cell_value(values[c]) if c < len(values) else None for c in columnas])
+            entrada["filas"][1] = self.rows
+
+    def append_rows(self, rows: Iterable[Sequence[Any]]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def append_frame(self, df) -> None:
+        """Filas de un DataFrame (los encabezados ya se dieron al crear la hoja)."""
+        self.append_rows(df.itertuples(index=False, name=None))
+
+    def close(self) -> List[Dict[str, Any]]:
+        self._format()
+        self.closed = True
+        return self._entries
+
+
+class ShardedWorkbook:
+    """Libro en modo write-only que rota a `base_2.xlsx`, ... al llegar a MAX_FILAS_ARCHIVO.
+
+    Al cerrar escribe `<base>.manifest.json` con los archivos, sus hojas y el rango de filas y
+    columnas de cada tabla que contiene cada hoja. Usado con `with`, un libro que no llegó a
+    `close` (por un error al escribir) suelta sus hojas con `discard`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.paths: List[str] = []
+        self.sheets: List[ShardedSheet] = []
+        self.workbook = None
+        self.current_path = path
+        self._rows_in_file = 0
+        self._remove_stale_shards()
+        self._new_file()
+
+    def _remove_stale_shards(self) -> None:
+        """Borra los archivos `_2`, `_3`, ... de una corrida anterior según su manifiesto."""
+        try:
+            with open(manifest_path(self.path), "r", encoding="utf-8") as handle:
+                anteriores = json.load(handle).get("archivos", [])
+        except (OSError, ValueError):
+            return
+        directorio = os.path.dirname(self.path)
+        for nombre in anteriores[1:]:
+            try:
+                os.remove(os.path.join(directorio, os.path.basename(nombre)))
+            except OSError:
+                pass
+
+    def _new_file(self) -> None:
+        self.current_path = shard_path(self.path, len(self.paths) + 1)
+        self.paths.append(self.current_path)
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self._rows_in_file = 0
+
+    def _save_current(self) -> None:
+        for hoja in self.sheets:
+            hoja._format()
+        if not self.workbook.worksheets:
+            self.workbook.create_sheet("Sheet1")
+        self.workbook.save(self.current_path)
+
+    def reserve(self, rows: int) -> None:
+        """Cuenta filas del archivo actual; al pasar el límite, las tablas abiertas siguen en uno nuevo."""
+        if MAX_FILAS_ARCHIVO and self._rows_in_file and self._rows_in_file + rows > MAX_FILAS_ARCHIVO:
+            self._save_current()
+            self._new_file()
+            for hoja in self.sheets:
+                if not hoja.closed:
+                    hoja._rotate()
+        self._rows_in_file += rows
+
+    def add_sheet(
+        self,
+        name: str,
+        headers: Sequence[Any],
+        key_columns: int = 1,
+        header_style: Optional[Dict[str, Any]] = None,
+        widths: Optional[Sequence[float]] = None,
+        rules: Sequence[Rule] = (),
+    ) -> ShardedSheet:
+        hoja = ShardedSheet(self, name, headers, key_columns, header_style, widths, rules)
+        self.sheets.append(hoja)
+        return hoja
+
+    def write_frame(
+        self,
+        name: str,
+        df,
+        key_columns: int = 1,
+        widths: Optional[Sequence[float]] = None,
+        rules: Sequence[Rule] = (),
+    ) -> ShardedSheet:
+        hoja = self.add_sheet(name, [str(columna) for columna in df.columns], key_columns, widths=widths, rules=rules)
+        hoja.append_frame(df)
+        hoja.close()
+        return hoja
+
+    def discard(self) -> None:
+        """Suelta el archivo en curso sin guardarlo.
+
+        Cada hoja write-only de openpyxl deja un generador abierto sobre un archivo temporal; si
+        se recolectan sin cerrarse, fallan con "I/O operation on closed file" y el temporal queda.
+        """
+        if self.workbook is None:
+            return
+        for ws in self.workbook.worksheets:
+            try:
+                if not ws.closed:
+                    ws.close()
+            except Exception:
+                pass
+            writer = getattr(ws, "_writer", None)
+            if writer is None:
+                continue
+            try:
+                writer.close()
+                writer.cleanup()
+            except (OSError, ValueError):
+                pass
+        for hoja in self.sheets:
+            hoja.closed = True
+        self.workbook = None
+
+    def close(self) -> List[str]:
+        try:
+            self._save_current()
+        except BaseException:
+            self.discard()
+            raise
+        self.workbook = None
+        manifest = {
+            "archivo": os.path.basename(self.path),
+            "archivos": [os.path.basename(path) for path in self.paths],
+            "limites": {"filas_hoja": MAX_FILAS_HOJA, "columnas_hoja": MAX_COLUMNAS_HOJA, "filas_archivo": MAX_FILAS_ARCHIVO},
+            "tablas": [
+                {"tabla": hoja.name, "filas": hoja.rows, "columnas": len(hoja.headers)} for hoja in self.sheets
+            ],
+            "hojas": [entrada for hoja in self.sheets for entrada in hoja.close()],
+        }
+        write_manifest(manifest_path(self.path), manifest)
+        return self.paths
+
+    def __enter__(self) -> "ShardedWorkbook":
+        return self
+
+    def __exit__(self, *exc) -> Optional[bool]:
+        self.discard()
+        return None
@@ -0,0 +1,143 @@
+"""Esquemas declarativos de columnas compilados una vez en extractores por elemento.
+
+Un esquema es la lista ordenada de columnas de una fila; cada `Campo` dice de qué ámbito (el
+comprobante, un concepto, un pago, ...), de qué elemento relativo a él y de qué atributo sale el
+valor, y qué poner si falta. Al compilar se agrupan los campos por ámbito y por ruta, así que por
+fila solo se hace un `find` por elemento y un `attrib.get` por columna, sin interpretar nada.
+
+Quien ya recorrió el documento puede pasar los elementos de cada ruta en `hijos` (ruta ->
+elemento, ver `Esquema.rutas`) y entonces no se busca nada.
+"""
+
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from xml_utils import find_first, normalize_attr
+
+# texto: cadena normalizada; numero/monto: texto crudo que los extractores convierten por
+# columna al final (los montos en Decimal con XML_MONTOS_EXACTOS).
+TIPOS_CAMPO = ("texto", "numero", "monto")
+
+
+class Campo(NamedTuple):
+    columna: str
+    ambito: Optional[str]  # None: constante, siempre `defecto`
+    atributo: Optional[str] = None
+    defecto: Any = None  # si el elemento o el atributo faltan o están en blanco
+    ruta: str = "."  # elemento relativo al del ámbito
+    tipo: str = "texto"
+    respaldo: Optional[str] = None  # columna que se copia si este campo quedó en None
+
+
+Llenador = Callable[[Any, List[Any], Optional[Mapping[str, Any]]], None]
+
+
+def _compilar_ruta(ruta: str, campos: Tuple[Tuple[int, str, Any], ...], namespaces: Dict[str, str]) -> Llenador:
+    normalizar = normalize_attr
+
+    def llenar(contexto, fila: List[Any], hijos: Optional[Mapping[str, Any]] = None) -> None:
+        if ruta == "." or contexto is None:
+            elemento = contexto
+        elif hijos is not None:
+            elemento = hijos.get(ruta)
+        else:
+            elemento = find_first(contexto, ruta, namespaces)
+        if elemento is None:
+            for posicion, _, defecto in campos:
+                fila[posicion] = defecto
+            return
+        atributos = elemento.attrib
+        for posicion, atributo, defecto in campos:
+            valor = atributos.get(atributo)
+            fila[posicion] = (normalizar(valor) or defecto) if valor else defecto
+
+    return llenar
+
+
+def _compilar_ambito(rutas: List[Llenador]) -> Llenador:
+    if len(rutas) == 1:
+        return rutas[0]
+
+    def llenar(contexto, fila: List[Any], hijos: Optional[Mapping[str, Any]] = None) -> None:
+        for llenar_ruta in rutas:
+            llenar_ruta(contexto, fila, hijos)
+
+    return llenar
+
+
+class Esquema:
+    """Esquema compilado: plantilla con las constantes y un extractor por ámbito."""
+
+    def __init__(self, campos: Sequence[Campo], namespaces: Optional[Dict[str, str]] = None) -> None:
+        self.campos = tuple(campos)
+        self.columnas = tuple(campo.columna for campo in self.campos)
+        if len(set(self.columnas)) != len(self.columnas):
+            raise ValueError(f"Columnas repetidas en el esquema: {self.columnas}")
+        posiciones = {columna: posicion for posicion, columna in enumerate(self.columnas)}
+
+        self.plantilla: List[Any] = [None] * len(self.campos)
+        por_ambito: Dict[str, Dict[str, List[Tuple[int, str, Any]]]] = {}
+        respaldos: List[Tuple[int, int]] = []
+        for posicion, campo in enumerate(self.campos):
+            if campo.tipo not in TIPOS_CAMPO:
+                raise ValueError(f"Tipo '{campo.tipo}' desconocido en la columna {campo.columna}")
+            if campo.respaldo is not None:
+                respaldos.append((posicion, posiciones[campo.respaldo]))
+            if campo.ambito is None:
+                self.plantilla[posicion] = campo.defecto
+                continue
+            por_ambito.setdefault(campo.ambito, {}).setdefault(campo.ruta, []).append(
+                (posicion, campo.atributo, campo.defecto)
+            )
+
+        namespaces = namespaces or {}
+        self._ambitos: Dict[str, Llenador] = {
+            ambito: _compilar_ambito([_compilar_ruta(ruta, tuple(grupo), namespaces) for ruta, grupo in rutas.items()])
+            for ambito, rutas in por_ambito.items()
+        }
+        self._rutas = {
+            ambito: tuple(ruta for ruta in rutas if ruta != ".") for ambito, rutas in por_ambito.items()
+        }
+        self._respaldos = tuple(respaldos)
+        self._posiciones = posiciones
+
+    @property
+    def ambitos(self) -> Tuple[str, ...]:
+        return tuple(self._ambitos)
+
+    def rutas(self, ambito: str) -> Tuple[str, ...]:
+        """Rutas distintas de "." que lee el ámbito: las llaves que espera `hijos` en `llenar`."""
+        return self._rutas.get(ambito, ())
+
+    def posicion(self, columna: str) -> int:
+        return self._posiciones[columna]
+
+    def columnas_de_tipo(self, *tipos: str) -> List[str]:
+        return [campo.columna for campo in self.campos if campo.tipo in tipos]
+
+    def nueva_fila(self) -> List[Any]:
+        return self.plantilla.copy()
+
+    def llenar(self, ambito: str, elemento, fila: List[Any], hijos: Optional[Mapping[str, Any]] = None) -> None:
+        """Escribe en `fila` las columnas del ámbito leídas de `elemento` (None: valores por omisión).
+
+        Con `hijos` las rutas se toman de ahí (las que falten quedan con su valor por omisión).
+        """
+        self._ambitos[ambito](elemento, fila, hijos)
+
+    def extraer(self, elementos: Dict[str, Any]) -> List[Any]:
+        fila = self.nueva_fila()
+        for ambito, elemento in elementos.items():
+            self._ambitos[ambito](elemento, fila)
+        return fila
+
+    def _con_respaldos(self, fila: List[Any]) -> List[Any]:
+        for posicion, origen in self._respaldos:
+            if fila[posicion] is None:
+                fila[posicion] = fila[origen]
+        return fila
+
+    def como_dict(self, fila: List[Any]) -> Dict[str, Any]:
+        return dict(zip(self.columnas, self._con_respaldos(fila)))
+
+    def como_tupla(self, fila: List[Any]) -> Tuple[Any, ...]:
+        return tuple(self._con_respaldos(fila))
@@ -0,0 +1,158 @@
+"""Modo de memoria acotada: bloques de filas volcados a disco en corridas ordenadas y mezcla externa."""
+
+import heapq
+import os
+import pickle
+import tempfile
+from operator import itemgetter
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from xml_utils import env_int
+
+# Presupuesto de RSS del proceso en MB; 0 deja los extractores en el modo normal, todo en memoria.
+MEMORIA_MB = env_int("XML_MEMORIA_MB", 0)
+# Filas máximas por bloque aunque el RSS siga bajo el presupuesto.
+SPILL_FILAS = env_int("XML_SPILL_FILAS", 100_000)
+# Directorio de las corridas; por omisión el temporal del sistema (TMPDIR).
+SPILL_DIR = os.environ.get("XML_SPILL_DIR") or None
+
+# Leer /proc en cada fila costaría más que el trabajo; se revisa cada tantas filas.
+_REVISAR_RSS_CADA = 1024
+# Pares por pickle dentro de una corrida: la lectura solo mantiene un bloque por corrida.
+_PARES_POR_BLOQUE = 1024
+
+T = TypeVar("T")
+
+
+def memoria_acotada() -> bool:
+    return MEMORIA_MB > 0
+
+
+def rss_bytes() -> int:
+    """Memoria residente del proceso según /proc/self/statm; 0 donde no existe."""
+    try:
+        with open("/proc/self/statm", "rb") as handle:
+            paginas = int(handle.read().split()[1])
+        return paginas * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class PresupuestoMemoria:
+    """Indica cuándo volcar: al juntar SPILL_FILAS filas o cuando el RSS pasa de MEMORIA_MB."""
+
+    def __init__(self, filas: int = SPILL_FILAS) -> None:
+        self.filas = max(filas, 1)
+        self.limite = MEMORIA_MB * 1024 * 1024
+        self._acumuladas = 0
+        self._desde_revision = 0
+
+    def agregar(self, filas: int = 1) -> bool:
+        self._acumuladas += filas
+        if self._acumuladas >= self.filas:
+            return True
+        self._desde_revision += filas
+        if not self.limite or self._desde_revision < _REVISAR_RSS_CADA:
+            return False
+        self._desde_revision = 0
+        return rss_bytes() > self.limite
+
+    def reiniciar(self) -> None:
+        self._acumuladas = 0
+        self._desde_revision = 0
+
+
+def en_bloques(registros: Iterable[T], filas: Callable[[T], int]) -> Iterator[List[T]]:
+    """Agrupa registros consecutivos en bloques que caben en el presupuesto de memoria."""
+    presupuesto = PresupuestoMemoria()
+    bloque: List[T] = []
+    for registro in registros:
+        bloque.append(registro)
+        if presupuesto.agregar(filas(registro)):
+            yield bloque
+            bloque = []
+            presupuesto.reiniciar()
+    if bloque:
+        yield bloque
+
+
+class CorridasOrdenadas:
+    """Pares (clave, valor) que se vuelcan a disco ordenados por clave al agotar el presupuesto.
+
+    `mezclar` recorre todas las corridas y lo que quede en memoria en orden de clave con
+    heapq.merge, leyendo un bloque por corrida. Las claves deben ser únicas (p. ej. incluir la
+    secuencia del lote) para que nunca se comparen los valores.
+    """
+
+    def __init__(self, nombre: str) -> None:
+        self.nombre = nombre
+        self.archivos: List[str] = []
+        self.total = 0
+        self._memoria: List[Tuple[Any, Any]] = []
+        self._presupuesto = PresupuestoMemoria()
+
+    def agregar(self, clave: Any, valor: Any) -> None:
+        self._memoria.append((clave, valor))
+        self.total += 1
+        if self._presupuesto.agregar():
+            self.volcar()
+
+    def volcar(self) -> None:
+        if not self._memoria:
+            return
+        self._memoria.sort(key=itemgetter(0))
+        fd, path = tempfile.mkstemp(prefix=f"xml_{self.nombre}_", suffix=".corrida", dir=SPILL_DIR)
+        self.archivos.append(path)
+        with os.fdopen(fd, "wb") as handle:
+            for inicio in range(0, len(self._memoria), _PARES_POR_BLOQUE):
+                pickle.dump(self._memoria[inicio : inicio + _PARES_POR_BLOQUE], handle, protocol=pickle.HIGHEST_PROTOCOL)
+        self._memoria = []
+        self._presupuesto.reiniciar()
+
+    @staticmethod
+    def _leer(path: str) -> Iterator[Tuple[Any, Any]]:
+        with open(path, "rb") as handle:
+            while True:
+                try:
+                    bloque = pickle.load(handle)
+                except EOFError:
+                    return
+                yield from bloque
+
+    def mezclar(self) -> Iterator[Tuple[Any, Any]]:
+        self._memoria.sort(key=itemgetter(0))
+        corridas = [self._leer(path) for path in self.archivos] + [iter(self._memoria)]
+        return heapq.merge(*corridas, key=itemgetter(0))
+
+    def cerrar(self) -> None:
+        for path in self.archivos:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.archivos = []
+        self._memoria = []
+
+    def __enter__(self) -> "CorridasOrdenadas":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.cerrar()
+
+
+def por_grupos(
+    pares: Iterable[Tuple[Any, T]], grupo: Callable[[Any], Any], filas: Optional[int] = None
+) -> Iterator[List[T]]:
+    """Valores de una mezcla en lotes de unas `filas` que nunca parten un grupo de claves."""
+    tamano = filas or SPILL_FILAS
+    lote: List[T] = []
+    anterior: Any = object()
+    for clave, valor in pares:
+        actual = grupo(clave)
+        if len(lote) >= tamano and actual != anterior:
+            yield lote
+            lote = []
+        lote.append(valor)
+        anterior = actual
+    if lote:
+        yield lote
@@ -0,0 +1,87 @@
+"""Telemetría de llamadas a servicios externos: histograma de latencia, reintentos y tipos de error.
+
+Solo contadores: registrar una llamada es una búsqueda binaria y unas sumas, sin guardar cada
+latencia. Los percentiles salen del histograma, así que son la cota superior de su intervalo.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Límites superiores (ms) de los intervalos del histograma; el último intervalo queda abierto.
+LIMITES_LATENCIA_MS: Tuple[int, ...] = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+RESULTADO_OK = "ok"
+
+COLUMNAS_TELEMETRIA = ["sección", "métrica", "valor"]
+
+
+class CallTelemetry:
+    """Acumula latencia, reintentos y resultado de cada llamada."""
+
+    def __init__(self, limites: Sequence[int] = LIMITES_LATENCIA_MS) -> None:
+        self.limites = tuple(limites)
+        self.histograma: List[int] = [0] * (len(self.limites) + 1)
+        self.llamadas = 0
+        self.con_reintento = 0
+        self.reintentos = 0
+        self.total_ms = 0.0
+        self.maximo_ms = 0.0
+        self.resultados: Counter = Counter()
+
+    def record(self, latencia_ms: float, resultado: str = RESULTADO_OK, reintentos: int = 0) -> None:
+        latencia_ms = float(latencia_ms)
+        self.histograma[bisect_left(self.limites, latencia_ms)] += 1
+        self.llamadas += 1
+        self.total_ms += latencia_ms
+        self.maximo_ms = max(self.maximo_ms, latencia_ms)
+        self.resultados[resultado] += 1
+        if reintentos:
+            self.con_reintento += 1
+            self.reintentos += reintentos
+
+    def _etiqueta(self, posicion: int) -> str:
+        if posicion < len(self.limites):
+            return f"<={self.limites[posicion]}"
+        return f">{self.limites[-1]}"
+
+    def percentile(self, porcentaje: float) -> float:
+        """Cota superior (ms) del intervalo donde cae el percentil; el máximo si es el intervalo abierto."""
+        if not self.llamadas:
+            return 0.0
+        objetivo = porcentaje / 100.0 * self.llamadas
+        acumulado = 0
+        for posicion, cantidad in enumerate(self.histograma):
+            acumulado += cantidad
+            if cantidad and acumulado >= objetivo:
+                return float(self.limites[posicion]) if posicion < len(self.limites) else round(self.maximo_ms, 1)
+        return round(self.maximo_ms, 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "llamadas": self.llamadas,
+            "con_reintento": self.con_reintento,
+            "reintentos": self.reintentos,
+            "latencia_ms": {
+                "media": round(self.total_ms / self.llamadas, 1) if self.llamadas else 0.0,
+                "maxima": round(self.maximo_ms, 1),
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+            },
+            "histograma_ms": {self._etiqueta(posicion): cantidad for posicion, cantidad in enumerate(self.histograma)},
+            "resultados": dict(self.resultados.most_common()),
+        }
+
+    def rows(self) -> List[Tuple[str, str, Any]]:
+        """Filas (sección, métrica, valor) para la hoja de telemetría."""
+        stats = self.stats()
+        filas: List[Tuple[str, str, Any]] = [
+            ("Resumen", "Llamadas", stats["llamadas"]),
+            ("Resumen", "Llamadas con reintento", stats["con_reintento"]),
+            ("Resumen", "Reintentos", stats["reintentos"]),
+        ]
+        filas += [("Latencia (ms)", metrica, valor) for metrica, valor in stats["latencia_ms"].items()]
+        filas += [("Histograma (ms)", intervalo, cantidad) for intervalo, cantidad in stats["histograma_ms"].items()]
+        filas += [("Resultado", resultado, cantidad) for resultado, cantidad in stats["resultados"].items()]
+        return filas
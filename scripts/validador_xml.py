@@ -7,9 +7,21 @@ Verifica autenticidad y estatus fiscal de comprobantes digitales
 import os
 import sys
 import json
+import mmap
+import time
 import pandas as pd
 from datetime import datetime
-from xml_utils import IssueTracker, load_xml_root, find_first, find_first_local, strip_namespace, get_attr, print_progress
+from checkpoint_utils import finish_checkpoint, open_checkpoint
+from preview_utils import run_preview, split_preview_flag
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.styles import PatternFill
+from progress_utils import ProgressReporter, open_progress
+from report_utils import ShardedWorkbook, column_widths
+from telemetry_utils import COLUMNAS_TELEMETRIA, RESULTADO_OK, CallTelemetry
+from xml_utils import (
+    IssueTracker, load_xml_root, find_first, find_first_local, strip_namespace, get_attr, print_progress, print_file_progress, iter_xml_files,
+    prefetch_xml_files, normalize_text, read_xml_bytes, scan_xml, StopScan
+)
 
 # Namespaces
 NAMESPACES_CFDI_40 = {
@@ -22,19 +34,107 @@ NAMESPACES_CFDI_33 = {
     "tfd": "http://www.sat.gob.mx/TimbreFiscalDigital",
 }
 
+# Columnas repetitivas del reporte que se guardan como categorías
+COLUMNAS_CATEGORICAS = [
+    'estatus',
+    'rfc_emisor', 'nombre_emisor',
+    'rfc_receptor', 'nombre_receptor',
+    'codigo_estatus', 'es_cancelable', 'estado_cancelacion',
+]
+
+# Color de fila por estatus (columna B); Excel evalúa las reglas al abrir, sin estilo por celda
+_COLORES_ESTATUS = {
+    'Vigente': 'C6EFCE',
+    'Cancelado': 'FFC7CE',
+    'No encontrado': 'FFEB9C',
+}
+_COLOR_ERROR = 'D3D3D3'
+
+
+def _relleno(color: str) -> PatternFill:
+    return PatternFill(start_color=color, end_color=color, fill_type='solid')
+
+
+REGLAS_ESTATUS = [
+    FormulaRule(formula=[f'$B2="{estatus}"'], fill=_relleno(color))
+    for estatus, color in _COLORES_ESTATUS.items()
+] + [
+    FormulaRule(
+        formula=['AND(' + ','.join(f'$B2<>"{estatus}"' for estatus in _COLORES_ESTATUS) + ')'],
+        fill=_relleno(_COLOR_ERROR),
+    )
+]
+
+
+# Elementos que necesita la consulta al SAT y el namespace que se prefiere para cada uno
+# (None: el del Comprobante); si no aparece en ese namespace se toma el primero con ese nombre.
+ELEMENTOS_ESCANEO = {
+    "Emisor": None,
+    "Receptor": None,
+    "TimbreFiscalDigital": NAMESPACES_CFDI_40["tfd"],
+}
+NAMESPACES_COMPROBANTE = (NAMESPACES_CFDI_40["cfdi"], NAMESPACES_CFDI_33["cfdi"])
 
-def extraer_datos_cfdi(filepath: str, tracker: IssueTracker) -> dict:
+
+def escanear_datos_cfdi(contenido) -> dict:
     """
-    Extrae los datos necesarios para validación: UUID, RFCs, Total
+    Lee Total, RFC/Nombre de emisor y receptor y UUID de las etiquetas de apertura, sin armar el árbol
+
+    Se detiene en cuanto tiene los tres elementos; en un CFDI el Timbre es de lo último, pero
+    nunca se construyen los nodos de conceptos ni complementos.
 
     Args:
-        filepath: Ruta al archivo XML
-        tracker: IssueTracker para registrar problemas
+        contenido: Bytes o mmap del archivo
 
     Returns:
-        Dict con los datos extraídos o None si falla
+        Dict con los datos o None si no es un Comprobante 3.3/4.0 o falta algún elemento
+        (extraer_datos_cfdi usa entonces el cargador completo)
     """
-    root = load_xml_root(filepath, tracker)
+    raiz = {}
+    preferidos = {}
+    primeros = {}
+
+    def inicio(uri, local, attrs):
+        if not raiz:
+            raiz.update(uri=uri, local=local, attrs=attrs)
+            if local != "Comprobante" or uri not in NAMESPACES_COMPROBANTE:
+                raise StopScan()
+            return
+        if local not in ELEMENTOS_ESCANEO or local in preferidos:
+            return
+        primeros.setdefault(local, attrs)
+        if uri == (ELEMENTOS_ESCANEO[local] or raiz["uri"]):
+            preferidos[local] = attrs
+            if len(preferidos) == len(ELEMENTOS_ESCANEO):
+                raise StopScan()
+
+    scan_xml(contenido, inicio)
+    if raiz.get("local") != "Comprobante" or raiz.get("uri") not in NAMESPACES_COMPROBANTE:
+        return None
+    elementos = {local: preferidos.get(local) or primeros.get(local) for local in ELEMENTOS_ESCANEO}
+    if any(attrs is None for attrs in elementos.values()):
+        return None
+    uuid = normalize_text(elementos["TimbreFiscalDigital"].get('UUID', ''))
+    if not uuid:
+        return None
+    return {
+        'uuid': uuid,
+        'rfc_emisor': normalize_text(elementos["Emisor"].get('Rfc', '')),
+        'nombre_emisor': normalize_text(elementos["Emisor"].get('Nombre', '')),
+        'rfc_receptor': normalize_text(elementos["Receptor"].get('Rfc', '')),
+        'nombre_receptor': normalize_text(elementos["Receptor"].get('Nombre', '')),
+        'total': normalize_text(raiz["attrs"].get('Total', '0.0')),
+    }
+
+
+def _datos_desde_arbol(filepath: str, tracker: IssueTracker, contenido=None) -> dict:
+    """
+    Los mismos datos que escanear_datos_cfdi con el árbol completo (lectura reparada y búsquedas por nombre local)
+
+    Returns:
+        Dict con los datos o None si el archivo no se pudo leer o no es un CFDI con UUID
+    """
+    root = load_xml_root(filepath, tracker, contenido)
     if root is None:
         return None
 
@@ -86,22 +186,118 @@ def extraer_datos_cfdi(filepath: str, tracker: IssueTracker) -> dict:
         tracker.error(f"'{filename}' no tiene UUID (TimbreFiscalDigital)")
         return None
 
-    if not rfc_emisor or not rfc_receptor or not total:
-        tracker.warn(f"'{filename}' tiene datos incompletos (RFC Emisor, Receptor o Total faltantes)")
-
     return {
-        'archivo': filename,
         'uuid': uuid,
         'rfc_emisor': rfc_emisor,
         'nombre_emisor': nombre_emisor,
         'rfc_receptor': rfc_receptor,
         'nombre_receptor': nombre_receptor,
         'total': total,
+    }
+
+
+def extraer_datos_cfdi(filepath: str, tracker: IssueTracker, contenido=None) -> dict:
+    """
+    Extrae los datos necesarios para validación: UUID, RFCs, Total
+
+    Primero con escanear_datos_cfdi; si el escaneo falla o le falta algo, con el árbol completo.
+
+    Args:
+        filepath: Ruta al archivo XML
+        tracker: IssueTracker para registrar problemas
+        contenido: Bytes del archivo ya leídos (opcional)
+
+    Returns:
+        Dict con los datos extraídos o None si falla
+    """
+    filename = os.path.basename(filepath)
+
+    datos = None
+    if not isinstance(contenido, BaseException):
+        try:
+            if contenido is None:
+                contenido = read_xml_bytes(filepath)
+            datos = escanear_datos_cfdi(contenido)
+        except Exception:
+            datos = None
+
+    if datos is None:
+        # El cargador completo repara codificaciones, aplica los límites y reporta los errores
+        datos = _datos_desde_arbol(filepath, tracker, contenido)
+        if datos is None:
+            return None
+    else:
+        tracker.count("xml_leidos")
+        if isinstance(contenido, mmap.mmap):
+            contenido.close()
+
+    if not datos['rfc_emisor'] or not datos['rfc_receptor'] or not datos['total']:
+        tracker.warn(f"'{filename}' tiene datos incompletos (RFC Emisor, Receptor o Total faltantes)")
+
+    datos.update({
         'estatus': '',
         'codigo_estatus': '',
         'es_cancelable': '',
         'estado_cancelacion': '',
         'fecha_validacion': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+    return {'archivo': filename, **datos}
+
+
+# Tipo de error por nombre de clase de la excepción o de alguna de sus causas, en orden de prioridad.
+# Se compara la clase concreta: en urllib3 NewConnectionError hereda de ConnectTimeoutError.
+_TIPOS_ERROR = [
+    ('soap_fault', {'Fault'}),
+    ('dns', {'gaierror', 'NameResolutionError'}),
+    ('timeout', {'Timeout', 'ConnectTimeout', 'ReadTimeout', 'TimeoutError', 'timeout', 'ReadTimeoutError', 'ConnectTimeoutError'}),
+    ('ssl', {'SSLError', 'SSLCertVerificationError'}),
+    ('http_5xx', {'RetryError', 'ResponseError'}),
+    ('conexion', {
+        'ConnectionError', 'NewConnectionError', 'ProtocolError', 'RemoteDisconnected',
+        'ConnectionRefusedError', 'ConnectionResetError', 'ConnectionAbortedError',
+    }),
+    ('respuesta_invalida', {'XMLSyntaxError', 'XMLParseError', 'ParseError'}),
+]
+
+
+def clasificar_error_sat(exc: BaseException) -> str:
+    """
+    Tipo de error de una consulta al SAT para la telemetría
+
+    Recorre la excepción y sus causas (__cause__, __context__, .reason de urllib3) sin importar
+    requests/urllib3/zeep: se compara por nombre de clase. Los errores HTTP se agrupan por familia
+    de código (http_4xx, http_5xx).
+    """
+    nombres = set()
+    estado = None
+    pendientes = [exc]
+    vistos = set()
+    while pendientes:
+        actual = pendientes.pop()
+        if not isinstance(actual, BaseException) or id(actual) in vistos:
+            continue
+        vistos.add(id(actual))
+        nombres.add(type(actual).__name__)
+        respuesta = getattr(actual, 'response', None)
+        estado = estado or getattr(respuesta, 'status_code', None) or getattr(actual, 'status_code', None)
+        pendientes.extend([actual.__cause__, actual.__context__, getattr(actual, 'reason', None), *actual.args])
+
+    for tipo, clases in _TIPOS_ERROR[:2]:
+        if nombres & clases:
+            return tipo
+    if isinstance(estado, int) and estado >= 400:
+        return 'http_5xx' if estado >= 500 else 'http_4xx'
+    for tipo, clases in _TIPOS_ERROR[2:]:
+        if nombres & clases:
+            return tipo
+    return 'otro'
+
+
+def _telemetria(inicio: float, resultado: str, reintentos: int) -> dict:
+    return {
+        'sat_latencia_ms': round((time.perf_counter() - inicio) * 1000, 1),
+        'sat_resultado': resultado,
+        'sat_reintentos': reintentos,
     }
 
 
@@ -117,7 +313,8 @@ def validar_con_sat(uuid: str, rfc_emisor: str, rfc_receptor: str, total: str, t
         tracker: IssueTracker para registrar problemas
 
     Returns:
-        Dict con el resultado de la validación
+        Dict con el resultado de la validación y la telemetría de la llamada (sat_latencia_ms,
+        incluida la carga del WSDL; sat_reintentos del adaptador de urllib3; sat_resultado)
     """
     try:
         # Importar zeep (SOAP client)
@@ -136,10 +333,20 @@ def validar_con_sat(uuid: str, rfc_emisor: str, rfc_receptor: str, total: str, t
             'estado_cancelacion': 'N/A'
         }
 
+    # Cada reintento que concede urllib3 pasa por increment(); new() conserva la subclase
+    reintentos = []
+
+    class RetryContado(Retry):
+        def increment(self, *args, **kwargs):
+            nuevo = super().increment(*args, **kwargs)
+            reintentos.append(nuevo)
+            return nuevo
+
+    inicio = time.perf_counter()
     try:
         # Configurar sesión con reintentos
         session = Session()
-        retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+        retry = RetryContado(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
         adapter = HTTPAdapter(max_retries=retry)
         session.mount('http://', adapter)
         session.mount('https://', adapter)
@@ -156,7 +363,7 @@ def validar_con_sat(uuid: str, rfc_emisor: str, rfc_receptor: str, total: str, t
         # Formato: ?re=RFC_EMISOR&rr=RFC_RECEPTOR&tt=TOTAL&id=UUID
         expresion = f"?re={rfc_emisor}&rr={rfc_receptor}&tt={total}&id={uuid}"
 
-        print_progress(f"  Consultando SAT para UUID: {uuid[:8]}...")
+        print_file_progress(f"  Consultando SAT para UUID: {uuid[:8]}...")
 
         # Llamar al servicio
         response = client.service.Consulta(expresion)
@@ -181,86 +388,101 @@ def validar_con_sat(uuid: str, rfc_emisor: str, rfc_receptor: str, total: str, t
             'estatus': estatus_texto,
             'codigo_estatus': str(codigo_estatus),
             'es_cancelable': str(es_cancelable),
-            'estado_cancelacion': str(estado_cancelacion)
+            'estado_cancelacion': str(estado_cancelacion),
+            **_telemetria(inicio, RESULTADO_OK, len(reintentos)),
         }
 
     except Exception as e:
-        tracker.warn(f"Error al validar UUID {uuid[:8]}: {e}")
+        tipo = clasificar_error_sat(e)
+        tracker.warn(f"Error al validar UUID {uuid[:8]} ({tipo}): {e}")
         return {
             'estatus': 'Error de conexión',
             'codigo_estatus': str(e),
             'es_cancelable': 'N/A',
-            'estado_cancelacion': 'N/A'
+            'estado_cancelacion': 'N/A',
+            **_telemetria(inicio, tipo, len(reintentos)),
         }
 
 
-def validar_archivos(workdir: str, tracker: IssueTracker) -> str:
+def validar_archivo(filepath: str, tracker: IssueTracker, filename: str = None, contenido=None) -> dict:
     """
-    Valida todos los archivos XML en el directorio
+    Extrae y valida con el SAT un solo archivo
 
     Args:
-        workdir: Directorio con los XMLs a validar
+        filepath: Ruta al archivo XML
         tracker: IssueTracker para registrar problemas
+        filename: Nombre a reportar (ruta relativa al directorio de trabajo)
+        contenido: Bytes del archivo ya leídos por prefetch_xml_files (opcional)
 
     Returns:
-        Path del archivo Excel generado
+        Dict con los datos del CFDI y el resultado de la validación
     """
-    # Obtener lista de archivos XML
-    xml_files = [f for f in os.listdir(workdir) if f.lower().endswith('.xml')]
+    filename = filename or os.path.basename(filepath)
 
-    if not xml_files:
-        tracker.error("No se encontraron archivos XML en el directorio")
-        return None
+    # Extraer datos del CFDI
+    datos = extraer_datos_cfdi(filepath, tracker, contenido)
 
-    print_progress(f"Validando {len(xml_files)} archivo(s) XML con el SAT...")
+    if datos is None:
+        # Error al procesar archivo
+        return {
+            'archivo': filename,
+            'uuid': 'N/A',
+            'rfc_emisor': 'N/A',
+            'nombre_emisor': 'N/A',
+            'rfc_receptor': 'N/A',
+            'nombre_receptor': 'N/A',
+            'total': 'N/A',
+            'estatus': 'ERROR',
+            'codigo_estatus': 'No se pudo leer el archivo',
+            'es_cancelable': 'N/A',
+            'estado_cancelacion': 'N/A',
+            'fecha_validacion': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
 
-    resultados = []
-    stats = {
-        'vigente': 0,
-        'cancelado': 0,
-        'no_encontrado': 0,
-        'error': 0
-    }
+    datos['archivo'] = filename
 
-    # Procesar cada archivo
-    for filename in xml_files:
-        filepath = os.path.join(workdir, filename)
+    # Validar con SAT
+    validacion = validar_con_sat(
+        datos['uuid'],
+        datos['rfc_emisor'],
+        datos['rfc_receptor'],
+        datos['total'],
+        tracker
+    )
 
-        # Extraer datos del CFDI
-        datos = extraer_datos_cfdi(filepath, tracker)
+    # Actualizar datos con resultado de validación
+    datos.update(validacion)
 
-        if datos is None:
-            # Error al procesar archivo
-            resultados.append({
-                'archivo': filename,
-                'uuid': 'N/A',
-                'rfc_emisor': 'N/A',
-                'nombre_emisor': 'N/A',
-                'rfc_receptor': 'N/A',
-                'nombre_receptor': 'N/A',
-                'total': 'N/A',
-                'estatus': 'ERROR',
-                'codigo_estatus': 'No se pudo leer el archivo',
-                'es_cancelable': 'N/A',
-                'estado_cancelacion': 'N/A',
-                'fecha_validacion': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            stats['error'] += 1
-            continue
+    print_file_progress(f"  ✓ {filename} → {datos['estatus']}")
 
-        # Validar con SAT
-        validacion = validar_con_sat(
-            datos['uuid'],
-            datos['rfc_emisor'],
-            datos['rfc_receptor'],
-            datos['total'],
-            tracker
-        )
+    return datos
+
+
+def escribir_reporte(workdir: str, resultados, tracker: IssueTracker, progreso: ProgressReporter) -> dict:
+    """
+    Genera Validacion_CFDI.xlsx a partir de los resultados de cada archivo
 
-        # Actualizar datos con resultado de validación
-        datos.update(validacion)
+    Args:
+        workdir: Directorio donde se escribe el reporte
+        resultados: Resultados de validar_archivo en orden de lote
+        tracker: IssueTracker para registrar problemas
+        progreso: Canal de progreso NDJSON
 
-        # Actualizar estadísticas
+    Returns:
+        Dict con el path del Excel y las estadísticas; los errores al escribir se propagan
+    """
+    resultados = list(resultados)
+    stats = {
+        'vigente': 0,
+        'cancelado': 0,
+        'no_encontrado': 0,
+        'error': 0
+    }
+    # Telemetría de las llamadas al SAT; viaja en cada registro, así cubre también lo reanudado del checkpoint
+    telemetria = CallTelemetry()
+    for datos in resultados:
+        if 'sat_latencia_ms' in datos:
+            telemetria.record(datos['sat_latencia_ms'], datos['sat_resultado'], datos['sat_reintentos'])
         if datos['estatus'] == 'Vigente':
             stats['vigente'] += 1
         elif datos['estatus'] == 'Cancelado':
@@ -270,9 +492,8 @@ def validar_archivos(workdir: str, tracker: IssueTracker) -> str:
         else:
             stats['error'] += 1
 
-        resultados.append(datos)
-
-        print_progress(f"  ✓ {filename} → {datos['estatus']}")
+    stats['lectura'] = tracker.read_stats()
+    stats['telemetria'] = telemetria.stats()
 
     # Crear DataFrame
     df = pd.DataFrame(resultados)
@@ -288,91 +509,108 @@ def validar_archivos(workdir: str, tracker: IssueTracker) -> str:
     ]
 
     df = df[columnas_orden]
+    df = df.astype({columna: 'category' for columna in COLUMNAS_CATEGORICAS})
 
     # Generar archivo Excel
     excel_filename = 'Validacion_CFDI.xlsx'
     excel_path = os.path.join(workdir, excel_filename)
 
     print_progress(f"\nGenerando reporte Excel...")
+    progreso.stage('excel')
+
+    with ShardedWorkbook(excel_path) as libro:
+        libro.write_frame('Validación', df, widths=column_widths(df), rules=REGLAS_ESTATUS)
+        if telemetria.llamadas:
+            df_telemetria = pd.DataFrame(telemetria.rows(), columns=COLUMNAS_TELEMETRIA)
+            libro.write_frame('Telemetría', df_telemetria, key_columns=2, widths=column_widths(df_telemetria))
+        libro.close()
+
+    print_progress(f"✓ Reporte generado: {excel_filename}")
+    print_progress(f"\nEstadísticas:")
+    print_progress(f"  - Vigentes: {stats['vigente']}")
+    print_progress(f"  - Cancelados: {stats['cancelado']}")
+    print_progress(f"  - No encontrados: {stats['no_encontrado']}")
+    print_progress(f"  - Errores: {stats['error']}")
+    if telemetria.llamadas:
+        latencia = stats['telemetria']['latencia_ms']
+        print_progress(
+            f"  - Consultas al SAT: {telemetria.llamadas}, latencia media {latencia['media']} ms, "
+            f"p90 <= {latencia['p90']} ms, reintentos {telemetria.reintentos}"
+        )
 
-    try:
-        with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Validación')
-
-            # Obtener el worksheet para aplicar formato
-            workbook = writer.book
-            worksheet = writer.sheets['Validación']
-
-            # Aplicar formato condicional por estatus
-            from openpyxl.styles import PatternFill, Font
-
-            # Color coding
-            vigente_fill = PatternFill(start_color='C6EFCE', end_color='C6EFCE', fill_type='solid')
-            cancelado_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-            no_encontrado_fill = PatternFill(start_color='FFEB9C', end_color='FFEB9C', fill_type='solid')
-            error_fill = PatternFill(start_color='D3D3D3', end_color='D3D3D3', fill_type='solid')
-
-            # Aplicar colores a las filas según estatus
-            for idx, row in enumerate(worksheet.iter_rows(min_row=2, max_row=len(df) + 1, min_col=1, max_col=len(columnas_orden)), start=2):
-                estatus = worksheet.cell(row=idx, column=2).value
-
-                if estatus == 'Vigente':
-                    fill = vigente_fill
-                elif estatus == 'Cancelado':
-                    fill = cancelado_fill
-                elif estatus == 'No encontrado':
-                    fill = no_encontrado_fill
-                else:
-                    fill = error_fill
-
-                for cell in row:
-                    cell.fill = fill
-
-            # Ajustar ancho de columnas
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-
-        print_progress(f"✓ Reporte generado: {excel_filename}")
-        print_progress(f"\nEstadísticas:")
-        print_progress(f"  - Vigentes: {stats['vigente']}")
-        print_progress(f"  - Cancelados: {stats['cancelado']}")
-        print_progress(f"  - No encontrados: {stats['no_encontrado']}")
-        print_progress(f"  - Errores: {stats['error']}")
-
-        return {'excel_path': excel_path, 'stats': stats}
+    return {'excel_path': excel_path, 'stats': stats}
+
+
+def validar_archivos(workdir: str, tracker: IssueTracker, progreso: ProgressReporter = None) -> str:
+    """
+    Valida todos los archivos XML en el directorio
+
+    Args:
+        workdir: Directorio con los XMLs a validar
+        tracker: IssueTracker para registrar problemas
+        progreso: Canal de progreso NDJSON (opcional)
+
+    Returns:
+        Path del archivo Excel generado
+    """
+    print_progress("Validando archivos XML con el SAT...")
+
+    # Los resultados por UUID se guardan periódicamente para reanudar si el proceso muere
+    checkpoint = open_checkpoint(workdir, 'validador_xml', tracker)
+
+    progreso = progreso or ProgressReporter('validador_xml', None)
+    progreso.restore(len(checkpoint.processed))
+    progreso.count_in_background(workdir)
+    progreso.stage('validacion')
 
+    # Procesar cada archivo conforme se descubre
+    entradas = checkpoint.pending(progreso.discover(iter_xml_files(workdir, order="name")))
+    for entrada, contenido in prefetch_xml_files(entradas):
+        checkpoint.add(entrada.relpath, validar_archivo(entrada.path, tracker, entrada.relpath, contenido), tracker)
+        progreso.advance(1, entrada.size, 1)
+
+    if not checkpoint.seen:
+        tracker.error("No se encontraron archivos XML en el directorio")
+        finish_checkpoint(checkpoint, True, tracker)
+        return None
+
+    checkpoint.end_reading(tracker)
+    try:
+        resultado = escribir_reporte(workdir, checkpoint.records(), tracker, progreso)
     except Exception as e:
         tracker.fatal(f"Error al crear Excel: {e}")
+        finish_checkpoint(checkpoint, False, tracker)
         return None
 
+    finish_checkpoint(checkpoint, True, tracker)
+    return resultado
+
 
 def main():
-    if len(sys.argv) < 2:
+    argumentos, preview = split_preview_flag(sys.argv[1:])
+    if not argumentos:
         print("ERROR: Falta el directorio de trabajo", file=sys.stderr)
         sys.exit(2)
 
-    workdir = sys.argv[1]
+    workdir = argumentos[0]
 
     if not os.path.isdir(workdir):
         print(f"ERROR: '{workdir}' no es un directorio válido", file=sys.stderr)
         sys.exit(2)
 
+    if preview:
+        sys.exit(run_preview(workdir, "validador_xml"))
+
     tracker = IssueTracker()
+    progreso = open_progress(workdir, 'validador_xml')
+    codigo_salida = 2
 
     try:
-        result = validar_archivos(workdir, tracker)
+        result = validar_archivos(workdir, tracker, progreso)
 
         # Reportar problemas
         tracker.report()
+        codigo_salida = tracker.exit_code
 
         # Output JSON con path y stats
         if result and 'excel_path' in result:
@@ -387,10 +625,13 @@ def main():
         sys.exit(tracker.exit_code)
 
     except Exception as e:
+        codigo_salida = 2
         print(f"FATAL: Error inesperado: {e}", file=sys.stderr)
         import traceback
         traceback.print_exc(file=sys.stderr)
         sys.exit(2)
+    finally:
+        progreso.finish(codigo_salida)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+"""Modo vigilancia: procesa los XML conforme llegan a una carpeta, sin repetir el lote completo.
+
+Uso:
+    watch_folder.py extractor_xml <workdir> [--una-vez]
+    watch_folder.py clasificador_xml <workdir> [--una-vez]
+
+(o `extractor_xml.py <workdir> --vigilar` / `clasificador_xml.py <workdir> --vigilar`)
+
+Cada revisión recorre la carpeta con iter_xml_files (o despierta antes por inotify en Linux) y
+toma los archivos nuevos o modificados cuya firma (tamaño, mtime) no cambió desde la revisión
+anterior ni en los últimos XML_VIGILAR_REPOSO segundos, para no leer archivos a medio copiar.
+El extractor agrega sus filas a `cfdi_datos_extraidos.csv` y, con XML_SQLITE_DB, al almacén
+SQLite; el clasificador copia cada archivo a su carpeta y reescribe `Clasificacion.manifest.json`.
+Lo procesado se guarda en `<workdir>/.vigilancia_<trabajo>.json`, así que al reiniciar solo se
+leen los archivos que llegaron o cambiaron mientras tanto. Cuando un archivo ya procesado
+cambia, sus filas anteriores se quitan del CSV antes de agregar las nuevas. Si el proceso muere
+entre escribir las salidas y guardar el estado, esos archivos se vuelven a procesar: el CSV puede
+repetir filas de un archivo que era nuevo (la última aparición es la vigente) y SQLite reemplaza
+por UUID.
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import select
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from report_utils import write_manifest
+from xml_utils import (
+    OUTPUT_DIRS,
+    IssueTracker,
+    XmlEntry,
+    env_flag,
+    env_float,
+    iter_xml_files,
+    prefetch_xml_files,
+    print_progress,
+)
+
+TRABAJOS = ("extractor_xml", "clasificador_xml")
+VIGILAR_FLAG = "--vigilar"
+
+# Pausa entre revisiones sin archivos en espera.
+INTERVALO_SEGUNDOS = env_float("XML_VIGILAR_INTERVALO", 5.0)
+# Tiempo sin cambios de tamaño ni mtime para considerar que un archivo terminó de escribirse.
+REPOSO_SEGUNDOS = env_float("XML_VIGILAR_REPOSO", 2.0)
+# inotify solo adelanta la siguiente revisión; sin él (u otro sistema) se sondea.
+USAR_INOTIFY = env_flag("XML_VIGILAR_INOTIFY", True)
+
+ARCHIVO_CSV = "cfdi_datos_extraidos.csv"
+MANIFIESTO_CLASIFICACION = "Clasificacion.manifest.json"
+
+# sys/inotify.h
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+Firma = Tuple[int, int]
+
+
+def split_watch_flag(argv: List[str]) -> Tuple[List[str], bool]:
+    """Separa `--vigilar` de los argumentos posicionales de la línea de comandos."""
+    return [arg for arg in argv if arg != VIGILAR_FLAG], VIGILAR_FLAG in argv
+
+
+def estado_path(workdir: str, job: str) -> str:
+    return os.path.join(workdir, f".vigilancia_{job}.json")
+
+
+class _Inotify:
+    """Descriptor de inotify vía libc; solo indica que algo cambió en las carpetas vigiladas."""
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self._carpetas: Dict[str, int] = {}
+
+    def vigilar(self, carpeta: str) -> None:
+        if carpeta in self._carpetas:
+            return
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(carpeta), _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        )
+        if wd >= 0:
+            self._carpetas[carpeta] = wd
+
+    def esperar(self, segundos: float) -> None:
+        listos, _, _ = select.select([self.fd], [], [], segundos)
+        if not listos:
+            return
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def vigilar_arbol(self, workdir: str) -> None:
+        """Agrega las carpetas que recorre iter_xml_files, incluidas las vacías donde aún no llega nada."""
+        for actual, carpetas, _ in os.walk(workdir):
+            carpetas[:] = [
+                nombre for nombre in carpetas
+                if not nombre.startswith(".") and not (actual == workdir and nombre in OUTPUT_DIRS)
+            ]
+            self.vigilar(actual)
+
+    def cerrar(self) -> None:
+        os.close(self.fd)
+
+
+def _abrir_inotify() -> Optional[_Inotify]:
+    if not USAR_INOTIFY or not sys.platform.startswith("linux"):
+        return None
+    try:
+        return _Inotify()
+    except (OSError, AttributeError):
+        return None
+
+
+class Vigilante:
+    """Firma de cada archivo procesado y los candidatos que esperan a dejar de cambiar."""
+
+    def __init__(self, workdir: str, job: str) -> None:
+        self.workdir = workdir
+        self.path = estado_path(workdir, job)
+        # relpath -> [tamaño, mtime_ns, resultado]; el resultado depende del trabajo.
+        self.archivos: Dict[str, List[Any]] = {}
+        self._candidatos: Dict[str, Firma] = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as handle:
+                self.archivos = json.load(handle).get("archivos", {})
+        except (OSError, ValueError):
+            pass
+
+    @property
+    def pendientes(self) -> int:
+        return len(self._candidatos)
+
+    def revisar(self) -> List[Tuple[XmlEntry, Firma]]:
+        """Archivos listos para procesar, en el orden de iter_xml_files."""
+        ahora = time.time_ns()
+        reposo = int(REPOSO_SEGUNDOS * 1e9)
+        listos: List[Tuple[XmlEntry, Firma]] = []
+        candidatos: Dict[str, Firma] = {}
+        for entrada in iter_xml_files(self.workdir, order="name"):
+            try:
+                stat = os.stat(entrada.path)
+            except OSError:
+                continue
+            firma = (stat.st_size, stat.st_mtime_ns)
+            anterior = self.archivos.get(entrada.relpath)
+            if anterior is not None and tuple(anterior[:2]) == firma:
+                continue
+            if self._candidatos.get(entrada.relpath) == firma and ahora - firma[1] >= reposo:
+                listos.append((XmlEntry(entrada.path, entrada.relpath, firma[0]), firma))
+            else:
+                candidatos[entrada.relpath] = firma
+        self._candidatos = candidatos
+        return listos
+
+    def marcar(self, relpath: str, firma: Firma, resultado: Any) -> None:
+        self.archivos[relpath] = [firma[0], firma[1], resultado]
+
+    def guardar(self) -> None:
+        write_manifest(self.path, {"archivos": self.archivos})
+
+
+def _procesador_gasto(workdir: str) -> Callable[[Vigilante, List[Tuple[XmlEntry, Firma]], IssueTracker], str]:
+    import pandas as pd
+
+    from extractor_xml import ESQUEMA_CONCEPTO, ESQUEMA_PAGO, cargar_en_almacen, convertir_columnas_numericas, procesar_entrada
+
+    columnas = [columna for columna in ESQUEMA_CONCEPTO.columnas if not columna.startswith("_")]
+    columnas += [columna for columna in ESQUEMA_PAGO.columnas if columna not in columnas and not columna.startswith("_")]
+    # Columna derivada que agrega convertir_columnas_numericas, en la misma posición.
+    columnas.insert(columnas.index("Total General"), "Total por Concepto")
+    columnas.append("_Archivo")
+    csv_path = os.path.join(workdir, ARCHIVO_CSV)
+
+    def procesar(vigilante: Vigilante, listos: List[Tuple[XmlEntry, Firma]], tracker: IssueTracker) -> str:
+        firmas = {entrada.relpath: firma for entrada, firma in listos}
+        modificados = {relpath for relpath in firmas if relpath in vigilante.archivos}
+        nuevas: List[Dict[str, Optional[str]]] = []
+        for entrada, contenido in prefetch_xml_files(entrada for entrada, _ in listos):
+            filas = procesar_entrada(entrada, contenido, tracker)
+            nuevas.extend(filas)
+            vigilante.marcar(entrada.relpath, firmas[entrada.relpath], len(filas))
+        quitadas = _quitar_filas_csv(csv_path, modificados) if modificados else 0
+        if not nuevas:
+            return f"0 fila(s), {quitadas} reemplazada(s)" if quitadas else "0 fila(s)"
+        df = convertir_columnas_numericas(pd.DataFrame(nuevas), tracker)
+        cargar_en_almacen(df, workdir, tracker)
+        df.reindex(columns=columnas).rename(columns={"_Archivo": "Archivo"}).to_csv(
+            csv_path, mode="a", index=False, header=not os.path.exists(csv_path), encoding="utf-8"
+        )
+        if quitadas:
+            return f"{len(nuevas)} fila(s) agregadas a {ARCHIVO_CSV}, {quitadas} anterior(es) reemplazada(s)"
+        return f"{len(nuevas)} fila(s) agregadas a {ARCHIVO_CSV}"
+
+    return procesar
+
+
+def _quitar_filas_csv(csv_path: str, archivos: Set[str], bloque: int = 100_000) -> int:
+    """Reescribe el CSV sin las filas de `archivos` (columna Archivo); devuelve cuántas quitó.
+
+    Se lee por bloques y como texto, así que las demás filas quedan tal como estaban.
+    """
+    import pandas as pd
+
+    if not os.path.exists(csv_path):
+        return 0
+    temporal = csv_path + ".tmp"
+    quitadas = 0
+    escritas = 0
+    for parte in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=bloque, encoding="utf-8"):
+        conservar = ~parte["Archivo"].isin(archivos)
+        quitadas += int((~conservar).sum())
+        parte[conservar].to_csv(
+            temporal, mode="a" if escritas else "w", index=False, header=not escritas, encoding="utf-8"
+        )
+        escritas += 1
+    if not quitadas:
+        if escritas:
+            os.remove(temporal)
+        return 0
+    os.replace(temporal, csv_path)
+    return quitadas
+
+
+def _procesador_clasificacion(workdir: str) -> Callable[[Vigilante, List[Tuple[XmlEntry, Firma]], IssueTracker], str]:
+    from clasificador_xml import CARPETAS_TIPO, clasificar_archivo, crear_carpetas
+
+    crear_carpetas(workdir)
+    manifiesto = os.path.join(workdir, MANIFIESTO_CLASIFICACION)
+
+    def procesar(vigilante: Vigilante, listos: List[Tuple[XmlEntry, Firma]], tracker: IssueTracker) -> str:
+        firmas = {entrada.relpath: firma for entrada, firma in listos}
+        for entrada, contenido in prefetch_xml_files(entrada for entrada, _ in listos):
+            anterior = vigilante.archivos.get(entrada.relpath)
+            tipo = clasificar_archivo(workdir, entrada, contenido, tracker)
+            if anterior is not None and anterior[2] in CARPETAS_TIPO and anterior[2] != tipo:
+                # Un archivo reescrito que cambió de tipo no debe quedar también en su carpeta anterior.
+                try:
+                    os.remove(os.path.join(workdir, CARPETAS_TIPO[anterior[2]], entrada.relpath))
+                except OSError:
+                    pass
+            vigilante.marcar(entrada.relpath, firmas[entrada.relpath], tipo)
+
+        tipos = {relpath: datos[2] for relpath, datos in sorted(vigilante.archivos.items())}
+        stats = {"nomina": 0, "gasto": 0, "vacios": 0, "total": len(tipos)}
+        for tipo in tipos.values():
+            stats["vacios" if tipo == "vacio" else tipo] += 1
+        write_manifest(manifiesto, {"carpetas": CARPETAS_TIPO, "stats": stats, "archivos": tipos})
+        return f"Nómina {stats['nomina']}, Gasto {stats['gasto']}, Vacíos {stats['vacios']} en total"
+
+    return procesar
+
+
+def vigilar(workdir: str, job: str, una_vez: bool = False) -> int:
+    """Procesa los archivos que van llegando hasta Ctrl+C (o, con `una_vez`, hasta que no quede ninguno en espera)."""
+    procesar = _procesador_gasto(workdir) if job == "extractor_xml" else _procesador_clasificacion(workdir)
+    prefijo = {"extractor_xml": "CFDI", "clasificador_xml": ""}[job]
+    vigilante = Vigilante(workdir, job)
+    inotify = _abrir_inotify()
+    print_progress(
+        f"Vigilando {workdir} ({'inotify' if inotify else f'sondeo cada {INTERVALO_SEGUNDOS:g} s'}); "
+        f"{len(vigilante.archivos)} archivo(s) ya procesados"
+    )
+    try:
+        while True:
+            listos = vigilante.revisar()
+            if listos:
+                tracker = IssueTracker()
+                resumen = procesar(vigilante, listos, tracker)
+                vigilante.guardar()
+                tracker.report(prefijo)
+                print_progress(f"{len(listos)} archivo(s) nuevos o modificados: {resumen}")
+            elif una_vez and not vigilante.pendientes:
+                return 0
+            espera = REPOSO_SEGUNDOS if vigilante.pendientes else INTERVALO_SEGUNDOS
+            if inotify is None:
+                time.sleep(espera)
+                continue
+            inotify.vigilar_arbol(workdir)
+            inotify.esperar(espera)
+    except KeyboardInterrupt:
+        print_progress("Vigilancia detenida")
+        return 0
+    finally:
+        if inotify is not None:
+            inotify.cerrar()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Procesa los XML que llegan a una carpeta, de forma incremental.")
+    parser.add_argument("trabajo", choices=TRABAJOS)
+    parser.add_argument("workdir")
+    parser.add_argument("--una-vez", action="store_true", help="Terminar cuando no queden archivos en espera")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        print(f"ERROR: '{args.workdir}' no es un directorio válido", file=sys.stderr)
+        return 2
+    return vigilar(args.workdir, args.trabajo, args.una_vez)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
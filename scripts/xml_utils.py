@@ -1,8 +1,97 @@
+import codecs
+import mmap
 import os
 import re
 import sys
+import time
 import xml.etree.ElementTree as ET
-from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from decimal import Decimal, InvalidOperation
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from xml.parsers import expat
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "si", "sí", "yes", "on")
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+# XML_MONTOS_EXACTOS=1 converts peso amounts to Decimal so batch totals do not drift.
+EXACT_AMOUNTS = env_flag("XML_MONTOS_EXACTOS")
+
+# Files at or above this size are memory-mapped instead of read into a bytes copy.
+MMAP_THRESHOLD = 1024 * 1024
+
+# C0 control bytes that are invalid in XML 1.0 (tab, LF and CR are kept).
+_CONTROL_BYTES = bytes(range(0x00, 0x09)) + b"\x0b\x0c" + bytes(range(0x0E, 0x20))
+
+_BOMS: Tuple[Tuple[bytes, str], ...] = (
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+_XML_DECLARED_ENCODING = re.compile(rb"""^\s*<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._:-]+)["']""")
+
+# Per-file resource limits; a file over any of them is discarded and the batch continues.
+MAX_XML_BYTES = env_int("XML_MAX_BYTES", 100 * 1024 * 1024)
+MAX_XML_ELEMENTS = env_int("XML_MAX_ELEMENTOS", 2_000_000)
+MAX_XML_DEPTH = env_int("XML_MAX_PROFUNDIDAD", 256)
+MAX_PARSE_SECONDS = env_float("XML_MAX_SEGUNDOS", 30.0)
+_GUARDED_CHUNK = 1024 * 1024
+
+
+class XMLLimitError(Exception):
+    """An XML file exceeded one of the configured resource limits."""
+
+
+class _GuardedTreeBuilder(ET.TreeBuilder):
+    """TreeBuilder that aborts on a DOCTYPE, too many elements, too deep nesting or too much time.
+
+    Every parse goes through it, whatever the file size or the bytes the repair path removed.
+    """
+
+    def __init__(self, deadline: float) -> None:
+        super().__init__()
+        self._deadline = deadline
+        self._elements = 0
+        self._depth = 0
+
+    def start(self, tag, attrs):
+        self._elements += 1
+        self._depth += 1
+        if self._depth > MAX_XML_DEPTH:
+            raise XMLLimitError(f"profundidad mayor a {MAX_XML_DEPTH} niveles")
+        if self._elements > MAX_XML_ELEMENTS:
+            raise XMLLimitError(f"más de {MAX_XML_ELEMENTS} elementos")
+        if not self._elements & 0x3FF and time.monotonic() > self._deadline:
+            raise XMLLimitError(f"lectura mayor a {MAX_PARSE_SECONDS:g} s")
+        return super().start(tag, attrs)
+
+    def end(self, tag):
+        self._depth -= 1
+        return super().end(tag)
+
+    def doctype(self, name, pubid, system):
+        # Called at the start of the declaration, before the internal subset: no entity is ever expanded.
+        raise XMLLimitError("DOCTYPE no permitido")
 
 
 class IssueTracker:
@@ -12,6 +101,22 @@ class IssueTracker:
         self.warnings: List[str] = []
         self.errors: List[str] = []
         self.fatals: List[str] = []
+        self.counters: Dict[str, int] = {}
+
+    def count(self, key: str, amount: int = 1) -> None:
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def read_stats(self) -> Dict[str, Any]:
+        """Files read vs. files that needed encoding repair."""
+        leidos = self.counters.get("xml_leidos", 0)
+        reparados = self.counters.get("xml_reparados", 0)
+        tasa = round(100.0 * reparados / leidos, 2) if leidos else 0.0
+        return {
+            "leidos": leidos,
+            "reparados": reparados,
+            "tasa_reparacion": tasa,
+            "descartados": self.counters.get("xml_descartados", 0),
+        }
 
     def warn(self, message: str) -> None:
         self.warnings.append(message)
@@ -38,12 +143,30 @@ class IssueTracker:
             print(f"{label}ERROR: {msg}", file=sys.stderr)
         for msg in self.fatals:
             print(f"{label}FATAL: {msg}", file=sys.stderr)
+        if self.counters.get("xml_leidos"):
+            stats = self.read_stats()
+            print(
+                f"{label}INFO: XML leídos: {stats['leidos']}, reparados: {stats['reparados']} "
+                f"({stats['tasa_reparacion']}%), descartados por límites: {stats['descartados']}",
+                file=sys.stderr,
+            )
+
+
+@lru_cache(maxsize=env_int("XML_CACHE_TEXTO", 65536))
+def normalize_attr(text: str) -> Optional[str]:
+    """normalize_text for a str known to be one (attribute values); memoized and interned."""
+    if not text.isascii():
+        text = text.encode("utf-8", "replace").decode("utf-8", "replace")
+    text = text.strip()
+    return sys.intern(text) if text else None
 
 
 def normalize_text(value: Any) -> Optional[str]:
     """Return stripped utf-8-safe text; blank -> None."""
     if value is None:
         return None
+    if type(value) is str:
+        return normalize_attr(value)
     try:
         text = str(value)
     except Exception:
@@ -66,40 +189,291 @@ def to_float(value: Any, default: float = 0.0, tracker: Optional[IssueTracker] =
         return default
 
 
+def report_numeric_failures(
+    tracker: Optional[IssueTracker], column: str, failed_values: List[Any], total_failed: Optional[int] = None
+) -> None:
+    """One aggregated warning per column instead of one per cell."""
+    if tracker is None or not failed_values:
+        return
+    total = total_failed if total_failed is not None else len(failed_values)
+    muestra = ", ".join(f"'{value}'" for value in list(dict.fromkeys(failed_values))[:5])
+    tracker.warn(f"No se pudo convertir a número {total} valor(es) en {column} (ej. {muestra})")
+
+
+def to_numeric_column(
+    values: Iterable[Any],
+    column: str,
+    tracker: Optional[IssueTracker] = None,
+    default: Any = 0.0,
+    exact: bool = False,
+) -> List[Any]:
+    """Convert a whole column of raw strings at once; exact=True yields Decimal.
+
+    NaN and infinities count as failures in both paths.
+    """
+    if not exact:
+        import pandas as pd
+
+        crudo = pd.Series(list(values), dtype=object)
+        vacio = crudo.isna() | (crudo == "")
+        numerico = pd.to_numeric(crudo.where(~vacio), errors="coerce").astype(float)
+        fallidos = ~vacio & ~numerico.between(-float("inf"), float("inf"), inclusive="neither")
+        if fallidos.any():
+            report_numeric_failures(tracker, column, crudo[fallidos].head(50).tolist(), int(fallidos.sum()))
+        return numerico.where(~fallidos & ~vacio, float(default)).tolist()
+
+    default_value = Decimal(default)
+    result: List[Any] = []
+    failed: List[Any] = []
+    append = result.append
+    for value in values:
+        if value is None or value == "" or value != value:  # value != value: NaN from pandas
+            append(default_value)
+            continue
+        try:
+            converted = Decimal(value)
+        except (TypeError, ValueError, InvalidOperation):
+            converted = None
+        if converted is None or not converted.is_finite():
+            failed.append(value)
+            append(default_value)
+        else:
+            append(converted)
+    report_numeric_failures(tracker, column, failed)
+    return result
+
+
 def strip_namespace(tag: str) -> str:
     if "}" in tag:
         return tag.split("}", 1)[1]
     return tag
 
 
-def load_xml_root(path: str, tracker: IssueTracker) -> Optional[ET.Element]:
-    """Load XML defensively and strip namespaces where needed."""
-    if not os.path.exists(path):
+# Versiones de un mismo estándar del SAT: comparten nombres locales y atributos, solo cambia el URI.
+NAMESPACE_FAMILIES: Dict[str, str] = {
+    "http://www.sat.gob.mx/cfd/3": "cfdi",
+    "http://www.sat.gob.mx/cfd/4": "cfdi",
+    "http://www.sat.gob.mx/TimbreFiscalDigital": "tfd",
+    "http://www.sat.gob.mx/Pagos": "pago",
+    "http://www.sat.gob.mx/Pagos20": "pago",
+    "http://www.sat.gob.mx/nomina12": "nomina12",
+}
+
+
+@lru_cache(maxsize=4096)
+def family_tag(tag: str) -> str:
+    """'{http://www.sat.gob.mx/cfd/3}Concepto' -> 'cfdi:Concepto'; namespaces ajenos quedan como '{uri}Local'."""
+    if not tag.startswith("{"):
+        return tag
+    uri, local = tag[1:].split("}", 1)
+    familia = NAMESPACE_FAMILIES.get(uri)
+    return f"{familia}:{local}" if familia else tag
+
+
+def read_xml_bytes(path: str, use_mmap: bool = True) -> Union[bytes, mmap.mmap]:
+    """Read a file once; large files are memory-mapped unless use_mmap=False (caller closes mmaps)."""
+    with open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size > MAX_XML_BYTES:
+            raise XMLLimitError(f"tamaño de {size} bytes mayor al límite de {MAX_XML_BYTES}")
+        if use_mmap and size >= MMAP_THRESHOLD:
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return handle.read()
+
+
+def _count_bytes(data: Union[bytes, mmap.mmap], token: bytes) -> int:
+    if isinstance(data, bytes):
+        return data.count(token)
+    return sum(data[offset : offset + _GUARDED_CHUNK].count(token) for offset in range(0, len(data), _GUARDED_CHUNK))
+
+
+def check_xml_limits(data: Union[bytes, mmap.mmap]) -> None:
+    """Cheap byte-level check run before parsing: element estimate. DTDs are refused by the parser."""
+    # Start tags plus comments/PIs: an upper bound of the element count without parsing.
+    estimated = _count_bytes(data, b"<") - _count_bytes(data, b"</")
+    if estimated > MAX_XML_ELEMENTS:
+        raise XMLLimitError(f"aprox. {estimated} elementos, más de {MAX_XML_ELEMENTS}")
+
+
+def detect_xml_encoding(data: Union[bytes, mmap.mmap]) -> Tuple[Optional[str], int]:
+    """Return (encoding, BOM length) from the leading bytes; encoding is None if undeclared."""
+    head = bytes(data[:256])
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    match = _XML_DECLARED_ENCODING.match(head)
+    if match:
+        return match.group(1).decode("ascii").lower(), 0
+    return None, 0
+
+
+def _parse_buffer(data: Union[bytes, mmap.mmap], encoding: Optional[str] = None) -> ET.Element:
+    deadline = time.monotonic() + MAX_PARSE_SECONDS
+    parser = ET.XMLParser(target=_GuardedTreeBuilder(deadline), encoding=encoding)
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), _GUARDED_CHUNK):
+            parser.feed(view[offset : offset + _GUARDED_CHUNK])
+            if time.monotonic() > deadline:
+                raise XMLLimitError(f"lectura mayor a {MAX_PARSE_SECONDS:g} s")
+        return parser.close()
+    finally:
+        view.release()
+
+
+_INVALID_TOKEN = expat.errors.codes[expat.errors.XML_ERROR_INVALID_TOKEN]
+
+
+def _stops_at_invalid_utf8(data: Union[bytes, mmap.mmap], error: BaseException) -> bool:
+    """True when `error` is expat's invalid token at a byte that is not UTF-8 (latin-1 text)."""
+    if getattr(error, "code", None) != _INVALID_TOKEN:
+        return False
+    line, column = error.position
+    start = 0
+    for _ in range(line - 1):
+        start = data.find(b"\n", start) + 1
+    # expat counts columns in characters; a window of 4 bytes per character covers the line prefix.
+    window = bytes(data[start : start + 4 * column + 4096])
+    try:
+        window.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        return exc.reason != "unexpected end of data"
+    return False
+
+
+def _parse_repaired(data: Union[bytes, mmap.mmap], error: BaseException) -> ET.Element:
+    """Re-parse after `error`: latin-1 if it stopped at a non-UTF-8 byte, without control bytes if any."""
+    encoding, bom_length = detect_xml_encoding(data)
+    if encoding and encoding.startswith("utf-16"):
+        # Byte-level control stripping would corrupt UTF-16; expat handles the BOM itself.
+        return _parse_buffer(data)
+    if encoding in (None, "utf8"):
+        encoding = "utf-8"
+    body: Union[bytes, mmap.mmap] = bytes(data[bom_length:]) if bom_length else data
+    stripped = False
+    while True:
+        if encoding != "iso-8859-1" and (
+            isinstance(error, LookupError)
+            or (encoding == "utf-8" and _stops_at_invalid_utf8(body, error))
+            or (encoding != "utf-8" and stripped)
+        ):
+            encoding = "iso-8859-1"
+        elif not stripped:
+            stripped = True
+            cleaned = bytes(body).translate(None, _CONTROL_BYTES)
+            if len(cleaned) == len(body):
+                continue
+            body = cleaned
+        else:
+            raise error
+        try:
+            return _parse_buffer(body, encoding)
+        except (ET.ParseError, LookupError) as exc:
+            error = exc
+
+
+XmlBuffer = Union[bytes, mmap.mmap]
+
+
+def load_xml_root(
+    path: str, tracker: IssueTracker, data: Union[XmlBuffer, BaseException, None] = None
+) -> Optional[ET.Element]:
+    """Load XML defensively: one read, resource limits, encoding/control-byte repair if needed.
+
+    `data` may carry bytes already fetched by prefetch_xml_files (or the exception raised
+    while fetching them); mmaps are closed once parsed.
+    """
+    if data is None and not os.path.exists(path):
         tracker.fatal(f"Archivo no encontrado: {path}")
         return None
     try:
-        tree = ET.parse(path)
-        root = tree.getroot()
-    except Exception as exc:
-        # Fallback: attempt to decode with alternative encodings
+        if isinstance(data, BaseException):
+            raise data
+        if data is None:
+            data = read_xml_bytes(path)
+        tracker.count("xml_leidos")
+        check_xml_limits(data)
         try:
-            with open(path, "rb") as handle:
-                raw = handle.read()
+            root = _parse_buffer(data)
+        except XMLLimitError:
+            raise
+        except Exception as exc:
+            # Fallback: BOM/encoding detection and control-byte removal over the same buffer
             try:
-                text = raw.decode("utf-8-sig")
-            except UnicodeDecodeError:
-                text = raw.decode("latin-1")
-            # Remove invalid control chars that break XML parsing.
-            text = re.sub(r"[\x00-\x08\x0B\x0C\x0E-\x1F]", "", text)
-            root = ET.fromstring(text)
-            tracker.warn(f"Se reparó la lectura XML con fallback de codificación en {os.path.basename(path)}")
-        except Exception as inner_exc:
-            tracker.fatal(f"No se pudo leer/parsing XML '{os.path.basename(path)}': {exc}")
-            tracker.error(f"Detalle fallback: {inner_exc}")
-            return None
+                root = _parse_repaired(data, exc)
+                tracker.count("xml_reparados")
+                tracker.warn(f"Se reparó la lectura XML con fallback de codificación en {os.path.basename(path)}")
+            except XMLLimitError:
+                raise
+            except Exception as inner_exc:
+                tracker.fatal(f"No se pudo leer/parsing XML '{os.path.basename(path)}': {exc}")
+                tracker.error(f"Detalle fallback: {inner_exc}")
+                return None
+    except XMLLimitError as exc:
+        tracker.count("xml_descartados")
+        tracker.warn(f"Archivo '{os.path.basename(path)}' descartado por límite de recursos: {exc}")
+        return None
+    except Exception as exc:
+        tracker.fatal(f"No se pudo leer/parsing XML '{os.path.basename(path)}': {exc}")
+        return None
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
     return root
 
 
+class StopScan(Exception):
+    """Raised by a scan_xml callback once it has every value it needs."""
+
+
+def scan_xml(data: XmlBuffer, on_start: Callable[[str, str, Dict[str, str]], None]) -> bool:
+    """Stream start tags to `on_start(namespace_uri, local_name, attrs)` without building a tree.
+
+    Returns True when the callback stopped early with StopScan, False at the end of the
+    document. Parse errors, DTDs and the element/depth/time limits raise; callers fall back to
+    load_xml_root, which repairs or reports the file as usual.
+    """
+    parser = expat.ParserCreate(namespace_separator="}")
+    deadline = time.monotonic() + MAX_PARSE_SECONDS
+    elements = 0
+    depth = 0
+
+    def start(name: str, attrs: Dict[str, str]) -> None:
+        nonlocal elements, depth
+        elements += 1
+        depth += 1
+        if depth > MAX_XML_DEPTH:
+            raise XMLLimitError(f"profundidad mayor a {MAX_XML_DEPTH} niveles")
+        if elements > MAX_XML_ELEMENTS:
+            raise XMLLimitError(f"más de {MAX_XML_ELEMENTS} elementos")
+        uri, _, local = name.rpartition("}")
+        on_start(uri, local, attrs)
+
+    def end(_name: str) -> None:
+        nonlocal depth
+        depth -= 1
+
+    def doctype(*_args: Any) -> None:
+        # Rejected before the internal subset is read, so no entity is ever expanded.
+        raise XMLLimitError("DOCTYPE no permitido")
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.StartDoctypeDeclHandler = doctype
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), _GUARDED_CHUNK):
+            parser.Parse(view[offset : offset + _GUARDED_CHUNK], False)
+            if time.monotonic() > deadline:
+                raise XMLLimitError(f"lectura mayor a {MAX_PARSE_SECONDS:g} s")
+        parser.Parse(b"", True)
+    except StopScan:
+        return True
+    finally:
+        view.release()
+    return False
+
+
 def find_first(root: ET.Element, xpath: str, namespaces: Dict[str, str]) -> Optional[ET.Element]:
     try:
         return root.find(xpath, namespaces)
@@ -135,10 +509,148 @@ def safe_attrib(element: Optional[ET.Element]) -> Dict[str, str]:
     return {k: normalize_text(v) or "" for k, v in (element.attrib.items() if element is not None else [])}
 
 
+# Folders the tools create inside the workdir; never treated as input.
+OUTPUT_DIRS = frozenset({"Nomina", "Gasto", "Vacios"})
+
+
+class XmlEntry(NamedTuple):
+    path: str
+    relpath: str
+    size: int
+    mtime_ns: int = 0
+
+
+def iter_xml_files(
+    directorio: str,
+    recursive: bool = True,
+    min_size: int = 0,
+    max_size: Optional[int] = None,
+    order: Optional[str] = None,
+) -> Iterator[XmlEntry]:
+    """Yield .xml files under `directorio` while os.scandir is still reading each folder.
+
+    Files come in directory order, each folder before its subfolders. order="name" (or
+    "size", largest first) sorts each folder's files and subfolders, which means listing the
+    whole folder before its first file. Every output depends on the input order, so the
+    processing entry points ask for "name"; only counting and sampling walk unsorted.
+    Hidden folders and the top-level output folders are skipped.
+    """
+    pending: List[Tuple[str, str]] = [(directorio, "")]
+    while pending:
+        current, prefix = pending.pop()
+        files: List[XmlEntry] = []
+        subdirs: List[Tuple[str, str]] = []
+        try:
+            with os.scandir(current) as iterator:
+                for entry in iterator:
+                    name = entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and not name.startswith(".") and not (not prefix and name in OUTPUT_DIRS):
+                                subdirs.append((entry.path, prefix + name + os.sep))
+                            continue
+                        if not name.lower().endswith(".xml") or not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    size = stat.st_size
+                    if size < min_size or (max_size is not None and size > max_size):
+                        continue
+                    found = XmlEntry(entry.path, prefix + name, size, stat.st_mtime_ns)
+                    if order is None:
+                        yield found
+                    else:
+                        files.append(found)
+        except OSError:
+            pass
+        if order == "size":
+            files.sort(key=lambda item: (-item.size, item.relpath))
+        elif order is not None:
+            files.sort(key=lambda item: item.relpath)
+        yield from files
+        if order is not None:
+            subdirs.sort()
+        pending.extend(reversed(subdirs))
+
+
+# Read-ahead: threads fetching upcoming files while the current one is parsed (0 disables).
+PREFETCH_WORKERS = env_int("XML_PREFETCH_HILOS", 4)
+PREFETCH_AHEAD = env_int("XML_PREFETCH_ARCHIVOS", 32)
+PREFETCH_MAX_BYTES = env_int("XML_PREFETCH_MAX_BYTES", 64 * 1024 * 1024)
+
+
+def _fetch(entry: XmlEntry) -> Union[bytes, BaseException]:
+    # Plain bytes, never an mmap: the point is to have the I/O done (also on NFS) by the
+    # time the consumer gets here, and a bytes object needs no closing if it is never used.
+    try:
+        return read_xml_bytes(entry.path, use_mmap=False)
+    except Exception as exc:
+        return exc
+
+
+def prefetch_xml_files(
+    entries: Iterable[XmlEntry],
+    workers: int = PREFETCH_WORKERS,
+    ahead: int = PREFETCH_AHEAD,
+    max_bytes: int = PREFETCH_MAX_BYTES,
+) -> Iterator[Tuple[XmlEntry, Union[XmlBuffer, BaseException, None]]]:
+    """Yield (entry, contents) in input order while a thread pool reads the next files.
+
+    At most `ahead` files and `max_bytes` (by stat size) are read ahead; a file larger than
+    the cap is yielded with None and read by the consumer as usual. Read errors are yielded
+    as the exception so load_xml_root reports them as usual. Closing the generator early
+    cancels the reads still queued.
+    """
+    if workers <= 0:
+        for entry in entries:
+            yield entry, None
+        return
+
+    source = iter(entries)
+    in_flight: deque = deque()
+    in_flight_bytes = 0
+    following: Optional[XmlEntry] = next(source, None)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xml-prefetch")
+    try:
+        while following is not None or in_flight:
+            while following is not None and (not in_flight or len(in_flight) < ahead):
+                if following.size > max_bytes:
+                    in_flight.append((following, None))
+                elif in_flight_bytes + following.size <= max_bytes:
+                    in_flight.append((following, pool.submit(_fetch, following)))
+                    in_flight_bytes += following.size
+                else:
+                    break
+                following = next(source, None)
+            entry, future = in_flight.popleft()
+            if future is None:
+                yield entry, None
+                continue
+            in_flight_bytes -= entry.size
+            yield entry, future.result()
+    finally:
+        for _, future in in_flight:
+            if future is not None:
+                future.cancel()
+        in_flight.clear()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# Low-overhead mode for very large batches: no per-file lines, batched progress events.
+PROGRESS_LIGHT = env_flag("XML_PROGRESO_LIGERO")
+
+
 def print_progress(message: str) -> None:
     print(message, file=sys.stderr)
 
 
+def print_file_progress(message: str) -> None:
+    """Per-file line; skipped in light mode, where it would dominate stderr on 100k-file runs."""
+    if not PROGRESS_LIGHT:
+        print(message, file=sys.stderr)
+
+
 def collect_namespace_uris(root: ET.Element) -> List[str]:
     uris = set()
     for elem in root.iter():
@@ -0,0 +1,221 @@
+"""ZIP con deflate en paralelo: los miembros se comprimen en un pool de hilos y se escriben en orden.
+
+zlib suelta el GIL mientras comprime, así que basta con hilos. Cada miembro lo comprime un solo
+compresor de principio a fin y el escritor no usa la hora actual (los directorios llevan la
+fecha mínima del formato), así que el archivo es el mismo byte por byte sin importar cuántos
+hilos se usen. Los tamaños, desplazamientos y número de entradas que no caben en 32/16 bits se
+escriben con las extensiones ZIP64.
+"""
+
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from xml_utils import env_int
+
+ZIP_HILOS = env_int("XML_ZIP_HILOS", os.cpu_count() or 1)
+# Miembros y bytes (por tamaño sin comprimir) en vuelo; uno más grande que el tope va solo.
+ZIP_ADELANTE = env_int("XML_ZIP_ARCHIVOS", 64)
+ZIP_MAX_BYTES_VUELO = env_int("XML_ZIP_MAX_BYTES_VUELO", 256 * 1024 * 1024)
+ZIP_NIVEL = env_int("XML_ZIP_NIVEL", 6)
+
+_BLOQUE_LECTURA = 1024 * 1024
+
+_STORED = 0
+_DEFLATED = 8
+_UNIX = 3
+_VERSION = 20
+_VERSION_ZIP64 = 45
+_LIMITE_32 = 0xFFFFFFFF
+_LIMITE_16 = 0xFFFF
+_FLAG_UTF8 = 0x800
+# Fecha DOS mínima (1980-01-01 00:00) para las entradas que no vienen de un archivo.
+_FECHA_MINIMA = (0, (0 << 9) | (1 << 5) | 1)
+_ATRIBUTOS_DIRECTORIO = (0o40775 << 16) | 0x10
+
+_LOCAL = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+_FIN = struct.Struct("<IHHHHIIH")
+_FIN_ZIP64 = struct.Struct("<IQHHIIQQQQ")
+_LOCALIZADOR_ZIP64 = struct.Struct("<IIQI")
+
+
+class Miembro(NamedTuple):
+    nombre: str
+    datos: bytes  # ya comprimidos con `metodo`
+    crc: int
+    tamano: int  # sin comprimir
+    metodo: int
+    fecha: Tuple[int, int]  # (hora DOS, fecha DOS)
+    atributos: int  # atributos externos (modo Unix << 16)
+
+
+def _fecha_dos(mtime: float) -> Tuple[int, int]:
+    anio, mes, dia, hora, minuto, segundo = time.localtime(mtime)[:6]
+    if anio < 1980:
+        return _FECHA_MINIMA
+    anio = min(anio, 2107)
+    return (hora << 11) | (minuto << 5) | (segundo // 2), ((anio - 1980) << 9) | (mes << 5) | dia
+
+
+def comprimir_archivo(path: str, nombre: str, nivel: int = ZIP_NIVEL) -> Miembro:
+    """Lee y comprime un archivo en deflate crudo, por bloques, calculando el CRC-32 en el camino."""
+    estado = os.stat(path)
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    partes: List[bytes] = []
+    crc = 0
+    tamano = 0
+    with open(path, "rb") as handle:
+        while True:
+            bloque = handle.read(_BLOQUE_LECTURA)
+            if not bloque:
+                break
+            crc = zlib.crc32(bloque, crc)
+            tamano += len(bloque)
+            partes.append(compresor.compress(bloque))
+    partes.append(compresor.flush())
+    return Miembro(
+        nombre.replace(os.sep, "/"), b"".join(partes), crc, tamano, _DEFLATED,
+        _fecha_dos(estado.st_mtime), (estado.st_mode & 0xFFFF) << 16,
+    )
+
+
+def directorio(nombre: str) -> Miembro:
+    """Entrada de carpeta vacía ('Nomina/')."""
+    return Miembro(nombre.rstrip("/") + "/", b"", 0, 0, _STORED, _FECHA_MINIMA, _ATRIBUTOS_DIRECTORIO)
+
+
+def comprimir_en_paralelo(
+    archivos: Iterable[Tuple[str, str, int]],
+    hilos: int = ZIP_HILOS,
+    adelante: int = ZIP_ADELANTE,
+    max_bytes: int = ZIP_MAX_BYTES_VUELO,
+) -> Iterator[Miembro]:
+    """Miembros de (ruta, nombre en el ZIP, tamaño) en el mismo orden, comprimidos por un pool de hilos.
+
+    Los errores de lectura salen al consumir el miembro que falló.
+    """
+    if hilos <= 1:
+        for path, nombre, _ in archivos:
+            yield comprimir_archivo(path, nombre)
+        return
+
+    origen = iter(archivos)
+    en_vuelo: deque = deque()
+    bytes_en_vuelo = 0
+    siguiente = next(origen, None)
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="zip-deflate") as pool:
+        while siguiente is not None or en_vuelo:
+            while siguiente is not None and (
+                not en_vuelo or (len(en_vuelo) < adelante and bytes_en_vuelo + siguiente[2] <= max_bytes)
+            ):
+                en_vuelo.append((siguiente[2], pool.submit(comprimir_archivo, siguiente[0], siguiente[1])))
+                bytes_en_vuelo += siguiente[2]
+                siguiente = next(origen, None)
+            tamano, futuro = en_vuelo.popleft()
+            bytes_en_vuelo -= tamano
+            yield futuro.result()
+
+
+def _extra_zip64(*valores: int) -> bytes:
+    if not valores:
+        return b""
+    return struct.pack(f"<HH{len(valores)}Q", 0x0001, 8 * len(valores), *valores)
+
+
+class ZipWriter:
+    """ZIP de solo escritura para miembros ya comprimidos, en el orden en que se agregan."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.handle = open(path, "wb")
+        self.posicion = 0
+        self.central: List[bytes] = []
+        self.tamano_central = 0
+
+    def tell(self) -> int:
+        return self.posicion
+
+    @staticmethod
+    def _local(miembro: Miembro) -> bytes:
+        nombre = miembro.nombre.encode("utf-8")
+        zip64 = miembro.tamano >= _LIMITE_32 or len(miembro.datos) >= _LIMITE_32
+        extra = _extra_zip64(miembro.tamano, len(miembro.datos)) if zip64 else b""
+        flags = _FLAG_UTF8 if not miembro.nombre.isascii() else 0
+        encabezado = _LOCAL.pack(
+            0x04034B50, _VERSION_ZIP64 if zip64 else _VERSION, flags, miembro.metodo, *miembro.fecha, miembro.crc,
+            _LIMITE_32 if zip64 else len(miembro.datos), _LIMITE_32 if zip64 else miembro.tamano,
+            len(nombre), len(extra),
+        )
+        return encabezado + nombre + extra
+
+    @staticmethod
+    def _central(miembro: Miembro, desplazamiento: int) -> bytes:
+        nombre = miembro.nombre.encode("utf-8")
+        comprimido = len(miembro.datos)
+        grandes = [
+            valor for valor in (miembro.tamano, comprimido, desplazamiento) if valor >= _LIMITE_32
+        ]
+        # El extra ZIP64 lleva, en este orden, solo los campos que no cupieron.
+        extra = _extra_zip64(*grandes)
+        version = _VERSION_ZIP64 if grandes else _VERSION
+        flags = _FLAG_UTF8 if not miembro.nombre.isascii() else 0
+        encabezado = _CENTRAL.pack(
+            0x02014B50, (_UNIX << 8) | version, version, flags, miembro.metodo, *miembro.fecha, miembro.crc,
+            min(comprimido, _LIMITE_32), min(miembro.tamano, _LIMITE_32),
+            len(nombre), len(extra), 0, 0, 0, miembro.atributos, min(desplazamiento, _LIMITE_32),
+        )
+        return encabezado + nombre + extra
+
+    def _fin(self) -> bytes:
+        entradas = len(self.central)
+        inicio_central = self.posicion
+        zip64 = entradas >= _LIMITE_16 or self.tamano_central >= _LIMITE_32 or inicio_central >= _LIMITE_32
+        registros = b""
+        if zip64:
+            fin_zip64 = inicio_central + self.tamano_central
+            registros = _FIN_ZIP64.pack(
+                0x06064B50, _FIN_ZIP64.size - 12, (_UNIX << 8) | _VERSION_ZIP64, _VERSION_ZIP64, 0, 0,
+                entradas, entradas, self.tamano_central, inicio_central,
+            ) + _LOCALIZADOR_ZIP64.pack(0x07064B50, 0, fin_zip64, 1)
+        return registros + _FIN.pack(
+            0x06054B50, 0, 0, min(entradas, _LIMITE_16), min(entradas, _LIMITE_16),
+            min(self.tamano_central, _LIMITE_32), min(inicio_central, _LIMITE_32), 0,
+        )
+
+    def tamano_con(self, miembro: Miembro) -> int:
+        """Tamaño que tendría el archivo si se agregara `miembro` y se cerrara enseguida (cota)."""
+        registros_fin = _FIN.size + _FIN_ZIP64.size + _LOCALIZADOR_ZIP64.size
+        return (
+            self.posicion + len(self._local(miembro)) + len(miembro.datos)
+            + self.tamano_central + len(self._central(miembro, self.posicion)) + registros_fin
+        )
+
+    def add(self, miembro: Miembro) -> None:
+        self.central.append(self._central(miembro, self.posicion))
+        self.tamano_central += len(self.central[-1])
+        local = self._local(miembro)
+        self.handle.write(local)
+        self.handle.write(miembro.datos)
+        self.posicion += len(local) + len(miembro.datos)
+
+    def close(self) -> None:
+        if self.handle.closed:
+            return
+        try:
+            for entrada in self.central:
+                self.handle.write(entrada)
+            self.handle.write(self._fin())
+        finally:
+            self.handle.close()
+
+    def __enter__(self) -> "ZipWriter":
+        return self
+
+    def __exit__(self, *exc) -> Optional[bool]:
+        self.close()
+        return None